@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+import multiprocessing
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# benchmark the code of this working tree rather than an installed version
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# the stand-in servers are shared with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+
+from standin_servers import KacheryStandin, PairioStandin  # noqa: E402
+
+# Benchmarks of the storage hot paths of mountainclient: computeFileSha1(),
+# saveFile(), realizeFile(), getValue()/setValue() and readDir().
+#
+# Synthetic trees of files are generated in a work directory:
+#
+#   many_small: many small files in nested subdirectories
+#   medium:     a moderate number of medium sized files
+#   huge:       a few huge files
+#
+# Each benchmark uses its own sha1 cache (SHA1_CACHE_DIR) and local database
+# (MOUNTAIN_DIR) inside the work directory:
+#
+#   cold:       starting from an empty cache and database (the files may still
+#               be in the page cache of the OS)
+#   warm:       repeating the operation with everything already cached
+#   contention: N processes doing the same thing at the same time against one
+#               cache and database
+#
+# Remote operations use local stand-ins for kachery and pairio (see
+# tests/standin_servers.py), optionally with a simulated latency. The results
+# are written as json, and two result files can be compared with --compare.
+
+_MB = 1024 * 1024
+_GB = 1024 * _MB
+
+# tree name -> (number of files, file size); and the number of keys
+SCALES: Dict[str, Dict[str, Any]] = dict(
+    small=dict(many_small=(500, 4096), medium=(20, _MB), huge=(1, 64 * _MB), num_keys=500),
+    medium=dict(many_small=(5000, 4096), medium=(100, 4 * _MB), huge=(2, 512 * _MB), num_keys=5000),
+    large=dict(many_small=(50000, 4096), medium=(200, 16 * _MB), huge=(4, 2 * _GB), num_keys=20000)
+)
+_TREE_NAMES = ['many_small', 'medium', 'huge']
+_FILES_PER_SUBDIR = 100
+# environment variables that change the behavior being measured
+_CONFIG_ENV_VARS = [
+    'MOUNTAIN_DB_BACKEND', 'SHA1_CACHE_INDEX', 'SHA1_CACHE_LINK_MODE', 'SHA1_CACHE_CHUNKING',
+    'MOUNTAIN_DIR_INDEX_CACHE', 'FILELOCK_MODE', 'SHA1_CACHE_COMPRESSION'
+]
+
+
+class _Context():
+    def __init__(self, *, workdir: str, scale: str, repeats: int, num_procs: int, kachery: KacheryStandin, pairio: PairioStandin):
+        self.workdir = workdir
+        self.scale = SCALES[scale]
+        self.repeats = repeats
+        self.num_procs = num_procs
+        self.kachery = kachery
+        self.pairio = pairio
+        self.trees: Dict[str, List[str]] = dict()
+        self._env_counter = 0
+
+    def fresh_client(self, label: str):
+        # a new client with its own (empty) sha1 cache and local database
+        self._env_counter += 1
+        env_dir = os.path.join(self.workdir, 'env', '{}-{}'.format(self._env_counter, re.sub('[^a-zA-Z0-9_]', '_', label)))
+        os.makedirs(env_dir)
+        env = dict(SHA1_CACHE_DIR=os.path.join(env_dir, 'sha1-cache'), MOUNTAIN_DIR=os.path.join(env_dir, 'mountain'), PAIRIO_URL=self.pairio.url)
+        os.makedirs(env['MOUNTAIN_DIR'])
+        os.environ.update(env)
+        return _new_client(), env
+
+
+def _new_client():
+    from mountainclient import MountainClient
+    mt = MountainClient()
+    mt.setPairioToken('benchmark', 'benchmark-token')
+    return mt
+
+
+def _tree_size(files: List[str]) -> int:
+    return sum([os.path.getsize(f) for f in files])
+
+
+def generate_tree(directory: str, *, num_files: int, file_size: int, seed: int) -> List[str]:
+    # Deterministic content: a random block (depending on the seed) with the
+    # file and block indices written at the start of each block, so that all
+    # files and blocks are distinct
+    block_size = min(file_size, _MB)
+    block = random.Random(seed).getrandbits(8 * block_size).to_bytes(block_size, 'little')
+    paths = []
+    for ii in range(num_files):
+        subdir = os.path.join(directory, 'd{:03d}'.format(ii // _FILES_PER_SUBDIR))
+        if not os.path.exists(subdir):
+            os.makedirs(subdir)
+        path = os.path.join(subdir, 'file{:06d}.dat'.format(ii))
+        with open(path, 'wb') as f:
+            offset = 0
+            jj = 0
+            while offset < file_size:
+                n = min(block_size, file_size - offset)
+                header = struct.pack('<QQ', ii, jj)
+                f.write((header + block[len(header):])[:n])
+                offset += n
+                jj += 1
+        paths.append(path)
+    return paths
+
+
+def _measure(name: str, *, setup: Callable[[], Any], run: Callable[[Any], Any], repeats: int, num_ops: int, num_bytes: int) -> dict:
+    elapsed_list = []
+    for _ in range(repeats):
+        state = setup()
+        timer = time.perf_counter()
+        run(state)
+        elapsed_list.append(time.perf_counter() - timer)
+    return _result(name, elapsed_list, num_ops=num_ops, num_bytes=num_bytes)
+
+
+def _result(name: str, elapsed_list: List[float], *, num_ops: int, num_bytes: int, extra: Optional[dict]=None) -> dict:
+    elapsed = statistics.median(elapsed_list)
+    ret = dict(
+        name=name,
+        num_ops=num_ops,
+        num_bytes=num_bytes,
+        elapsed_sec=elapsed,
+        elapsed_sec_all=elapsed_list,
+        ops_per_sec=num_ops / elapsed if elapsed > 0 else None,
+        mb_per_sec=(num_bytes / _MB) / elapsed if (elapsed > 0) and num_bytes else None
+    )
+    if extra:
+        ret.update(extra)
+    print('{:<50} {:>10.4f} sec {:>12} ops/sec {:>10} MB/sec'.format(
+        name, elapsed, _fmt(ret['ops_per_sec']), _fmt(ret['mb_per_sec'])))
+    return ret
+
+
+def _fmt(x: Optional[float]) -> str:
+    return '{:.1f}'.format(x) if x is not None else '-'
+
+
+def _check(condition: bool, message: str) -> None:
+    if not condition:
+        raise Exception('Benchmark check failed: ' + message)
+
+
+def bench_compute_file_sha1(ctx: _Context) -> List[dict]:
+    ret = []
+    for tree, files in ctx.trees.items():
+        num_bytes = _tree_size(files)
+
+        def run(mt, files=files):
+            for f in files:
+                _check(mt.computeFileSha1(f) is not None, 'computeFileSha1')
+
+        def setup_cold():
+            return ctx.fresh_client('sha1-cold')[0]
+        ret.append(_measure('computeFileSha1/{}/cold'.format(tree), setup=setup_cold, run=run, repeats=ctx.repeats, num_ops=len(files), num_bytes=num_bytes))
+        mt_warm = setup_cold()
+        run(mt_warm)
+        ret.append(_measure('computeFileSha1/{}/warm'.format(tree), setup=lambda: mt_warm, run=run, repeats=ctx.repeats, num_ops=len(files), num_bytes=0))
+
+        def run_batch(mt, files=files):
+            _check(None not in mt.computeFileSha1s(files), 'computeFileSha1s')
+        ret.append(_measure('computeFileSha1s/{}/cold'.format(tree), setup=setup_cold, run=run_batch, repeats=ctx.repeats, num_ops=len(files), num_bytes=num_bytes))
+    return ret
+
+
+def bench_save_and_realize(ctx: _Context) -> List[dict]:
+    ret = []
+    for tree, files in ctx.trees.items():
+        num_bytes = _tree_size(files)
+
+        def run_save(mt, files=files):
+            return [mt.saveFile(f) for f in files]
+
+        def setup_cold():
+            return ctx.fresh_client('save-cold')[0]
+        ret.append(_measure('saveFile/{}/cold'.format(tree), setup=setup_cold, run=run_save, repeats=ctx.repeats, num_ops=len(files), num_bytes=num_bytes))
+        mt_warm = setup_cold()
+        sha1_paths = run_save(mt_warm)
+        ret.append(_measure('saveFile/{}/warm'.format(tree), setup=lambda: mt_warm, run=run_save, repeats=ctx.repeats, num_ops=len(files), num_bytes=0))
+
+        def run_realize(mt, sha1_paths=sha1_paths):
+            for p in sha1_paths:
+                _check(mt.realizeFile(p) is not None, 'realizeFile')
+        ret.append(_measure('realizeFile/{}/warm'.format(tree), setup=lambda: mt_warm, run=run_realize, repeats=ctx.repeats, num_ops=len(files), num_bytes=0))
+
+        # download from the kachery stand-in into an empty cache
+        for f in files:
+            with open(f, 'rb') as fobj:
+                ctx.kachery.addContent(fobj.read())
+
+        def run_download(mt, sha1_paths=sha1_paths):
+            for p in sha1_paths:
+                _check(mt.realizeFile(p, download_from=ctx.kachery.url) is not None, 'realizeFile from kachery')
+        ret.append(_measure('realizeFile/{}/kachery-cold'.format(tree), setup=setup_cold, run=run_download, repeats=ctx.repeats, num_ops=len(files), num_bytes=num_bytes))
+    return ret
+
+
+def bench_read_dir(ctx: _Context) -> List[dict]:
+    ret = []
+    for tree, files in ctx.trees.items():
+        directory = os.path.join(ctx.workdir, 'trees', tree)
+        num_bytes = _tree_size(files)
+
+        def run(mt, directory=directory, files=files):
+            _check(mt.readDir(directory, recursive=True, include_sha1=True) is not None, 'readDir')
+
+        def setup_cold():
+            return ctx.fresh_client('readdir-cold')[0]
+        ret.append(_measure('readDir/{}/cold'.format(tree), setup=setup_cold, run=run, repeats=ctx.repeats, num_ops=len(files), num_bytes=num_bytes))
+        mt_warm = setup_cold()
+        run(mt_warm)
+        ret.append(_measure('readDir/{}/warm'.format(tree), setup=lambda: mt_warm, run=run, repeats=ctx.repeats, num_ops=len(files), num_bytes=0))
+        ret.append(_measure('computeDirHash/{}/warm'.format(tree), setup=lambda: mt_warm, run=lambda mt, directory=directory: mt.computeDirHash(directory),
+                            repeats=ctx.repeats, num_ops=len(files), num_bytes=0))
+    return ret
+
+
+def bench_key_values(ctx: _Context) -> List[dict]:
+    ret = []
+    num_keys = ctx.scale['num_keys']
+    keys = [dict(benchmark='key-value', index=ii) for ii in range(num_keys)]
+
+    def run_set(mt):
+        for ii, key in enumerate(keys):
+            mt.setValue(key=key, value='value-{}'.format(ii))
+
+    def run_get(mt):
+        for ii, key in enumerate(keys):
+            _check(mt.getValue(key=key) == 'value-{}'.format(ii), 'getValue')
+
+    def setup_cold():
+        return ctx.fresh_client('kv-cold')[0]
+    ret.append(_measure('setValue/local/cold', setup=setup_cold, run=run_set, repeats=ctx.repeats, num_ops=num_keys, num_bytes=0))
+    mt_warm = setup_cold()
+    run_set(mt_warm)
+    ret.append(_measure('setValue/local/overwrite', setup=lambda: mt_warm, run=run_set, repeats=ctx.repeats, num_ops=num_keys, num_bytes=0))
+    ret.append(_measure('getValue/local/warm', setup=lambda: mt_warm, run=run_get, repeats=ctx.repeats, num_ops=num_keys, num_bytes=0))
+    ret.append(_measure('getValue/local/missing', setup=lambda: mt_warm, run=lambda mt: [mt.getValue(key=dict(missing=ii)) for ii in range(num_keys)],
+                        repeats=ctx.repeats, num_ops=num_keys, num_bytes=0))
+
+    # remote (pairio stand-in)
+    num_remote_keys = max(1, num_keys // 10)
+    remote_keys = keys[:num_remote_keys]
+
+    def run_set_remote(mt):
+        for ii, key in enumerate(remote_keys):
+            mt.setValue(key=key, value='value-{}'.format(ii), collection='benchmark')
+
+    def run_get_remote(mt):
+        for ii, key in enumerate(remote_keys):
+            _check(mt.getValue(key=key, collection='benchmark') == 'value-{}'.format(ii), 'getValue from pairio')
+    ret.append(_measure('setValue/pairio', setup=lambda: mt_warm, run=run_set_remote, repeats=ctx.repeats, num_ops=num_remote_keys, num_bytes=0))
+    ret.append(_measure('getValue/pairio', setup=lambda: mt_warm, run=run_get_remote, repeats=ctx.repeats, num_ops=num_remote_keys, num_bytes=0))
+    return ret
+
+
+def _contention_worker(env: dict, op: str, args: dict, barrier, queue) -> None:
+    os.environ.update(env)
+    try:
+        mt = _new_client()
+        barrier.wait()
+        timer = time.perf_counter()
+        if op == 'saveFile':
+            for f in args['files']:
+                _check(mt.saveFile(f) is not None, 'saveFile')
+        elif op == 'realizeFile':
+            for p in args['sha1_paths']:
+                _check(mt.realizeFile(p, download_from=args['download_from']) is not None, 'realizeFile')
+        elif op == 'setValue/getValue':
+            for ii in range(args['num_keys']):
+                key = dict(benchmark='contention', worker=args['worker'], index=ii)
+                mt.setValue(key=key, value=str(ii))
+                _check(mt.getValue(key=key) == str(ii), 'getValue')
+        else:
+            raise Exception('Unexpected op: ' + op)
+        queue.put((time.perf_counter() - timer, None))
+    except Exception as e:
+        queue.put((None, str(e)))
+
+
+def _run_contention(ctx: _Context, name: str, op: str, args_list: List[dict], *, num_ops: int, num_bytes: int) -> dict:
+    # The elapsed time is that of the slowest process, measured from when all
+    # processes are ready (excluding process startup)
+    mp = multiprocessing.get_context('spawn')
+    elapsed_list = []
+    for _ in range(ctx.repeats):
+        _, env = ctx.fresh_client('contention')
+        barrier = mp.Barrier(len(args_list))
+        queue = mp.Queue()
+        procs = [mp.Process(target=_contention_worker, args=(env, op, args, barrier, queue)) for args in args_list]
+        for p in procs:
+            p.start()
+        results = [queue.get() for _ in procs]
+        for p in procs:
+            p.join()
+        errors = [err for _, err in results if err is not None]
+        if errors:
+            raise Exception('Error in contention benchmark {}: {}'.format(name, errors[0]))
+        elapsed_list.append(max([elapsed for elapsed, _ in results]))
+    return _result(name, elapsed_list, num_ops=num_ops, num_bytes=num_bytes, extra=dict(num_procs=len(args_list)))
+
+
+def bench_contention(ctx: _Context) -> List[dict]:
+    ret = []
+    n = ctx.num_procs
+    files = ctx.trees['many_small']
+    # all processes save the same files
+    ret.append(_run_contention(ctx, 'contention/saveFile/many_small/{}procs'.format(n), 'saveFile',
+                               [dict(files=files) for _ in range(n)], num_ops=n * len(files), num_bytes=n * _tree_size(files)))
+    # and download the same files
+    mt, _ = ctx.fresh_client('contention-setup')
+    sha1_paths = []
+    for f in files:
+        with open(f, 'rb') as fobj:
+            sha1_paths.append('sha1://' + ctx.kachery.addContent(fobj.read()))
+    ret.append(_run_contention(ctx, 'contention/realizeFile/many_small/{}procs'.format(n), 'realizeFile',
+                               [dict(sha1_paths=sha1_paths, download_from=ctx.kachery.url) for _ in range(n)], num_ops=n * len(files), num_bytes=n * _tree_size(files)))
+    # and write and read their own keys
+    num_keys = ctx.scale['num_keys'] // n
+    ret.append(_run_contention(ctx, 'contention/setValue+getValue/{}procs'.format(n), 'setValue/getValue',
+                               [dict(worker=ii, num_keys=num_keys) for ii in range(n)], num_ops=2 * n * num_keys, num_bytes=0))
+    return ret
+
+
+BENCHMARKS: List[Tuple[str, Callable[[_Context], List[dict]]]] = [
+    ('sha1', bench_compute_file_sha1),
+    ('save_realize', bench_save_and_realize),
+    ('read_dir', bench_read_dir),
+    ('key_value', bench_key_values),
+    ('contention', bench_contention)
+]
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except:
+        return None
+
+
+def compare_results(path1: str, path2: str) -> None:
+    with open(path1, 'r') as f:
+        obj1 = json.load(f)
+    with open(path2, 'r') as f:
+        obj2 = json.load(f)
+    results1 = dict([(r['name'], r) for r in obj1['results']])
+    print('{:<50} {:>12} {:>12} {:>8}'.format('benchmark', (obj1.get('commit') or 'before')[:10], (obj2.get('commit') or 'after')[:10], 'speedup'))
+    for r2 in obj2['results']:
+        r1 = results1.get(r2['name'], None)
+        if r1 is None:
+            continue
+        speedup = r1['elapsed_sec'] / r2['elapsed_sec'] if r2['elapsed_sec'] > 0 else float('inf')
+        print('{:<50} {:>12.4f} {:>12.4f} {:>7.2f}x'.format(r2['name'], r1['elapsed_sec'], r2['elapsed_sec'], speedup))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the storage hot paths of mountainclient (computeFileSha1, saveFile, realizeFile, getValue/setValue and readDir) on synthetic trees of files.')
+    parser.add_argument('--scale', default='small', choices=list(SCALES.keys()), help='The size of the synthetic trees')
+    parser.add_argument('--only', default=None, help='Only run the benchmark groups matching this regular expression ({})'.format(', '.join([name for name, _ in BENCHMARKS])))
+    parser.add_argument('--repeats', type=int, default=3, help='Number of repetitions of each benchmark (the median is reported)')
+    parser.add_argument('--num-procs', type=int, default=4, help='Number of concurrent processes in the contention benchmarks')
+    parser.add_argument('--latency', type=float, default=0, help='Simulated latency (seconds per request) of the kachery and pairio stand-ins')
+    parser.add_argument('--workdir', default=None, help='Work directory (by default a new temporary directory, removed at the end)')
+    parser.add_argument('--output', '-o', default=None, help='Write the results to this json file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), default=None, help='Compare two result files instead of running the benchmarks')
+
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(args.compare[0], args.compare[1])
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='mt-benchmarks-')
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    results: List[dict] = []
+    try:
+        with KacheryStandin(latency=args.latency) as kachery, PairioStandin(latency=args.latency) as pairio:
+            ctx = _Context(workdir=workdir, scale=args.scale, repeats=args.repeats, num_procs=args.num_procs, kachery=kachery, pairio=pairio)
+            print('Generating synthetic trees in {}'.format(workdir))
+            for ii, tree in enumerate(_TREE_NAMES):
+                num_files, file_size = ctx.scale[tree]
+                ctx.trees[tree] = generate_tree(os.path.join(workdir, 'trees', tree), num_files=num_files, file_size=file_size, seed=ii)
+            for name, bench in BENCHMARKS:
+                if args.only and not re.search(args.only, name):
+                    continue
+                results.extend(bench(ctx))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    obj = dict(
+        commit=_git_commit(),
+        timestamp=time.time(),
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        num_cpus=os.cpu_count(),
+        scale=args.scale,
+        repeats=args.repeats,
+        latency=args.latency,
+        config=dict([(k, os.environ[k]) for k in _CONFIG_ENV_VARS if k in os.environ]),
+        results=results
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(obj, f, indent=4)
+        print('Wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -68,6 +68,20 @@ GET:/check/sha1/[sha1]
     size:[int]
   }
 
+POST:/check/sha1
+  Check whether many files are available for download, in one request
+
+  The body of the POST request is the JSON of the following object
+  {
+    sha1s:[list of sha1 strings (at most 1000)]
+  }
+
+  Returns the JSON of the following object
+  {
+    success:[boolean],
+    results:[list of {found:[boolean], size:[int]}, in the same order as sha1s]
+  }
+
 GET:/probe
   Check whether the server is alive
 
@@ -89,6 +103,7 @@ var path = require('path');
 
 const MAX_FILE_SIZE = Number(process.env['KACHERY_UPLOAD_MAX_SIZE']) || (1024 * 1024 * 1024 * 100);
 const TEST_SIGNATURE = process.env['KACHERY_TEST_SIGNATURE'] || null;
+const MAX_BATCH_CHECK_SIZE = 1000;
 
 process.on('SIGINT', function () {
   process.exit();
@@ -141,6 +156,36 @@ function KacheryServer() {
     res.json({ success: true, found: found, size: size });
   });
 
+  // API:POST /check/sha1
+  m_app.post('/check/sha1', function (req, res) {
+    // invalid requests are answered with 400 (not 500), so that clients do not retry them
+    let sha1s = (req.body || {}).sha1s;
+    if (!Array.isArray(sha1s)) {
+      error_response(req, res, 400, 'Missing or invalid sha1s in request body.')
+      return;
+    }
+    if (sha1s.length > MAX_BATCH_CHECK_SIZE) {
+      error_response(req, res, 400, `Too many sha1s in batch check: ${sha1s.length}>${MAX_BATCH_CHECK_SIZE}`)
+      return;
+    }
+    let results = [];
+    for (let sha1 of sha1s) {
+      if ((typeof(sha1) != 'string') || (sha1.length != 40)) {
+        error_response(req, res, 400, 'Invalid sha1 string.')
+        return;
+      }
+      let found = false;
+      let size = 0;
+      let relpath = m_sha1_cache.findFileForSha1(sha1);
+      if (relpath) {
+        found = true;
+        size = safe_file_size(m_sha1_cache.directory() + '/' + relpath);
+      }
+      results.push({ found: found, size: size });
+    }
+    res.json({ success: true, results: results });
+  });
+
   // API:GET /get/sha1/:sha1?signature=[signature (optional)]
   m_app.get('/get/sha1/:sha1', function (req, res) {
     let params = req.params;
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+from mountainclient import MountainClient
+from mountainclient.filelock import FileLock
+from typing import Optional, List, Dict, Tuple
+
+# The compute requirements of a job (the _compute_requirements argument of
+# createJobs(), on top of the COMPUTE_REQUIREMENTS attribute of the processor
+# class) declare the number of cpu cores, the memory (GB) and the number of
+# gpus that the job needs. The job handlers pack jobs against the capacity of
+# the node (see ParallelJobHandler).
+#
+# The peak memory of each job that runs is recorded in its runtime info and,
+# per processor, in the local database (a single record holding the most
+# recent peaks, which is updated under a lock so that processes finishing at
+# the same time do not lose each other's peaks). When no memory is declared
+# for a job, and its processor has run before, the memory reserved for it is
+# the largest of the recent peaks plus a margin. Declared memory is always
+# respected.
+
+local_client = MountainClient()
+
+_DEFAULT_COMPUTE_REQUIREMENTS = dict(
+    num_cores=1,
+    memory_gb=None,  # unknown
+    num_gpus=0
+)
+_NUM_PEAKS_TO_REMEMBER = 20
+_MEMORY_ESTIMATE_MARGIN = 1.2
+_MEMORY_ESTIMATE_CACHE_SEC = 60
+
+_memory_estimate_cache: Dict[Tuple[str, str], Tuple[float, Optional[float]]] = dict()
+
+
+def normalizeComputeRequirements(compute_requirements: Optional[dict]) -> dict:
+    """Fill in the default cores, memory and gpus of the compute requirements
+    of a job, and check the values. Other fields (e.g., batch_type) are kept."""
+    ret = dict(_DEFAULT_COMPUTE_REQUIREMENTS)
+    ret.update(compute_requirements or dict())
+    for name in ['num_cores', 'memory_gb']:
+        val = ret[name]
+        if val is None:
+            continue
+        if (type(val) not in [int, float]) or (val < 0):
+            raise Exception('Invalid {} in compute requirements: {}'.format(name, val))
+    if (type(ret['num_gpus']) != int) or (ret['num_gpus'] < 0):
+        raise Exception('Invalid num_gpus in compute requirements: {}'.format(ret['num_gpus']))
+    return ret
+
+
+def jobResources(job_object: dict, *, use_learned_memory: bool=True) -> dict:
+    """The cores, memory (GB) and gpus to reserve for a job when scheduling it"""
+    compute_requirements = normalizeComputeRequirements(job_object.get('compute_requirements', None))
+    memory_gb = compute_requirements['memory_gb']
+    if (memory_gb is None) and use_learned_memory:
+        learned = estimatedPeakMemoryGb(processor_name=job_object['processor_name'], processor_version=job_object['processor_version'])
+        if learned is not None:
+            memory_gb = learned
+    return dict(
+        num_cores=compute_requirements['num_cores'],
+        memory_gb=memory_gb or 0,
+        num_gpus=compute_requirements['num_gpus']
+    )
+
+
+def recordPeakMemory(*, processor_name: str, processor_version: str, peak_memory_gb: float) -> None:
+    """Remember the peak memory of a run of a processor (in the local database)"""
+    key = _peak_memory_key(processor_name, processor_version)
+    lock_dir = local_client.localDatabasePath()
+    os.makedirs(lock_dir, exist_ok=True)
+    with FileLock(os.path.join(lock_dir, 'mlprocessors_peak_memory.lock'), exclusive=True):
+        peaks = _load_peaks(key) + [peak_memory_gb]
+        local_client.setValue(key=key, value=json.dumps(peaks[-_NUM_PEAKS_TO_REMEMBER:]))
+    _memory_estimate_cache.pop((processor_name, processor_version), None)
+
+
+def estimatedPeakMemoryGb(*, processor_name: str, processor_version: str) -> Optional[float]:
+    """The memory (GB) to expect a processor to use, based on its recent runs,
+    or None if it has not run before"""
+    k = (processor_name, processor_version)
+    if k in _memory_estimate_cache:
+        timestamp, estimate = _memory_estimate_cache[k]
+        if time.time() - timestamp < _MEMORY_ESTIMATE_CACHE_SEC:
+            return estimate
+    peaks = _load_peaks(_peak_memory_key(processor_name, processor_version))
+    estimate = max(peaks) * _MEMORY_ESTIMATE_MARGIN if peaks else None
+    _memory_estimate_cache[k] = (time.time(), estimate)
+    return estimate
+
+
+class PeakMemoryMeter():
+    def __init__(self):
+        """Measures the peak memory used while running a job, both by this
+        process and by the processes that it runs (Linux only, otherwise the
+        peak is unknown)
+
+        The peak resident set size of this process is reset at start. For the
+        child processes we only know the largest peak of all children that
+        have finished, so their peak is only known when it exceeds that of the
+        earlier children.
+        """
+        self._self_reset = False
+        self._children_maxrss_kb = 0
+
+    def start(self) -> None:
+        self._self_reset = _reset_peak_rss()
+        self._children_maxrss_kb = _children_maxrss_kb() or 0
+
+    def stop(self) -> Optional[float]:
+        """Returns the peak memory in GB, or None if unknown"""
+        peaks_kb = []
+        if self._self_reset:
+            hwm = _read_peak_rss_kb()
+            if hwm is not None:
+                peaks_kb.append(hwm)
+        children_maxrss_kb = _children_maxrss_kb()
+        if (children_maxrss_kb is not None) and (children_maxrss_kb > self._children_maxrss_kb):
+            peaks_kb.append(children_maxrss_kb)
+        if not peaks_kb:
+            return None
+        return max(peaks_kb) / (1024 * 1024)
+
+
+def _peak_memory_key(processor_name: str, processor_version: str) -> dict:
+    return dict(name='mlprocessors_peak_memories', processor_name=processor_name, processor_version=processor_version)
+
+
+def _load_peaks(key: dict) -> List[float]:
+    txt = local_client.getValue(key=key)
+    if not txt:
+        return []
+    try:
+        return [float(x) for x in json.loads(txt)][-_NUM_PEAKS_TO_REMEMBER:]
+    except:
+        print('Warning: problem parsing recorded peak memory for {}'.format(key))
+        return []
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except:
+        return False
+
+
+def _read_peak_rss_kb() -> Optional[int]:
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except:
+        pass
+    return None
+
+
+def _children_maxrss_kb() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    if not os.path.exists('/proc/self/status'):
+        # ru_maxrss is in bytes (not kB) on some systems
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
@@ -3,6 +3,7 @@ import os
 import fnmatch
 from mountainclient import MountainClient
 from .mountainjob import MountainJob
+from .computeresources import normalizeComputeRequirements
 import json
 import inspect
 import multiprocessing
@@ -89,8 +90,8 @@ def createJobs(proc, argslist, verbose=None) -> List[MountainJob]:
         if _label is None:
             _label = '{} (version: {})'.format(proc.NAME, proc.VERSION)
 
-        if _compute_requirements is None:
-            _compute_requirements = dict()
+        # cores, memory (GB) and gpus, on top of those declared by the processor class
+        _compute_requirements = normalizeComputeRequirements(dict(getattr(proc, 'COMPUTE_REQUIREMENTS', dict()), **(_compute_requirements or dict())))
 
         # hashes for inputs are computed below
         inputs = dict()
@@ -415,22 +416,12 @@ def _file_exists_or_is_sha1_url(fname):
 
 @mtlogging.log()
 def _compute_sha1s_for_local_file_inputs(inputs):
-    # do not parallelize if small number
-    if len(inputs) <= 4:
-        return [_compute_sha1_for_local_file_input(input0) for input0 in inputs]
-    pool = multiprocessing.Pool(10)
-    ret = pool.map(_compute_sha1_for_local_file_input, inputs)
-    pool.close()
-    pool.join()
-    return ret
-
-
-def _compute_sha1_for_local_file_input(input0):
-    path0 = input0['path']
-    if not os.path.exists(path0):
-        raise Exception('Input file does not exists: {}'.format(path0))
-    sha1 = local_client.computeFileSha1(path0)
-    return sha1
+    paths = [input0['path'] for input0 in inputs]
+    for path0 in paths:
+        if not os.path.exists(path0):
+            raise Exception('Input file does not exists: {}'.format(path0))
+    # stat everything up front, look up cached hashes in one query and hash the rest in parallel
+    return local_client.computeFileSha1s(paths)
 
 
 @mtlogging.log()
@@ -1,4 +1,4 @@
-from .jobhandler import JobHandler
+from .jobhandler import JobHandler, _job_finished
 from .mountainjob import MountainJob
 from .mountainjobresult import MountainJobResult
 
@@ -11,6 +11,7 @@ class DefaultJobHandler(JobHandler):
         job.result._status = 'running'
         result = job._execute()
         job.result._status = 'finished'
+        _job_finished(job)
         return result
 
     def iterate(self) -> None:
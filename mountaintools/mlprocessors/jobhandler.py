@@ -1,13 +1,24 @@
 import abc
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .mountainjob import MountainJob
 from .mountainjobresult import MountainJobResult
+from typing import Optional
+
+# The longest time between calls to iterate() while waiting. Handlers that
+# poll (e.g., files written by slurm workers) make progress in iterate().
+_POLL_INTERVAL = 0.2
+# The number of threads realizing the cached results of jobs (see cacheRealizationPool())
+_CACHE_REALIZATION_POOL_SIZE = 10
 
 
 class JobHandler():
     def __init__(self):
         super().__init__()
         self._parent_job_handler = None
+        self._wake_event = threading.Event()
+        self._cache_realization_pool: Optional[ThreadPoolExecutor] = None
 
     @abc.abstractmethod
     def executeJob(self, job: MountainJob) -> MountainJobResult:
@@ -29,6 +40,31 @@ class JobHandler():
     def cleanup(self) -> None:
         pass
 
+    def waitForEvent(self, timeout: Optional[float]) -> None:
+        """Block until something may have happened that calls for iterate()
+        (e.g., a job finished) or until timeout (in seconds). Handlers that can
+        wait on their workers directly override this. The default waits until
+        wake() is called."""
+        if self._wake_event.wait(timeout):
+            self._wake_event.clear()
+
+    def wake(self) -> None:
+        """Wake up waitForEvent() (may be called from any thread)"""
+        self._wake_event.set()
+
+    def cacheRealizationPool(self) -> ThreadPoolExecutor:
+        """The threads on which the job queue realizes the cached results of
+        its jobs (see MountainJob.checkCacheForJobs()). The pool is created
+        when first needed and shut down by closeCacheRealizationPool()."""
+        if self._cache_realization_pool is None:
+            self._cache_realization_pool = ThreadPoolExecutor(max_workers=_CACHE_REALIZATION_POOL_SIZE)
+        return self._cache_realization_pool
+
+    def closeCacheRealizationPool(self) -> None:
+        if self._cache_realization_pool is not None:
+            self._cache_realization_pool.shutdown(wait=True)
+            self._cache_realization_pool = None
+
     def wait(self, timeout: float=-1):
         timer = time.time()
         while not self.isFinished():
@@ -37,5 +73,13 @@ class JobHandler():
             if (timeout >= 0) and (elapsed > timeout):
                 return False
             if not self.isFinished():
-                time.sleep(0.2)
+                self.waitForEvent(_POLL_INTERVAL)
         return True
+
+
+def _job_finished(job: MountainJob) -> None:
+    # Called by the job handlers after setting the status of a job to
+    # finished, so that its job queue (if any) processes it right away
+    job_queue = job.result._job_queue
+    if job_queue is not None:
+        job_queue.notifyJobFinished(job.result)
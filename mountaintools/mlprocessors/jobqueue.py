@@ -1,15 +1,27 @@
 import time
+import heapq
+import threading
+import collections
 import mlprocessors as mlpr
 import traceback
-import multiprocessing
 from .mountainjob import MountainJob
 from .mountainjobresult import MountainJobResult
 from mountainclient import client as mt
-from typing import Optional, List
-from .jobhandler import JobHandler
+from typing import Optional, List, Dict, Deque
+from .jobhandler import JobHandler, _POLL_INTERVAL
 from .defaultjobhandler import DefaultJobHandler
 
 
+# The queue keeps a dependency graph of the queued jobs instead of rescanning
+# them on every iteration. For each job we count the inputs that are still
+# pending (outputs of unfinished queued jobs), and for each job we keep the
+# ids of the jobs waiting on its outputs. A job is moved to the ready heap when
+# its count reaches zero. The job handlers call notifyJobFinished() when a job
+# finishes (from whichever thread they use), and the queue wakes the job
+# handler so that the completion is processed right away rather than at the
+# next poll.
+
+
 class JobQueue():
     def __init__(self, job_handler: JobHandler=DefaultJobHandler()):
         super().__init__()
@@ -22,6 +34,11 @@ class JobQueue():
         self._halted = False  # Whether this job queue has been halted
         self._parent_job_queue = None  # Not sure if we actually support nested job queues, but for now we restore the parent job queue on exit of the with block
         self._job_handler: JobHandler = job_handler  # The job handler (e.g., parallel, slurm, default)
+        self._dependents: Dict[int, List[int]] = dict()  # job id -> ids of the queued jobs that use its outputs
+        self._num_pending_inputs: Dict[int, int] = dict()  # job id -> number of inputs from unfinished jobs
+        self._ready_job_ids: List[int] = []  # heap of the ids of the queued jobs whose inputs are available
+        self._completions_lock = threading.Lock()
+        self._completed_job_ids: Deque[int] = collections.deque()  # finished jobs not yet processed
         # self._job_manager = None
 
     def queueJob(self, job: MountainJob) -> MountainJobResult:
@@ -41,6 +58,16 @@ class JobQueue():
         self._last_job_id = job_id
         self._queued_jobs[job_id] = job
         self._all_jobs[job_id] = job
+        num_pending_inputs = 0
+        for input0 in _job_inputs(job):
+            if input0.get('pending', False):
+                qj_id = input0['object']['queue_job_id']
+                if qj_id not in self._finished_jobs:
+                    self._dependents.setdefault(qj_id, []).append(job_id)
+                    num_pending_inputs = num_pending_inputs + 1
+        self._num_pending_inputs[job_id] = num_pending_inputs
+        if num_pending_inputs == 0:
+            heapq.heappush(self._ready_job_ids, job_id)
         job_object = job.getObject()
         job_outputs = job_object['outputs']
         result_outputs = dict()
@@ -54,6 +81,7 @@ class JobQueue():
             outputs=result_outputs
         )
         result0 = MountainJobResult(result_object=obj0, job_queue=self)
+        result0._queue_job_id = job_id
         setattr(job, 'result', result0)
         return result0
 
@@ -69,20 +97,21 @@ class JobQueue():
 
         if self._job_handler:
             self._job_handler.iterate()
-        self._check_for_finished_jobs()
+        self._process_completions()
 
-        queued_job_ids = sorted(list(self._queued_jobs.keys()))
-        job_ids_to_run = []
-        for id in queued_job_ids:
-            job = self._queued_jobs[id]
-            if self._job_is_ready_to_run(job):
-                job_ids_to_run.append(id)
-        
         newly_running_jobs = []
-        for id in job_ids_to_run:
+        while self._ready_job_ids:
             if self._halted:
                 return
+            id = heapq.heappop(self._ready_job_ids)
             job = self._queued_jobs[id]
+            if not self._resolve_pending_inputs(job):
+                # an input is not available because the job producing it failed
+                job.result.retcode = 7  # for now this signifies that it failed in this way
+                job.result._status = 'finished'
+                self.notifyJobFinished(job.result)
+                self._process_completions()
+                continue
             del self._queued_jobs[id]
             self._running_jobs[id] = job
             job.result._status = 'running'
@@ -91,7 +120,7 @@ class JobQueue():
 
         if len(newly_running_jobs) > 0:
             print('Checking cache for {} jobs...'.format(len(newly_running_jobs)))
-            newly_running_job_results_from_cache = _check_cache_for_job_results(newly_running_jobs)
+            newly_running_job_results_from_cache = MountainJob.checkCacheForJobs(newly_running_jobs, executor=self._job_handler.cacheRealizationPool())
             for ii, job in enumerate(newly_running_jobs):
                 newly_running_job_result = newly_running_job_results_from_cache[ii]
                 if newly_running_job_result is not None:
@@ -99,12 +128,13 @@ class JobQueue():
                     print('Using result from cache: {}'.format(jobj.get('label', jobj.get('processor_name', '<>'))))
                     job.result.fromObject(newly_running_job_result.getObject())
                     job.result._status = 'finished'
+                    self.notifyJobFinished(job.result)
                 else:
                     self._job_handler.executeJob(job)
 
         if self._job_handler:
             self._job_handler.iterate()
-        self._check_for_finished_jobs()
+        self._process_completions()
     
     def wait(self, timeout: float=-1) -> bool:
         """Wait until all queued jobs have completed or until timeout.
@@ -126,45 +156,68 @@ class JobQueue():
             if (timeout >= 0) and (elapsed > timeout):
                 return False
             if not self.isFinished():
-                time.sleep(0.2)
+                self._wait_for_event(timeout=None if timeout < 0 else timeout - elapsed)
         return True
 
-    def _check_for_finished_jobs(self) -> None:
-        for jobs0 in [self._running_jobs, self._queued_jobs]:
-            finished_job_ids = []
-            for id, job in jobs0.items():
-                if job.result.status() == 'finished':
-                    finished_job_ids.append(id)
-            for id in finished_job_ids:
-                job = jobs0[id]
-                del jobs0[id]
-                self._finished_jobs[id] = job
-
-    def _job_is_ready_to_run(self, job: MountainJob) -> bool:
-        obj0 = job.getObject(copy=False)
-        inputs0 = obj0['inputs']
-        all_inputs: List[dict] = []
-        for _, input0 in inputs0.items():
-            if type(input0) == list:
-                all_inputs.extend(input0)
+    def notifyJobFinished(self, result: MountainJobResult) -> None:
+        """Called by the job handler when it has set the status of the result
+        of a queued job to finished (may be called from any thread).
+
+        Parameters
+        ----------
+        result : MountainJobResult
+            The result of the job (job.result)
+        """
+        if result._queue_job_id is None:
+            return
+        with self._completions_lock:
+            self._completed_job_ids.append(result._queue_job_id)
+        if self._job_handler:
+            self._job_handler.wake()
+
+    def _wait_for_event(self, timeout: Optional[float]) -> None:
+        # Wait until a job finishes (or the job handler has something to do),
+        # but no longer than the poll interval so that handlers that make
+        # progress in iterate() are still iterated
+        with self._completions_lock:
+            if self._completed_job_ids:
+                return
+        timeout = _POLL_INTERVAL if timeout is None else max(0, min(timeout, _POLL_INTERVAL))
+        if self._job_handler:
+            self._job_handler.waitForEvent(timeout)
+        else:
+            time.sleep(timeout)
+
+    def _process_completions(self) -> None:
+        while True:
+            with self._completions_lock:
+                if not self._completed_job_ids:
+                    return
+                id = self._completed_job_ids.popleft()
+            if id in self._running_jobs:
+                job = self._running_jobs.pop(id)
+            elif id in self._queued_jobs:
+                job = self._queued_jobs.pop(id)
             else:
-                all_inputs.append(input0)
-        for input0 in all_inputs:
+                continue
+            self._finished_jobs[id] = job
+            for dependent_id in self._dependents.pop(id, []):
+                self._num_pending_inputs[dependent_id] = self._num_pending_inputs[dependent_id] - 1
+                if self._num_pending_inputs[dependent_id] == 0:
+                    heapq.heappush(self._ready_job_ids, dependent_id)
+
+    def _resolve_pending_inputs(self, job: MountainJob) -> bool:
+        # Fill in the paths of the inputs that come from the outputs of
+        # (finished) queued jobs. Returns False if one of these jobs failed.
+        for input0 in _job_inputs(job):
             if input0.get('pending', False):
                 qj_id = input0['object']['queue_job_id']
                 output_name = input0['object']['output_name']
                 qj = self._all_jobs[qj_id]
-                if qj.result.status() == 'finished':
-                    if qj.result.retcode == 0:
-                        input0['path'] = qj.result.outputs[output_name]
-                        input0['hash'] = mt.computeFileSha1(input0['path'])
-                    else:
-                        # in this case the input is not available because the dependent job failed
-                        job.result.retcode = 7  # for now this signifies that it failed in this way
-                        job.result._status = 'finished'
-                        return False
-                else:
+                if qj.result.retcode != 0:
                     return False
+                input0['path'] = qj.result.outputs[output_name]
+                input0['hash'] = mt.computeFileSha1(input0['path'])
         return True
     
     def isFinished(self) -> bool:
@@ -199,9 +252,21 @@ class JobQueue():
         self.halt()
         if self._job_handler:
             self._job_handler.cleanup()
+            self._job_handler.closeCacheRealizationPool()
         _setCurrentJobQueue(self._parent_job_queue)
 
 
+def _job_inputs(job: MountainJob) -> List[dict]:
+    obj0 = job.getObject(copy=False)
+    all_inputs: List[dict] = []
+    for _, input0 in obj0['inputs'].items():
+        if type(input0) == list:
+            all_inputs.extend(input0)
+        else:
+            all_inputs.append(input0)
+    return all_inputs
+
+
 class _Internal():
     def __init__(self):
         self.current_job_queue: Optional[JobQueue] = None
@@ -216,25 +281,3 @@ def currentJobQueue() -> Optional[JobQueue]:
 def _setCurrentJobQueue(jqueue: Optional[JobQueue]) -> None:
     _internal.current_job_queue = jqueue
 
-
-def _check_cache_for_job_results(jobs: List[MountainJob]) -> List[Optional[MountainJobResult]]:
-    pool = multiprocessing.Pool(10)
-    result_objects = pool.map(_execute_job_check_cache, [job.getObject() for job in jobs])
-    pool.close()
-    pool.join()
-    results: List[Optional[MountainJobResult]] = []
-    for robj in result_objects:
-        if robj:
-            results.append(MountainJobResult(result_object=robj))
-        else:
-            results.append(None)
-    return results
-
-
-def _execute_job_check_cache(job_object: dict) -> Optional[dict]:
-    job = MountainJob(job_object=job_object)
-    result = job._execute_check_cache()
-    if result:
-        return result.getObject()
-    else:
-        return None
@@ -13,8 +13,10 @@ from .temporarydirectory import TemporaryDirectory
 import mtlogging
 import numpy as np
 from .mountainjobresult import MountainJobResult
-from typing import Optional, List, Union, Any, Tuple, TYPE_CHECKING, Type
+from typing import Optional, List, Union, Any, Tuple, Dict, TYPE_CHECKING, Type
+from concurrent.futures import Executor
 from .consolecapture import ConsoleCapture
+from .computeresources import PeakMemoryMeter, recordPeakMemory
 
 if TYPE_CHECKING:
     # avoid cyclic dependency
@@ -123,14 +125,72 @@ class MountainJob():
         else:
             return self._execute()
 
-    def _execute_check_cache(self) -> Optional[MountainJobResult]:
+    @staticmethod
+    def checkCacheForJobs(jobs: List['MountainJob'], *, executor: Optional[Executor]=None) -> List[Optional[MountainJobResult]]:
+        """Look up the cached results of many jobs at once.
+
+        The runtime info and console output signatures of all the jobs are
+        looked up together with MountainClient.getValues() (a single bulk
+        query per shard with the sqlite backend of the local database, and
+        one file per signature with the default files backend). The output
+        signatures are then looked up only for the jobs whose runtime info
+        and console output were both found, and these jobs are realized
+        (loading the cached outputs and copying them to their destination
+        paths).
+
+        Parameters
+        ----------
+        jobs : List[MountainJob]
+            The jobs
+        executor : Optional[Executor], optional
+            Where to realize the cached results concurrently (the job queue
+            uses the pool of its job handler), by default in this thread
+
+        Returns
+        -------
+        List[Optional[MountainJobResult]]
+            The cached result of each job, or None if the job needs to run
+        """
+        candidates = [ii for ii, job in enumerate(jobs) if job._uses_cache()]
+        signatures: List[str] = []
+        for ii in candidates:
+            signatures.extend([jobs[ii].runtimeInfoSignature(), jobs[ii].consoleOutSignature()])
+        values = dict(zip(signatures, local_client.getValues(keys=signatures, check_alt=True)))
+        hits = [
+            ii for ii in candidates
+            if values.get(jobs[ii].runtimeInfoSignature()) and values.get(jobs[ii].consoleOutSignature())
+        ]
+        ret: List[Optional[MountainJobResult]] = [None for _ in jobs]
+        if not hits:
+            return ret
+        signatures = []
+        for ii in hits:
+            signatures.extend(jobs[ii]._output_signatures())
+        values.update(zip(signatures, local_client.getValues(keys=signatures, check_alt=True)))
+        if executor is not None:
+            results = list(executor.map(lambda ii: jobs[ii]._execute_check_cache(_values=values), hits))
+        else:
+            results = [jobs[ii]._execute_check_cache(_values=values) for ii in hits]
+        for ii, result in zip(hits, results):
+            ret[ii] = result
+        return ret
+
+    def _uses_cache(self) -> bool:
         force_run = self._job_object['force_run']
         use_cache = self._job_object['use_cache']
         ignore_local_cache = (os.environ.get('MLPROCESSORS_IGNORE_LOCAL_CACHE', 'FALSE') == 'TRUE')
+        return (use_cache) and (not force_run) and (not ignore_local_cache)
+
+    def _output_signatures(self) -> List[str]:
+        # the keys of the local database looked up by _find_result_in_cache()
+        # once the runtime info and console output are found
+        return [self.outputSignature(output_name) for output_name in self._job_object['outputs'].keys()]
+
+    def _execute_check_cache(self, _values: Optional[Dict[str, Optional[str]]]=None) -> Optional[MountainJobResult]:
         skip_failing = self._job_object['skip_failing']
         skip_timed_out = self._job_object.get('skip_timed_out', False)
-        if (use_cache) and (not force_run) and (not ignore_local_cache):
-            result = self._find_result_in_cache()
+        if self._uses_cache():
+            result = self._find_result_in_cache(_values=_values)
             if result:
                 if (result.retcode == 0):
                     use_result = True
@@ -187,7 +247,8 @@ class MountainJob():
         if self._use_cached_results_only:
             return MountainJobResult()
 
-        with TemporaryDirectory(remove=(not keep_temp_files), prefix='tmp_execute_outputdir_' + self._job_object['processor_name']) as tmp_output_path:
+        # don't let the cache garbage collector evict our inputs while we are running
+        with mt.pinFiles(self.getFilesToRealize()), TemporaryDirectory(remove=(not keep_temp_files), prefix='tmp_execute_outputdir_' + self._job_object['processor_name']) as tmp_output_path:
             attributes_for_processor: dict = dict()
             tmp_output_file_names = dict()
             output_files_to_copy = []
@@ -284,6 +345,8 @@ class MountainJob():
 
             runtime_capture = ConsoleCapture()
             runtime_capture.start_capturing()
+            memory_meter = PeakMemoryMeter()
+            memory_meter.start()
             print('Job: {}'.format(label))
             print('Timestamp: {:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now()))
             R = MountainJobResult()
@@ -330,7 +393,9 @@ class MountainJob():
 
                     if not container:
                         env_vars = []
-                        env_vars.append('PYTHONPATH={}/processor_source/_local_modules'.format(temp_path))
+                        # the processor code imports mlprocessors, which may not be installed
+                        source_path = os.path.dirname(os.path.realpath(__file__))
+                        env_vars.append('PYTHONPATH={}/processor_source/_local_modules:{}'.format(temp_path, os.path.abspath(os.path.join(source_path, '..'))))
                         run_sh_script.substitute('{temp_path}', temp_path)
                         run_sh_script.substitute('{console_out_fname}', tmp_process_console_out_fname)
                         run_sh_script.substitute('{env_vars}', '\n'.join(['export ' + env_var for env_var in env_vars]))
@@ -418,10 +483,20 @@ class MountainJob():
                 print('================================================================================')
 
             runtime_capture.stop_capturing()
+            peak_memory_gb = memory_meter.stop()
             R.retcode = retcode
             R.runtime_info = runtime_capture.runtimeInfo()
             R.runtime_info['retcode'] = retcode
             R.runtime_info['timed_out'] = R.timed_out
+            if peak_memory_gb is not None:
+                R.runtime_info['peak_memory_gb'] = peak_memory_gb
+                if retcode == 0:
+                    # so that the job handlers can schedule future runs of this processor
+                    try:
+                        recordPeakMemory(processor_name=self._job_object['processor_name'], processor_version=self._job_object['processor_version'], peak_memory_gb=peak_memory_gb)
+                    except:
+                        traceback.print_exc()
+                        print('WARNING: problem recording peak memory of job.')
             R.console_out = local_client.saveText(text=runtime_capture.consoleOut(), basename='console_out.txt')
             R.outputs = dict()
             if retcode == 0:
@@ -540,12 +615,19 @@ class MountainJob():
             output_name=output_name
         )
 
-    def _find_result_in_cache(self) -> Optional[MountainJobResult]:
+    def _find_result_in_cache(self, _values: Optional[Dict[str, Optional[str]]]=None) -> Optional[MountainJobResult]:
+        # _values: the values of the signatures if they were already looked up
+        # (see checkCacheForJobs())
+        def get_value(signature: str) -> Optional[str]:
+            if _values is not None:
+                return _values.get(signature, None)
+            return local_client.getValue(key=signature, check_alt=True)
+
         output_paths = dict()
 
         runtime_info_signature = self.runtimeInfoSignature()
         assert runtime_info_signature
-        output_paths['--runtime-info--'] = local_client.getValue(key=runtime_info_signature, check_alt=True)
+        output_paths['--runtime-info--'] = get_value(runtime_info_signature)
         if not output_paths['--runtime-info--']:
             return None
 
@@ -558,7 +640,7 @@ class MountainJob():
 
         console_out_signature = self.consoleOutSignature()
         assert console_out_signature
-        output_paths['--console-out--'] = local_client.getValue(key=console_out_signature, check_alt=True)
+        output_paths['--console-out--'] = get_value(console_out_signature)
         if not output_paths['--console-out--']:
             return None
 
@@ -566,7 +648,7 @@ class MountainJob():
             for output_name in self._job_object['outputs'].keys():
                 signature0 = self.outputSignature(output_name)
                 assert signature0
-                output_path = local_client.getValue(key=signature0, check_alt=True)
+                output_path = get_value(signature0)
                 if not output_path:
                     return None
                 output_paths[output_name] = output_path
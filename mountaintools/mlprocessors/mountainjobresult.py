@@ -14,10 +14,17 @@ class MountainJobResult():
         self.runtime_info: Optional[dict] = None
         self.outputs: Optional[dict] = None
         self._job_queue: Optional[JobQueue] = job_queue
+        self._queue_job_id: Optional[int] = None  # set by JobQueue.queueJob()
         self._status: str = 'pending'  # pending, running, finished -- note: finished includes error
         if result_object is not None:
             self.fromObject(result_object)
 
+    def __getstate__(self) -> dict:
+        # the job queue (with its lock) stays in this process
+        state = dict(self.__dict__)
+        state['_job_queue'] = None
+        return state
+
     def status(self) -> str:
         return self._status
 
@@ -38,7 +45,7 @@ class MountainJobResult():
             if (timeout >= 0) and (elapsed > timeout):
                 return False
             if self._status != 'finished':
-                time.sleep(0.2)
+                self._job_queue._wait_for_event(timeout=timeout - elapsed if timeout >= 0 else None)
         return True
 
     def getObject(self) -> dict:
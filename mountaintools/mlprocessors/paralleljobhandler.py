@@ -1,29 +1,87 @@
+import os
+import sys
+import time
+import subprocess
+import atexit
+import importlib
+import traceback
 import multiprocessing
+import multiprocessing.connection
 from multiprocessing.connection import Connection
-import time
-import signal
-import mlprocessors as mlpr
-from .jobhandler import JobHandler
+from mountainclient import client as mt
+from .jobhandler import JobHandler, _job_finished
 from .mountainjobresult import MountainJobResult
-from typing import List
+from typing import List, Optional
 from .mountainjob import MountainJob
+from .computeresources import jobResources
+
+# The jobs are run by a pool of long-lived worker processes, which are started
+# when needed and kept until the handler is halted. Each worker imports the
+# preload modules once. A job is sent to an idle worker as its job object
+# (together with the module and name of the processor class, so that the
+# worker can run it directly), and the worker sends the result object back
+# over the same pipe as soon as the job is done.
+#
+# Since a worker may have been forked long before it runs a job, the state of
+# the controller that a job depends on (the environment variables, the working
+# directory, sys.path and the configuration of the mountain client) is sent
+# with each job and applied by the worker before running it. A processor class
+# that the workers cannot look up by its module and name (one defined in
+# __main__, as in a script or a notebook, where it may also have been redefined
+# since the workers were forked) is not looked up: its job is run by a worker
+# that is forked for that job alone, and so inherits the class as it is now.
+#
+# A job occupies one worker and the cores, memory and gpus of its compute
+# requirements (see computeresources.py, where the memory is learned from
+# earlier runs of the processor). The pending jobs are packed into what is not
+# used by the running jobs, largest first (first-fit decreasing). A job that
+# has been pending for longer than _MAX_PENDING_SEC is not passed over any
+# more: no other job is started until it fits. A job that requires more than
+# the capacity of the handler is run when nothing else is running. The gpus
+# assigned to a job are passed to it in CUDA_VISIBLE_DEVICES (when the ids of
+# the gpus of the node are not known, the environment is left unchanged).
+
+_DEFAULT_PRELOAD_MODULES = ['mountaintools', 'spikeforest']
+_MAX_PENDING_SEC = 60
 
 
 class ParallelJobHandler(JobHandler):
-    def __init__(self, num_workers: int):
+    def __init__(self, num_workers: int, *, num_cores: Optional[float]=None, memory_gb: Optional[float]=None, gpu_ids: Optional[List[str]]=None,
+                 learn_memory: bool=True, preload_modules: Optional[List[str]]=None):
+        """Constructor for the parallel job handler
+
+        Parameters
+        ----------
+        num_workers : int
+            The maximum number of jobs to run at the same time (the number of worker processes)
+        num_cores : Optional[float], optional
+            The number of cpu cores available to the jobs, by default num_workers
+        memory_gb : Optional[float], optional
+            The memory (GB) available to the jobs, by default the physical memory of the node (or unlimited if unknown)
+        gpu_ids : Optional[List[str]], optional
+            The gpus available to the jobs, by default those in CUDA_VISIBLE_DEVICES, or those listed by nvidia-smi (or none)
+        learn_memory : bool, optional
+            Whether to use the peak memory of earlier runs of the processors for jobs that do not declare their memory, by default True
+        preload_modules : Optional[List[str]], optional
+            Modules to import in each worker process when it starts, by default mountaintools and spikeforest (if available)
+        """
         super().__init__()
         self._num_workers = num_workers
-        self._processes: List[dict] = []
+        self._num_cores = num_cores if num_cores is not None else num_workers
+        self._memory_gb = memory_gb if memory_gb is not None else _physical_memory_gb()
+        self._gpu_ids = gpu_ids if gpu_ids is not None else _available_gpu_ids()
+        self._learn_memory = learn_memory
+        self._preload_modules = preload_modules if preload_modules is not None else _DEFAULT_PRELOAD_MODULES
+        self._pending_jobs: List[dict] = []  # job, resources, time_queued
+        self._workers: List[dict] = []
         self._halted = False
+        self._registered_atexit = False
 
     def executeJob(self, job: MountainJob) -> MountainJobResult:
-        pipe_to_parent, pipe_to_child = multiprocessing.Pipe()
-        process = multiprocessing.Process(target=_run_job, args=(pipe_to_parent, job))
-        self._processes.append(dict(
+        self._pending_jobs.append(dict(
             job=job,
-            process=process,
-            pipe_to_child=pipe_to_child,
-            pjh_status='pending'
+            resources=jobResources(job.getObject(copy=False), use_learned_memory=self._learn_memory),
+            time_queued=time.time()
         ))
         return job.result
 
@@ -31,52 +89,253 @@ class ParallelJobHandler(JobHandler):
         if self._halted:
             return
 
-        for p in self._processes:
-            if p['pjh_status'] == 'running':
-                if p['pipe_to_child'].poll():
-                    result_obj = p['pipe_to_child'].recv()
-                    p['pipe_to_child'].send('okay!')
-                    p['job'].result.fromObject(result_obj)
-                    p['job'].result._status = 'finished'
-                    p['pjh_status'] = 'finished'
-        
-        num_running = 0
-        for p in self._processes:
-            if p['pjh_status'] == 'running':
-                num_running = num_running + 1
-
-        for p in self._processes:
-            if p['pjh_status'] == 'pending':
-                if num_running < self._num_workers:
-                    p['pjh_status'] = 'running'
-                    p['process'].start()
-                    num_running = num_running + 1
-    
+        for w in self._workers:
+            if (w['job'] is not None) and w['conn'].poll():
+                self._receive_result(w)
+        self._workers = [w for w in self._workers if w['process'] is not None]
+
+        if not self._pending_jobs:
+            return
+        timer = time.time()
+        overdue = [p for p in self._pending_jobs if timer - p['time_queued'] > _MAX_PENDING_SEC]
+        others = [p for p in self._pending_jobs if timer - p['time_queued'] <= _MAX_PENDING_SEC]
+        others.sort(key=lambda p: (p['resources']['num_gpus'], p['resources']['memory_gb'], p['resources']['num_cores']), reverse=True)
+        started = []
+        for p in overdue + others:
+            busy_workers = [w for w in self._workers if w['job'] is not None]
+            if len(busy_workers) >= self._num_workers:
+                break
+            if self._fits(p['resources'], busy_workers):
+                self._start_job(p)
+                started.append(p)
+            elif timer - p['time_queued'] > _MAX_PENDING_SEC:
+                # keep the resources for this job as they are freed
+                break
+        started_ids = set([id(p) for p in started])
+        self._pending_jobs = [p for p in self._pending_jobs if id(p) not in started_ids]
+
+    def waitForEvent(self, timeout: Optional[float]) -> None:
+        # wake up as soon as one of the running jobs sends its result
+        conns = [w['conn'] for w in self._workers if w['job'] is not None]
+        if conns:
+            multiprocessing.connection.wait(conns, timeout)
+        else:
+            super().waitForEvent(timeout)
+
     def isFinished(self) -> bool:
         if self._halted:
             return True
-        for p in self._processes:
-            if p['pjh_status'] != 'finished':
+        if self._pending_jobs:
+            return False
+        for w in self._workers:
+            if w['job'] is not None:
                 return False
         return True
 
     def halt(self) -> None:
-        for p in self._processes:
-            if p['pjh_status'] == 'running':
-                # TODO: i don't think this will actually terminate the child processes
-                p['process'].terminate()
         self._halted = True
+        self._stop_workers()
 
     def cleanup(self) -> None:
-        pass
+        self._stop_workers()
+
+    def _fits(self, resources: dict, busy_workers: List[dict]) -> bool:
+        if not busy_workers:
+            # always run a job when nothing else is running, even if it needs more than we have
+            return True
+        if sum([w['resources']['num_cores'] for w in busy_workers]) + resources['num_cores'] > self._num_cores:
+            return False
+        if (self._memory_gb is not None) and (sum([w['resources']['memory_gb'] for w in busy_workers]) + resources['memory_gb'] > self._memory_gb):
+            return False
+        if sum([len(w['gpu_ids']) for w in busy_workers]) + resources['num_gpus'] > len(self._gpu_ids):
+            return False
+        return True
+
+    def _start_job(self, p: dict) -> None:
+        job = p['job']
+        processor = job._processor
+        if (processor is not None) and (not _can_find_processor(processor)):
+            w = self._start_worker(processor=processor)
+        else:
+            idle_workers = [w for w in self._workers if (w['job'] is None) and (w['processor'] is None)]
+            if idle_workers:
+                w = idle_workers[0]
+            else:
+                w = self._start_worker()
+        gpu_ids_in_use = [id for w0 in self._workers if w0['job'] is not None for id in w0['gpu_ids']]
+        w['job'] = job
+        w['resources'] = p['resources']
+        w['gpu_ids'] = [id for id in self._gpu_ids if id not in gpu_ids_in_use][:p['resources']['num_gpus']]
+        job.result._status = 'running'
+        w['conn'].send(dict(
+            job_object=job.getObject(copy=False),
+            processor_module=processor.__module__ if processor is not None else None,
+            processor_class_name=processor.__name__ if processor is not None else None,
+            context=_job_context(),
+            # if no gpus could be assigned, the environment is left unchanged
+            gpu_ids=w['gpu_ids'] if (p['resources']['num_gpus'] > 0) and w['gpu_ids'] else None
+        ))
+
+    def _start_worker(self, processor=None) -> dict:
+        # if processor is given, the worker runs a single job of that processor and exits
+        if not self._registered_atexit:
+            # the worker processes are not daemonic (so that jobs may start processes of their own)
+            atexit.register(self._stop_workers)
+            self._registered_atexit = True
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_worker_main,
+            args=(child_conn, self._preload_modules, [conn] + [w['conn'] for w in self._workers], processor)
+        )
+        process.start()
+        child_conn.close()
+        w = dict(process=process, conn=conn, job=None, resources=None, gpu_ids=[], processor=processor)
+        self._workers.append(w)
+        return w
+
+    def _receive_result(self, w: dict) -> None:
+        job = w['job']
+        w['job'] = None
+        w['gpu_ids'] = []
+        try:
+            result_obj = w['conn'].recv()
+        except (EOFError, OSError):
+            # the worker died (e.g., it was killed for using too much memory)
+            exitcode = w['process'].exitcode if w['process'] is not None else None
+            result_obj = dict(
+                retcode=-1,
+                timed_out=False,
+                console_out='Worker process of parallel job handler exited unexpectedly (exit code: {}).'.format(exitcode),
+                runtime_info=None,
+                outputs=None
+            )
+            w['process'].join(timeout=1)
+            w['conn'].close()
+            w['process'] = None
+        if (w['processor'] is not None) and (w['process'] is not None):
+            # the worker of a single job exits after sending the result
+            w['process'].join()
+            w['conn'].close()
+            w['process'] = None
+        job.result.fromObject(result_obj)
+        job.result._status = 'finished'
+        _job_finished(job)
 
+    def _stop_workers(self) -> None:
+        for w in self._workers:
+            if w['process'] is None:
+                continue
+            if w['job'] is not None:
+                w['process'].terminate()
+            else:
+                try:
+                    w['conn'].send(None)
+                except (OSError, BrokenPipeError):
+                    pass
+        for w in self._workers:
+            if w['process'] is None:
+                continue
+            w['process'].join(timeout=5)
+            if w['process'].is_alive():
+                w['process'].terminate()
+                w['process'].join()
+            w['conn'].close()
+        self._workers = []
+        self._pending_jobs = []
 
-def _run_job(pipe_to_parent: Connection, job: MountainJob) -> None:
-    result0 = job._execute(print_console_out=False)
-    pipe_to_parent.send(result0.getObject())
-    # wait for message to return
+
+def _worker_main(conn: Connection, preload_modules: List[str], parent_conns: List[Connection], processor=None) -> None:
+    # Close the parent ends of the pipes (ours and those of the other workers)
+    # that were inherited when forking, so that we get EOF on conn when the
+    # parent goes away
+    for c in parent_conns:
+        c.close()
+    single_job = (processor is not None)
+    for module_name in preload_modules:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            pass
     while True:
-        if pipe_to_parent.poll():
-            pipe_to_parent.recv()
+        try:
+            msg = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if msg is None:
             return
-        time.sleep(0.1)
+        try:
+            _apply_job_context(msg['context'])
+            if msg['gpu_ids'] is not None:
+                os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(msg['gpu_ids'])
+            if single_job:
+                job_processor = processor
+            else:
+                job_processor = _find_processor(msg['processor_module'], msg['processor_class_name'])
+            job = MountainJob(processor=job_processor, job_object=msg['job_object'])
+            result_obj = job._execute(print_console_out=False).getObject()
+        except:
+            result_obj = dict(
+                retcode=-1,
+                timed_out=False,
+                console_out=traceback.format_exc(),
+                runtime_info=None,
+                outputs=None
+            )
+        conn.send(result_obj)
+        if single_job:
+            return
+
+
+def _physical_memory_gb() -> Optional[float]:
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _available_gpu_ids() -> List[str]:
+    if 'CUDA_VISIBLE_DEVICES' in os.environ:
+        return [x for x in os.environ['CUDA_VISIBLE_DEVICES'].split(',') if x.strip()]
+    try:
+        output = subprocess.check_output(['nvidia-smi', '--query-gpu=index', '--format=csv,noheader'], stderr=subprocess.DEVNULL, timeout=10)
+    except:
+        # no nvidia driver
+        return []
+    return [x.strip() for x in output.decode('utf-8').splitlines() if x.strip()]
+
+
+def _job_context() -> dict:
+    # the state of the controller that the jobs depend on (see above)
+    return dict(
+        environ=dict(os.environ),
+        cwd=os.getcwd(),
+        sys_path=list(sys.path),
+        client_config=mt.getConfig()
+    )
+
+
+def _apply_job_context(context: dict) -> None:
+    os.environ.clear()
+    os.environ.update(context['environ'])
+    os.chdir(context['cwd'])
+    sys.path[:] = context['sys_path']
+    mt.setConfig(context['client_config'])
+
+
+def _can_find_processor(processor) -> bool:
+    # whether a worker can look up the processor class by its module and name
+    if processor.__module__ == '__main__':
+        return False
+    module = sys.modules.get(processor.__module__, None)
+    return (module is not None) and (getattr(module, processor.__name__, None) is processor)
+
+
+def _find_processor(module_name: Optional[str], class_name: Optional[str]):
+    # if the processor class cannot be imported, the job is run from the processor code in the job object
+    if (module_name is None) or (class_name is None):
+        return None
+    try:
+        module = sys.modules.get(module_name, None) or importlib.import_module(module_name)
+        return getattr(module, class_name, None)
+    except:
+        return None
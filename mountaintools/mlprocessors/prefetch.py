@@ -0,0 +1,22 @@
+from .mountainjob import MountainJob
+from mountainclient import client as mt
+from typing import List, Optional, Union
+
+
+def prefetchJobInputs(jobs: List[MountainJob], *,
+                      num_workers: int=4,
+                      max_bytes: Optional[int]=None,
+                      max_bytes_per_sec: Optional[float]=None,
+                      download_from: Optional[Union[str, List[str]]]=None,
+                      verbose: bool=False
+                      ) -> dict:
+    """Download the files needed by a batch of jobs (containers, inputs and
+    processor code; see MountainJob.getFilesToRealize()) into the local SHA-1
+    cache before the jobs are run, so that the jobs do not block on downloads.
+    The files are deduplicated across jobs and downloaded concurrently. See
+    MountainClient.prefetchFiles() for the parameters and the returned
+    statistics."""
+    paths: List[str] = []
+    for job in jobs:
+        paths.extend(job.getFilesToRealize())
+    return mt.prefetchFiles(paths, num_workers=num_workers, max_bytes=max_bytes, max_bytes_per_sec=max_bytes_per_sec, download_from=download_from, verbose=verbose)
@@ -2,13 +2,16 @@ import multiprocessing
 import os
 import time
 import random
+import select
 import signal
+import socket
 import shutil
 import traceback
 import mlprocessors as mlpr
-from .jobhandler import JobHandler
+from .jobhandler import JobHandler, _job_finished
 from .mountainjobresult import MountainJobResult
 from .shellscript import ShellScript
+from .workerprotocol import MessageConnection, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, MAX_HELLO_SIZE, MAX_MESSAGE_SIZE
 from mountainclient import FileLock
 from mountainclient import client as mt
 from typing import Optional, List
@@ -16,6 +19,12 @@ import json
 
 DEFAULT_JOB_TIMEOUT = 1200
 
+# The workers of a batch get their jobs from the controller (this process)
+# over TCP by default (see workerprotocol.py). With transport='files' they
+# instead poll json files in the working directory on the shared file system,
+# which is slower but works where the compute nodes cannot connect back to
+# the controller.
+
 
 class SlurmJobHandler(JobHandler):
     def __init__(self, working_dir: str):
@@ -44,7 +53,9 @@ class SlurmJobHandler(JobHandler):
                      use_slurm: bool,
                      time_limit_per_batch: Optional[float]=None,  # number of seconds or None
                      max_simultaneous_batches: Optional[int]=None,
-                     additional_srun_opts: List[str]=[]
+                     additional_srun_opts: List[str]=[],
+                     transport: str='socket',
+                     controller_host: Optional[str]=None
                      ) -> None:
         """Add a batch type to the slurm job handler.
 
@@ -62,6 +73,10 @@ class SlurmJobHandler(JobHandler):
             If a number, the maximum duration of a batch in seconds, by default None
         additional_srun_opts : List[str], optional
             A list of additional string options to send to srun (only applies of use_slurm is True), by default []
+        transport : str, optional
+            How the workers get their jobs: 'socket' (connect to this process over TCP) or 'files' (poll files in the working directory), by default 'socket'
+        controller_host : Optional[str], optional
+            The host name or address of this computer for the workers to connect to, by default the host name (or 127.0.0.1 if use_slurm is False)
 
         Returns
         -------
@@ -69,13 +84,17 @@ class SlurmJobHandler(JobHandler):
         """
         if name in self._batch_types:
             raise Exception('Batch type already exists: {}'.format(name))
+        if transport not in ['socket', 'files']:
+            raise Exception('Invalid transport for batch type: {}'.format(transport))
         self._batch_types[name] = dict(
             num_workers_per_batch=num_workers_per_batch,
             num_cores_per_job=num_cores_per_job,
             use_slurm=use_slurm,
             time_limit_per_batch=time_limit_per_batch,
             max_simultaneous_batches=max_simultaneous_batches,
-            additional_srun_opts=additional_srun_opts
+            additional_srun_opts=additional_srun_opts,
+            transport=transport,
+            controller_host=controller_host
         )
 
     def executeJob(self, job: mlpr.MountainJob) -> MountainJobResult:
@@ -103,6 +122,9 @@ class SlurmJobHandler(JobHandler):
         if batch_type['time_limit_per_batch'] is not None:
             if job_timeout > batch_type['time_limit_per_batch']:
                 raise Exception('Cannot execute job. Job timeout exceeds time limit: {} > {}'.format(job_timeout, batch_type['time_limit_per_batch']))
+        num_cores = compute_requirements.get('num_cores', 1)
+        if num_cores > batch_type['num_cores_per_job']:
+            raise Exception('Cannot execute job. Job requires more cores than batch type {} provides: {} > {}'.format(batch_type_name, num_cores, batch_type['num_cores_per_job']))
         self._unassigned_jobs.append(job)
         return job.result
 
@@ -130,6 +152,17 @@ class SlurmJobHandler(JobHandler):
                 unassigned_jobs_after.append(job)
         self._unassigned_jobs = unassigned_jobs_after
 
+    def waitForEvent(self, timeout: Optional[float]) -> None:
+        # wake up as soon as a worker connects or sends a message
+        fileobjs = []
+        for b in self._batches.values():
+            if not b.isFinished():
+                fileobjs.extend(b.socketsToWatch())
+        if fileobjs:
+            select.select(fileobjs, [], [], timeout)
+        else:
+            super().waitForEvent(timeout)
+
     def isFinished(self) -> bool:
         """Whether all queued jobs have finished
 
@@ -247,12 +280,20 @@ class _Batch():
         self._use_slurm = batch_type['use_slurm']
         self._time_limit = batch_type['time_limit_per_batch']
         self._additional_srun_opts = batch_type['additional_srun_opts']
+        self._transport = batch_type.get('transport', 'socket')
         self._workers: List[_Worker] = []
         self._had_a_job = False
+        self._server_socket: Optional[socket.socket] = None
+        self._token = _random_string(32)  # so that only our workers can connect
+        self._unidentified_connections: List[MessageConnection] = []
+        controller_host = batch_type.get('controller_host', None)
+        if controller_host is None:
+            controller_host = socket.gethostname() if self._use_slurm else '127.0.0.1'
+        self._controller_host: str = controller_host
 
         # Create the workers
         for i in range(self._num_workers):
-            self._workers.append(_Worker(base_path=self._working_dir + '/worker_{}'.format(i)))
+            self._workers.append(_Worker(base_path=self._working_dir + '/worker_{}'.format(i), use_socket=(self._transport == 'socket')))
 
         self._slurm_process = _SlurmProcess(
             working_dir=self._working_dir,
@@ -263,6 +304,18 @@ class _Batch():
             time_limit=self._time_limit
         )
 
+    def socketsToWatch(self) -> list:
+        """The sockets on which something may arrive that calls for iterate()"""
+        ret: list = []
+        if self._server_socket is not None:
+            ret.append(self._server_socket)
+        ret.extend([c for c in self._unidentified_connections if not c.isClosed()])
+        for w in self._workers:
+            c = w.connection()
+            if (c is not None) and (not c.isClosed()):
+                ret.append(c)
+        return ret
+
     def batchTypeName(self) -> str:
         return self._batch_type_name
 
@@ -300,6 +353,7 @@ class _Batch():
         if self.isPending():
             pass
         elif self.isWaitingToStart():
+            self._accept_connections()
             # first iterate all the workers so they can do what they need to do
             for w in self._workers:
                 w.iterate()
@@ -321,10 +375,16 @@ class _Batch():
                 if len(x) == 0:
                     assert('Unexpected problem. We should at least have a running.txt and a *.py file here.')
         elif self.isRunning():
+            self._accept_connections()
             # first iterate all the workers so they can do what they need to do
             for w in self._workers:
                 w.iterate()
 
+            if all([w.isLost() for w in self._workers]):
+                print('All workers of {} are gone. Ending batch.'.format(self._batch_label))
+                self.halt()
+                return
+
             # If we had a job in the past and we
             # haven't had anything to do for last 30 seconds, then
             # let's just end.
@@ -373,7 +433,7 @@ class _Batch():
                 return False
         # If some worker has a vacancy then we can add the job
         for w in self._workers:
-            if not w.hasJob():
+            if (not w.hasJob()) and (not w.isLost()):
                 return True
         # Otherwise, we have no vacancy for a new job
         return False
@@ -416,7 +476,7 @@ class _Batch():
 
         # Add the job to a vacant worker
         for w in self._workers:
-            if not w.hasJob():
+            if (not w.hasJob()) and (not w.isLost()):
                 w.setJob(job)
                 return
 
@@ -432,14 +492,29 @@ class _Batch():
         """
         assert self._status == 'pending', "Unexpected... cannot start a batch that is not pending."
 
-        # Write the running.txt file
-        running_fname = self._working_dir + '/running.txt'
-        with FileLock(running_fname + '.lock', exclusive=True):
-            with open(running_fname, 'w') as f:
-                f.write('batch.')
+        socket_info = None
+        if self._transport == 'socket':
+            try:
+                self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self._server_socket.bind(('127.0.0.1' if self._controller_host == '127.0.0.1' else '', 0))
+                self._server_socket.listen(self._num_workers)
+                self._server_socket.setblocking(False)
+                socket_info = dict(host=self._controller_host, port=self._server_socket.getsockname()[1], token=self._token)
+            except OSError:
+                traceback.print_exc()
+                print('WARNING: Unable to listen for workers of {}. Using files instead.'.format(self._batch_label))
+                self._server_socket = None
+                for w in self._workers:
+                    w.useFiles()
+        if socket_info is None:
+            # Write the running.txt file
+            running_fname = self._working_dir + '/running.txt'
+            with FileLock(running_fname + '.lock', exclusive=True):
+                with open(running_fname, 'w') as f:
+                    f.write('batch.')
 
         # Start the slurm process
-        self._slurm_process.start()
+        self._slurm_process.start(socket_info=socket_info)
 
         self._status = 'waiting'
         # self._time_started = time.time()  # instead of doing it here, let's wait until a worker has actually started.
@@ -452,6 +527,15 @@ class _Batch():
         if os.path.exists(running_fname):
             with FileLock(running_fname + '.lock', exclusive=True):
                 os.remove(self._working_dir + '/running.txt')
+        # Tell the connected workers to end
+        for w in self._workers:
+            w.stop()
+        for c in self._unidentified_connections:
+            c.close()
+        self._unidentified_connections = []
+        if self._server_socket is not None:
+            self._server_socket.close()
+            self._server_socket = None
         self._status = 'finished'
         # wait a bit for it to resolve on its own (because we removed the running.txt)
         if not self._slurm_process.wait(5):
@@ -461,8 +545,46 @@ class _Batch():
         self._slurm_process.halt()
 
 
+    def _accept_connections(self) -> None:
+        if self._server_socket is None:
+            return
+        while True:
+            try:
+                sock, _ = self._server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            self._unidentified_connections.append(MessageConnection(sock, max_message_size=MAX_HELLO_SIZE))
+        still_unidentified = []
+        for c in self._unidentified_connections:
+            try:
+                msg = c.receive()
+            except:
+                # not one of our workers
+                print('WARNING: Unexpected data on connection to {}. Closing it.'.format(self._batch_label))
+                c.close()
+                continue
+            if msg is None:
+                if (not c.isClosed()) and (c.elapsedSinceLastReceived() <= HEARTBEAT_TIMEOUT):
+                    still_unidentified.append(c)
+                else:
+                    c.close()
+                continue
+            if (msg.get('type', None) != 'hello') or (msg.get('token', None) != self._token):
+                print('WARNING: Unexpected connection to {}. Closing it.'.format(self._batch_label))
+                c.close()
+                continue
+            vacant_workers = [w for w in self._workers if w.connection() is None and not w.isLost()]
+            if not vacant_workers:
+                c.send(dict(type='stop'))
+                c.close()
+                continue
+            c.setMaxMessageSize(MAX_MESSAGE_SIZE)
+            vacant_workers[0].setConnection(c)
+        self._unidentified_connections = still_unidentified
+
+
 class _Worker():
-    def __init__(self, base_path: str):
+    def __init__(self, base_path: str, use_socket: bool):
         """Constructor for _Worker of _Batch of SlurmJobHandler
 
         Parameters
@@ -473,10 +595,17 @@ class _Worker():
             [base_path]_job.json
             [base_path]_result.json
             and corresponding lock files
+        use_socket : bool
+            Whether the worker process connects to the controller (socket
+            transport) rather than polling the files above
         """
         self._job: Optional[mlpr.MountainJob] = None
         self._job_finish_timestamp: Optional[float] = None
         self._base_path: str = base_path
+        self._connection: Optional[MessageConnection] = None  # when the worker connected over TCP
+        self._job_sent = False
+        self._lost = False
+        self._use_socket = use_socket
 
     def hasJob(self) -> bool:
         """Whether this worker has a job
@@ -504,8 +633,30 @@ class _Worker():
             return elapsed
         return None
 
+    def connection(self) -> Optional[MessageConnection]:
+        return self._connection
+
+    def setConnection(self, connection: MessageConnection) -> None:
+        """Attach the connection of the worker process (socket transport)"""
+        self._connection = connection
+        self._send_job_if_needed()
+
+    def useFiles(self) -> None:
+        """Use the file transport (the batch is not listening for connections)"""
+        self._use_socket = False
+
+    def isLost(self) -> bool:
+        """Whether the worker process disconnected or stopped sending heartbeats"""
+        return self._lost
+
+    def stop(self) -> None:
+        """Tell the worker process to end (socket transport)"""
+        if self._connection is not None:
+            self._connection.send(dict(type='stop'))
+            self._connection.close()
+
     def setJob(self, job: mlpr.MountainJob) -> None:
-        """Set the job for this worker. Essentially writes the job object to a file which is picked up by the running worker process.
+        """Set the job for this worker. With the socket transport the job is sent to the worker process once it has connected, and otherwise the job object is written to a file which is picked up by the running worker process.
 
         Parameters
         ----------
@@ -517,6 +668,11 @@ class _Worker():
         None
         """
         self._job = job
+        self._job_sent = False
+        if self._use_socket:
+            # sent now or in setConnection()
+            self._send_job_if_needed()
+            return
         job_object = self._job.getObject()
         job_fname = self._base_path + '_job.json'
         num_tries = 3
@@ -537,11 +693,17 @@ class _Worker():
     def hasStarted(self) -> bool:
         """Returns whether the worker (not the job) has started
         """
+        if self._use_socket:
+            return self._connection is not None
         return os.path.exists(self._base_path + '_claimed.txt')
 
     def iterate(self) -> None:
         """Take care of business of the worker
         """
+        if self._use_socket:
+            if self._connection is not None:
+                self._iterate_connection()
+            return
         if not self._job:
             # If we don't have a job, then we don't need to take care of any business.
             return
@@ -580,11 +742,55 @@ class _Worker():
             # Here's the result that we read above
             self._job.result.fromObject(result_obj)
             self._job.result._status = 'finished'
+            _job_finished(self._job)
             # We no longer have a job, and we should set the finished timestamp
             self._job = None
             self._job_finish_timestamp = time.time()
 
 
+    def _send_job_if_needed(self) -> None:
+        if (self._connection is None) or (self._job is None) or self._job_sent:
+            return
+        self._connection.send(dict(type='job', job_object=self._job.getObject(copy=False)))
+        self._job_sent = True
+
+    def _iterate_connection(self) -> None:
+        assert self._connection is not None
+        while True:
+            msg = self._connection.receive()
+            if msg is None:
+                break
+            if msg['type'] == 'result':
+                if self._job is not None:
+                    self._job.result.fromObject(msg['result'])
+                    self._job.result._status = 'finished'
+                    _job_finished(self._job)
+                    self._job = None
+                    self._job_finish_timestamp = time.time()
+            elif msg['type'] == 'error':
+                # This is not a job error, this is a mountaintools error (see the file protocol)
+                print(msg['error'])
+                raise Exception('Unexpected error processing job in batch.')
+        if self._connection.elapsedSinceLastSent() >= HEARTBEAT_INTERVAL:
+            self._connection.send(dict(type='heartbeat'))
+        if self._connection.isClosed() or (self._connection.elapsedSinceLastReceived() > HEARTBEAT_TIMEOUT):
+            print('Lost connection to worker: {}'.format(self._base_path))
+            self._connection.close()
+            self._lost = True
+            if self._job is not None:
+                self._job.result.fromObject(dict(
+                    retcode=-1,
+                    timed_out=False,
+                    console_out=mt.saveText(text='Lost connection to slurm batch worker while running job.', basename='console_out.txt'),
+                    runtime_info=None,
+                    outputs=None
+                ))
+                self._job.result._status = 'finished'
+                _job_finished(self._job)
+                self._job = None
+                self._job_finish_timestamp = time.time()
+
+
 class _SlurmProcess():
     def __init__(self, working_dir: str, num_workers: int, additional_srun_opts: List[str], use_slurm: bool, time_limit: Optional[float], num_cores_per_job: int):
         """Constructor for a slurm process (corresponding to a batch)
@@ -613,19 +819,48 @@ class _SlurmProcess():
             self._num_cores_per_job = 1
         self._time_limit = time_limit
 
-    def start(self) -> None:
+    def start(self, socket_info: Optional[dict]=None) -> None:
         """Start the slurm process
+
+        Parameters
+        ----------
+        socket_info : Optional[dict], optional
+            The host, port and token for the workers to connect to (socket transport), by default None (file transport)
         """
 
+        if socket_info is not None:
+            # This script is run by each worker (slurm task) in the batch
+            srun_py_script = ShellScript("""
+                #!/usr/bin/env python
+
+                import sys
+                # use the same mountaintools as the controller, even if it is not installed
+                sys.path.insert(0, '{package_path}')
+
+                from mlprocessors.workerprotocol import runSocketWorker
+
+                runSocketWorker(host='{host}', port={port}, token='{token}')
+            """, script_path=os.path.join(self._working_dir, 'execute_batch_srun.py'))
+            srun_py_script.substitute('{host}', socket_info['host'])
+            srun_py_script.substitute('{port}', socket_info['port'])
+            srun_py_script.substitute('{token}', socket_info['token'])
+            srun_py_script.substitute('{package_path}', _package_path())
+            srun_py_script.write()
+            self._start_srun(srun_py_script)
+            return
+
         # This script is run by each worker (slurm task) in the batch
         srun_py_script = ShellScript("""
                 #!/usr/bin/env python
 
                 import os
+                import sys
                 import time
                 import json
                 import random
                 import traceback
+                # use the same mountaintools as the controller, even if it is not installed
+                sys.path.insert(0, '{package_path}')
                 from mountainclient import FileLock
                 import mlprocessors as mlpr
 
@@ -705,8 +940,11 @@ class _SlurmProcess():
         srun_py_script.substitute('{working_dir}', self._working_dir)
         srun_py_script.substitute('{num_workers}', self._num_workers)
         srun_py_script.substitute('{running_fname}', self._working_dir + '/running.txt')
+        srun_py_script.substitute('{package_path}', _package_path())
         srun_py_script.write()
+        self._start_srun(srun_py_script)
 
+    def _start_srun(self, srun_py_script: ShellScript) -> None:
         srun_opts = []
         srun_opts.extend(self._additional_srun_opts)
         srun_opts.append('-n {}'.format(self._num_workers))
@@ -803,6 +1041,11 @@ class _SlurmProcess():
                     print('Warning: unable to stop slurm script.')
 
 
+def _package_path() -> str:
+    # the directory that contains mlprocessors and mountainclient
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
 def _rmdir_with_retries(dirname, num_retries, delay_between_tries=1):
     for retry_num in range(1, num_retries + 1):
         if not os.path.exists(dirname):
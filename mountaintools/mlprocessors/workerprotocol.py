@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import select
+import socket
+import struct
+import threading
+import traceback
+import collections
+from typing import Optional, Deque
+
+# The workers of a slurm batch (see slurmjobhandler.py) connect back to the
+# controller over TCP, instead of polling json files on the shared file
+# system. Each message is a json object preceded by its length in bytes (4
+# bytes, big endian).
+#
+#   worker -> controller: hello (with the token of the batch), result, error
+#                         (an exception in the worker, not in the job), heartbeat
+#   controller -> worker: job, heartbeat, stop
+#
+# The workers send heartbeats from a separate thread (also while running a
+# job), and the controller considers a worker gone after HEARTBEAT_TIMEOUT
+# seconds without a message. A worker stops when told to or when the
+# connection is closed (e.g., the controller exited).
+#
+# Anything may connect to the port of the controller, so until a connection
+# has sent a valid hello its messages are limited to MAX_HELLO_SIZE bytes, and
+# a connection that does not follow the protocol is closed.
+
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 60
+MAX_HELLO_SIZE = 1 << 12
+MAX_MESSAGE_SIZE = 1 << 30
+_RECV_SIZE = 1 << 16
+
+
+class MessageConnection():
+    def __init__(self, sock: socket.socket, *, max_message_size: int=MAX_MESSAGE_SIZE):
+        """A connection that sends and receives length-prefixed json messages
+
+        Parameters
+        ----------
+        sock : socket.socket
+            A connected socket
+        max_message_size : int, optional
+            The largest message to accept (in bytes), by default 1 GiB. A
+            larger or malformed message raises an exception in receive().
+        """
+        sock.settimeout(HEARTBEAT_TIMEOUT)  # for sending
+        if sock.family in [socket.AF_INET, socket.AF_INET6]:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._sock = sock
+        self._buffer = bytearray()
+        self._messages: Deque[dict] = collections.deque()
+        self._send_lock = threading.Lock()
+        self._closed = False
+        self._last_received = time.time()
+        self._last_sent = time.time()
+        self._max_message_size = max_message_size
+
+    def setMaxMessageSize(self, max_message_size: int) -> None:
+        self._max_message_size = max_message_size
+
+    def fileno(self) -> int:
+        return self._sock.fileno()
+
+    def isClosed(self) -> bool:
+        return self._closed
+
+    def elapsedSinceLastReceived(self) -> float:
+        return time.time() - self._last_received
+
+    def elapsedSinceLastSent(self) -> float:
+        return time.time() - self._last_sent
+
+    def send(self, msg: dict) -> bool:
+        """Send a message (may be called from any thread). Returns False if
+        the connection is closed."""
+        data = json.dumps(msg).encode('utf-8')
+        with self._send_lock:
+            if self._closed:
+                return False
+            try:
+                self._sock.sendall(struct.pack('>I', len(data)) + data)
+            except OSError:
+                self._closed = True
+                return False
+            self._last_sent = time.time()
+        return True
+
+    def receive(self, timeout: float=0) -> Optional[dict]:
+        """Return the next message, waiting up to timeout seconds for it.
+        Returns None if there is no message (see isClosed())."""
+        timer = time.time()
+        while not self._messages:
+            if self._closed:
+                return None
+            remaining = max(0, timeout - (time.time() - timer))
+            ready, _, _ = select.select([self._sock], [], [], remaining)
+            if not ready:
+                return None
+            self._read_available()
+        return self._messages.popleft()
+
+    def close(self) -> None:
+        with self._send_lock:
+            self._closed = True
+            self._sock.close()
+
+    def _read_available(self) -> None:
+        try:
+            data = self._sock.recv(_RECV_SIZE)
+        except OSError:
+            data = b''
+        if not data:
+            self._closed = True
+            return
+        self._last_received = time.time()
+        self._buffer.extend(data)
+        while len(self._buffer) >= 4:
+            size = struct.unpack('>I', self._buffer[:4])[0]
+            if size > self._max_message_size:
+                raise Exception('Unexpected size of message from worker connection: {}'.format(size))
+            if len(self._buffer) < 4 + size:
+                break
+            msg = json.loads(self._buffer[4:4 + size].decode('utf-8'))
+            if not isinstance(msg, dict):
+                raise Exception('Unexpected message from worker connection')
+            self._messages.append(msg)
+            del self._buffer[:4 + size]
+
+
+def runSocketWorker(*, host: str, port: int, token: str, connect_timeout: float=120) -> None:
+    """Run a batch worker that gets its jobs from the controller at host:port.
+    This is called by the script that is run for each slurm task."""
+    import mlprocessors as mlpr
+
+    conn = MessageConnection(_connect(host, port, connect_timeout))
+    conn.send(dict(type='hello', token=token, hostname=socket.gethostname(), pid=os.getpid()))
+
+    stop_heartbeats = threading.Event()
+
+    def send_heartbeats():
+        while not stop_heartbeats.wait(HEARTBEAT_INTERVAL):
+            if not conn.send(dict(type='heartbeat')):
+                return
+
+    heartbeat_thread = threading.Thread(target=send_heartbeats, daemon=True)
+    heartbeat_thread.start()
+    try:
+        while True:
+            msg = conn.receive(timeout=HEARTBEAT_INTERVAL)
+            if msg is None:
+                if conn.isClosed():
+                    print('Connection to controller closed. Stopping worker.')
+                    break
+                continue
+            if msg['type'] == 'job':
+                job = mlpr.MountainJob(job_object=msg['job_object'])
+                result = job._execute(print_console_out=False)
+                conn.send(dict(type='result', result=result.getObject()))
+            elif msg['type'] == 'stop':
+                print('Stopping worker.')
+                break
+    except:
+        # report the exception back to the controller
+        traceback.print_exc()
+        conn.send(dict(type='error', error=traceback.format_exc()))
+    finally:
+        stop_heartbeats.set()
+        conn.close()
+
+
+def _connect(host: str, port: int, timeout: float) -> socket.socket:
+    # the controller may not be reachable right away (e.g., on a busy node)
+    timer = time.time()
+    while True:
+        try:
+            return socket.create_connection((host, port), timeout=10)
+        except OSError:
+            if time.time() - timer > timeout:
+                raise
+            time.sleep(1)
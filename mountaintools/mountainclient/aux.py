@@ -25,6 +25,37 @@ def deprecated(reason: str) -> Callable:
     return decorator
 
 
+def parse_size(txt: str) -> int:
+    """Parse a size given as e.g. 50G, 500M, 10KB, or a number of bytes
+    (the units are powers of 1024)"""
+    units = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+    txt = txt.strip().upper()
+    if txt.endswith('B'):
+        txt = txt[:-1]
+    if txt and (txt[-1] in units):
+        return int(float(txt[:-1]) * units[txt[-1]])
+    return int(txt)
+
+
+def parse_duration(txt: str) -> float:
+    """Parse a duration given as e.g. 7d, 12h, 30m, or a number of seconds"""
+    units = dict(S=1, M=60, H=3600, D=24 * 3600)
+    txt = txt.strip().upper()
+    if txt and (txt[-1] in units):
+        return float(txt[:-1]) * units[txt[-1]]
+    return float(txt)
+
+
+def format_size(num: float) -> str:
+    """Format a number of bytes for display, e.g. 1.5 GiB"""
+    num = float(num)
+    for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti']:
+        if abs(num) < 1024.0:
+            return '%3.1f %sB' % (num, unit)
+        num /= 1024.0
+    return '%.1f PiB' % num
+
+
 def _db_load(path: str, *, count: int = 0):
     if count > 10:
         raise Exception('Unexpected problem loading database file: ' + path)
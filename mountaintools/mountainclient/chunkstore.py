@@ -0,0 +1,340 @@
+import io
+import os
+import json
+import bisect
+import random
+import hashlib
+from .sha1cacheindex import _walk_cache_subdirectories
+from typing import Optional, List, Dict, Iterator, Tuple, IO
+
+# Content-defined chunk store for the Sha1Cache (see Sha1Cache.chunking()).
+#
+# Files are split into variable-size chunks at positions determined by a gear
+# rolling hash of the preceding 32 bytes, so an insertion or deletion only
+# changes the chunks around it and near-duplicate files share most of their
+# chunks. Each chunk is stored once, addressed by its own sha1:
+#
+#   <cache>/chunks/<c[0]>/<c[1:3]>/<chunk_sha1>
+#
+# and each file is described by a manifest addressed by the sha1 of the whole
+# file (so sha1:// urls do not change):
+#
+#   <cache>/chunks/manifests/<s[0]>/<s[1:3]>/<sha1>.json
+#   {"sha1": ..., "size": ..., "chunks": [[chunk_sha1, chunk_size], ...]}
+#
+# Chunks and manifests are written to temporary files and renamed into place,
+# so no locking is needed.
+
+_MIN_CHUNK_SIZE = 256 * 1024
+_AVG_CHUNK_BITS = 20  # average chunk size of about 1 MiB above the minimum
+_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+_READ_BLOCK_SIZE = 8 * 1024 * 1024
+_HASH_BLOCK_SIZE = 256 * 1024
+_WINDOW_SIZE = 32
+
+
+class ChunkStore():
+    def __init__(self, directory: str):
+        """Content-defined chunk store
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the store (the chunks/ subdirectory of the cache)
+        """
+        self._directory = directory
+
+    def directory(self) -> str:
+        return self._directory
+
+    def hasFile(self, sha1: str) -> bool:
+        return os.path.exists(self._manifest_path(sha1))
+
+    def getManifest(self, sha1: str) -> Optional[dict]:
+        try:
+            with open(self._manifest_path(sha1), 'r') as f:
+                return json.load(f)
+        except:
+            return None
+
+    def addFile(self, path: str, sha1: str) -> dict:
+        """Store the content of a file (whose sha1 is known) as chunks. Returns
+        the statistics: num_chunks, num_chunks_new, num_bytes, num_bytes_new"""
+        chunks = []
+        stats = dict(num_chunks=0, num_chunks_new=0, num_bytes=0, num_bytes_new=0)
+        with open(path, 'rb') as f:
+            for data in iter_chunks(f):
+                chunk_sha1 = hashlib.sha1(data).hexdigest()
+                if self._write_chunk(chunk_sha1, data):
+                    stats['num_chunks_new'] += 1
+                    stats['num_bytes_new'] += len(data)
+                stats['num_chunks'] += 1
+                stats['num_bytes'] += len(data)
+                chunks.append([chunk_sha1, len(data)])
+        manifest = dict(sha1=sha1, size=stats['num_bytes'], chunks=chunks)
+        _write_file_atomic(self._manifest_path(sha1, create=True), json.dumps(manifest).encode('utf-8'))
+        return stats
+
+    def openFile(self, sha1: str) -> Optional['ChunkedFile']:
+        """Return a read-only, seekable file object that reads the chunks on
+        demand, or None if the file is not in the store"""
+        manifest = self.getManifest(sha1)
+        if manifest is None:
+            return None
+        chunk_paths = [self._chunk_path(chunk_sha1) for chunk_sha1, _ in manifest['chunks']]
+        if not all([os.path.exists(p) for p in chunk_paths]):
+            return None
+        return ChunkedFile(chunk_paths=chunk_paths, chunk_sizes=[size for _, size in manifest['chunks']])
+
+    def reassembleFile(self, sha1: str, dest_path: str) -> bool:
+        """Write the file to dest_path, verifying its sha1. Returns False if
+        the file is not (completely) in the store."""
+        f = self.openFile(sha1)
+        if f is None:
+            return False
+        tmp_path = dest_path + '.copying.' + _random_string(6)
+        try:
+            hh = hashlib.sha1()
+            with f:
+                with open(tmp_path, 'wb') as f_out:
+                    while True:
+                        data = f.read(_READ_BLOCK_SIZE)
+                        if not data:
+                            break
+                        hh.update(data)
+                        f_out.write(data)
+            if hh.hexdigest() != sha1:
+                print('Warning: unexpected sha1 of reassembled file. Removing manifest for {}.'.format(sha1))
+                self.removeFile(sha1)
+                return False
+            os.replace(tmp_path, dest_path)
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def removeFile(self, sha1: str) -> None:
+        """Remove the manifest. The chunks are removed by cleanup() once they
+        are no longer referenced."""
+        try:
+            os.unlink(self._manifest_path(sha1))
+        except:
+            pass
+
+    def listFiles(self) -> List[Tuple[str, dict]]:
+        """Return (sha1, manifest) for all files in the store"""
+        ret = []
+        for dirpath, fnames in _walk_cache_subdirectories(os.path.join(self._directory, 'manifests')):
+            for fname in fnames:
+                if fname.endswith('.json'):
+                    manifest = self.getManifest(fname[:-len('.json')])
+                    if manifest is not None:
+                        ret.append((fname[:-len('.json')], manifest))
+        return ret
+
+    def listChunks(self) -> Dict[str, Tuple[str, os.stat_result]]:
+        """Return chunk_sha1 -> (path, stat) for all stored chunks"""
+        ret = dict()
+        for dirpath, fnames in _walk_cache_subdirectories(self._directory):
+            for fname in fnames:
+                if len(fname) == 40:
+                    path = os.path.join(dirpath, fname)
+                    try:
+                        ret[fname] = (path, os.stat(path))
+                    except:
+                        pass
+        return ret
+
+    def removeChunk(self, chunk_sha1: str) -> None:
+        try:
+            os.unlink(self._chunk_path(chunk_sha1))
+        except:
+            pass
+
+    def _write_chunk(self, chunk_sha1: str, data: bytes) -> bool:
+        path = self._chunk_path(chunk_sha1, create=True)
+        if os.path.exists(path):
+            # Mark it as recently used so that a concurrent cleanup() does
+            # not remove it before our manifest is written
+            try:
+                os.utime(path)
+            except:
+                pass
+            return False
+        _write_file_atomic(path, data)
+        return True
+
+    def _chunk_path(self, chunk_sha1: str, *, create: bool=False) -> str:
+        return _sharded_path(self._directory, chunk_sha1, '', create=create)
+
+    def _manifest_path(self, sha1: str, *, create: bool=False) -> str:
+        return _sharded_path(os.path.join(self._directory, 'manifests'), sha1, '.json', create=create)
+
+
+class ChunkedFile(io.RawIOBase):
+    def __init__(self, *, chunk_paths: List[str], chunk_sizes: List[int]):
+        """Read-only file object over a sequence of chunk files"""
+        super().__init__()
+        self._chunk_paths = chunk_paths
+        self._offsets = [0]
+        for size in chunk_sizes:
+            self._offsets.append(self._offsets[-1] + size)
+        self._position = 0
+        self._current_index: Optional[int] = None
+        self._current_file: Optional[IO] = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def size(self) -> int:
+        return self._offsets[-1]
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size() + offset
+        else:
+            raise ValueError('Invalid whence: {}'.format(whence))
+        if position < 0:
+            raise ValueError('Negative seek position: {}'.format(position))
+        self._position = position
+        return position
+
+    def readinto(self, b) -> int:
+        if self._position >= self.size():
+            return 0
+        ii = bisect.bisect_right(self._offsets, self._position) - 1
+        if self._current_index != ii:
+            self._close_current()
+            self._current_file = open(self._chunk_paths[ii], 'rb')
+            self._current_index = ii
+        assert self._current_file is not None
+        self._current_file.seek(self._position - self._offsets[ii])
+        num = min(len(b), self._offsets[ii + 1] - self._position)
+        data = self._current_file.read(num)
+        if len(data) != num:
+            raise Exception('Unexpected end of chunk file: {}'.format(self._chunk_paths[ii]))
+        b[0:num] = data
+        self._position += num
+        return num
+
+    def close(self) -> None:
+        self._close_current()
+        super().close()
+
+    def _close_current(self) -> None:
+        if self._current_file is not None:
+            self._current_file.close()
+            self._current_file = None
+            self._current_index = None
+
+
+def iter_chunks(f: IO, *, min_size: int=_MIN_CHUNK_SIZE, avg_bits: int=_AVG_CHUNK_BITS, max_size: int=_MAX_CHUNK_SIZE) -> Iterator[bytes]:
+    """Split the content of a binary file object into content-defined chunks"""
+    import numpy as np
+    table = _gear_table()
+    tail = np.zeros(0, dtype=np.uint8)
+    pending = b''
+    while True:
+        block = f.read(_READ_BLOCK_SIZE)
+        if not block:
+            break
+        arr = np.frombuffer(block, dtype=np.uint8)
+        # include the end of the previous block so that the hashes do not
+        # depend on where the blocks start
+        arr2 = np.concatenate([tail, arr])
+        cut_points = _cut_points(arr2, table, avg_bits, start=len(tail))
+        tail = arr2[-(_WINDOW_SIZE - 1):]
+        data = pending + block
+        base = len(pending)
+        last = 0
+        for cut_point in cut_points.tolist():
+            pos = base + cut_point
+            if pos - last < min_size:
+                continue
+            while pos - last > max_size:
+                yield data[last:last + max_size]
+                last = last + max_size
+            if pos - last < min_size:
+                continue
+            yield data[last:pos]
+            last = pos
+        while len(data) - last > max_size:
+            yield data[last:last + max_size]
+            last = last + max_size
+        pending = data[last:]
+    if pending:
+        yield pending
+
+
+def _cut_points(arr, table, avg_bits: int, *, start: int):
+    # Positions (relative to start) after which a chunk may end: where the
+    # top avg_bits bits of the hash are zero. Hashed in pieces that fit in
+    # the CPU cache, each overlapping the previous one by the window size.
+    import numpy as np
+    ret = []
+    threshold = np.uint32(1 << (32 - avg_bits))
+    for offset in range(start, len(arr), _HASH_BLOCK_SIZE):
+        offset0 = max(0, offset - (_WINDOW_SIZE - 1))
+        hashes = _gear_hashes(arr[offset0:offset + _HASH_BLOCK_SIZE], table)[offset - offset0:]
+        ret.append(np.nonzero(hashes < threshold)[0] + (offset - start + 1))
+    if not ret:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(ret)
+
+
+def _gear_hashes(arr, table):
+    # h[i] = sum_{k<32} table[arr[i-k]] << k (mod 2^32), i.e. the gear hash
+    # h = (h << 1) + table[byte] after byte i, computed by doubling the window
+    import numpy as np
+    h = table[arr]
+    width = 1
+    while width < _WINDOW_SIZE:
+        # the right hand side is evaluated before the in-place addition
+        h[width:] += h[:-width] << np.uint32(width)
+        width = width * 2
+    return h
+
+
+_gear_table_cache: list = []
+
+
+def _gear_table():
+    import numpy as np
+    if not _gear_table_cache:
+        # fixed pseudo-random values, so that all processes cut at the same places
+        values = [int(hashlib.sha1(bytes([ii])).hexdigest()[0:8], 16) for ii in range(256)]
+        _gear_table_cache.append(np.array(values, dtype=np.uint32))
+    return _gear_table_cache[0]
+
+
+def _sharded_path(directory: str, sha1: str, ext: str, *, create: bool) -> str:
+    path0 = os.path.join(directory, sha1[0], sha1[1:3])
+    if create and (not os.path.exists(path0)):
+        try:
+            os.makedirs(path0)
+        except:
+            if not os.path.exists(path0):
+                raise Exception('Unable to make directory: ' + path0)
+    return os.path.join(path0, sha1 + ext)
+
+
+def _write_file_atomic(path: str, data: bytes) -> None:
+    tmp_path = path + '.copying.' + _random_string(6)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _random_string(num_chars: int) -> str:
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    return ''.join(random.choice(chars) for _ in range(num_chars))
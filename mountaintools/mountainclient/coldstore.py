@@ -0,0 +1,283 @@
+import io
+import os
+import json
+import struct
+import random
+import hashlib
+import zlib
+from .sha1cacheindex import _walk_cache_subdirectories
+from typing import Optional, List, Tuple, IO
+
+# Compressed (cold) tier of the Sha1Cache (see Sha1Cache.cleanup()).
+#
+# Files that have not been accessed for a while are compressed and stored
+# under their original sha1:
+#
+#   <cache>/cold/<s[0]>/<s[1:3]>/<sha1>.cz
+#
+# The content is split into blocks that are compressed independently, so that
+# ColdFile can read any range by decompressing only the blocks involved. The
+# file ends with a json footer followed by its length (8 bytes, little endian):
+#
+#   {"sha1": ..., "size": ..., "codec": "zstd"|"zlib", "block_size": ...,
+#    "blocks": [[offset, compressed_size], ...]}
+#
+# zstd requires the optional zstandard package. Otherwise (or with
+# SHA1_CACHE_COMPRESSION=zlib) the files are compressed with zlib.
+
+_BLOCK_SIZE = 1024 * 1024
+# Files that shrink by less than this fraction are not compressed
+_MIN_SAVINGS = 0.1
+# Smaller files are not compressed
+_MIN_FILE_SIZE = 4096
+# The number of blocks compressed to estimate whether a file is worth compressing
+_NUM_SAMPLE_BLOCKS = 4
+_ZSTD_LEVEL = 3
+_ZLIB_LEVEL = 6
+_CODECS = ['zstd', 'zlib']
+
+
+class ColdStore():
+    def __init__(self, directory: str, *, codec: Optional[str]=None):
+        """Store of compressed files
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the store (the cold/ subdirectory of the cache)
+        codec : Optional[str], optional
+            The compression codec for new files ('zstd' or 'zlib'), by default
+            the SHA1_CACHE_COMPRESSION environment variable, or zstd if the
+            zstandard package is installed and zlib otherwise
+        """
+        self._directory = directory
+        self._codec = codec
+
+    def directory(self) -> str:
+        return self._directory
+
+    def codec(self) -> str:
+        codec = self._codec or os.environ.get('SHA1_CACHE_COMPRESSION', None)
+        if codec is None:
+            codec = 'zstd' if _zstandard_available() else 'zlib'
+        if codec not in _CODECS:
+            raise Exception('Invalid compression codec: {}'.format(codec))
+        return codec
+
+    def hasFile(self, sha1: str) -> bool:
+        return os.path.exists(self._path(sha1))
+
+    def addFile(self, path: str, sha1: str) -> Optional[int]:
+        """Store the compressed content of a file (whose sha1 is known).
+        Returns the compressed size, or None if the file does not compress
+        well enough to be worth storing."""
+        codec = self.codec()
+        compress = _compressor(codec)
+        size = os.path.getsize(path)
+        if size < _MIN_FILE_SIZE:
+            return None
+        dest_path = self._path(sha1, create=True)
+        tmp_path = dest_path + '.copying.' + _random_string(6)
+        try:
+            blocks: List[List[int]] = []
+            offset = 0
+            num_bytes = 0
+            with open(path, 'rb') as f, open(tmp_path, 'wb') as f_out:
+                while True:
+                    data = f.read(_BLOCK_SIZE)
+                    if not data:
+                        break
+                    data2 = compress(data)
+                    f_out.write(data2)
+                    blocks.append([offset, len(data2)])
+                    offset = offset + len(data2)
+                    num_bytes = num_bytes + len(data)
+                    if (len(blocks) == _NUM_SAMPLE_BLOCKS) or (num_bytes == size):
+                        # give up early on incompressible files (e.g., images of compressed file systems)
+                        if offset > (1 - _MIN_SAVINGS) * num_bytes:
+                            return None
+                if num_bytes != size:
+                    raise Exception('Unexpected size of file while compressing: {}'.format(path))
+                footer = json.dumps(dict(sha1=sha1, size=size, codec=codec, block_size=_BLOCK_SIZE, blocks=blocks)).encode('utf-8')
+                f_out.write(footer)
+                f_out.write(struct.pack('<Q', len(footer)))
+            if offset > (1 - _MIN_SAVINGS) * size:
+                return None
+            os.replace(tmp_path, dest_path)
+            return os.path.getsize(dest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def openFile(self, sha1: str) -> Optional['ColdFile']:
+        """Return a read-only, seekable file object that decompresses the
+        blocks on demand, or None if the file is not in the store"""
+        try:
+            return ColdFile(self._path(sha1))
+        except FileNotFoundError:
+            return None
+
+    def decompressFile(self, sha1: str, dest_path: str) -> bool:
+        """Write the file to dest_path, verifying its sha1. Returns False if
+        the file is not in the store."""
+        f = self.openFile(sha1)
+        if f is None:
+            return False
+        tmp_path = dest_path + '.copying.' + _random_string(6)
+        try:
+            hh = hashlib.sha1()
+            with f:
+                with open(tmp_path, 'wb') as f_out:
+                    while True:
+                        data = f.read(_BLOCK_SIZE)
+                        if not data:
+                            break
+                        hh.update(data)
+                        f_out.write(data)
+            if hh.hexdigest() != sha1:
+                print('Warning: unexpected sha1 of decompressed file. Removing {}.'.format(self._path(sha1)))
+                self.removeFile(sha1)
+                return False
+            os.replace(tmp_path, dest_path)
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def removeFile(self, sha1: str) -> None:
+        try:
+            os.unlink(self._path(sha1))
+        except:
+            pass
+
+    def listFiles(self) -> List[Tuple[str, str, os.stat_result]]:
+        """Return (sha1, path, stat) for all files in the store"""
+        ret = []
+        for dirpath, fnames in _walk_cache_subdirectories(self._directory):
+            for fname in fnames:
+                if fname.endswith('.cz') and (len(fname) == 43):
+                    path = os.path.join(dirpath, fname)
+                    try:
+                        ret.append((fname[:40], path, os.stat(path)))
+                    except:
+                        pass
+        return ret
+
+    def _path(self, sha1: str, *, create: bool=False) -> str:
+        path0 = os.path.join(self._directory, sha1[0], sha1[1:3])
+        if create and (not os.path.exists(path0)):
+            try:
+                os.makedirs(path0)
+            except:
+                if not os.path.exists(path0):
+                    raise Exception('Unable to make directory: ' + path0)
+        return os.path.join(path0, sha1 + '.cz')
+
+
+class ColdFile(io.RawIOBase):
+    def __init__(self, path: str):
+        """Read-only file object over a compressed file of the cold store"""
+        super().__init__()
+        self._file: IO = open(path, 'rb')
+        try:
+            self._file.seek(-8, io.SEEK_END)
+            footer_size = struct.unpack('<Q', self._file.read(8))[0]
+            self._file.seek(-8 - footer_size, io.SEEK_END)
+            self._footer = json.loads(self._file.read(footer_size).decode('utf-8'))
+            self._decompress = _decompressor(self._footer['codec'])
+        except:
+            self._file.close()
+            raise
+        self._block_size = self._footer['block_size']
+        self._position = 0
+        self._current_index: Optional[int] = None
+        self._current_data = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def size(self) -> int:
+        return self._footer['size']
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size() + offset
+        else:
+            raise ValueError('Invalid whence: {}'.format(whence))
+        if position < 0:
+            raise ValueError('Negative seek position: {}'.format(position))
+        self._position = position
+        return position
+
+    def readinto(self, b) -> int:
+        # fill b across block boundaries, so that read(n) returns n bytes
+        # unless the end of the file is reached
+        num = 0
+        while (num < len(b)) and (self._position < self.size()):
+            ii = self._position // self._block_size
+            if self._current_index != ii:
+                offset, compressed_size = self._footer['blocks'][ii]
+                self._file.seek(offset)
+                self._current_data = self._decompress(self._file.read(compressed_size))
+                self._current_index = ii
+            i1 = self._position - ii * self._block_size
+            num0 = min(len(b) - num, len(self._current_data) - i1)
+            if num0 <= 0:
+                raise Exception('Unexpected end of compressed block {} of {}'.format(ii, self._file.name))
+            b[num:num + num0] = self._current_data[i1:i1 + num0]
+            num = num + num0
+            self._position += num0
+        return num
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+
+def _zstandard_available() -> bool:
+    try:
+        import zstandard  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _compressor(codec: str):
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('The zstandard package is required for zstd compression.')
+        return zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress
+    elif codec == 'zlib':
+        return lambda data: zlib.compress(data, _ZLIB_LEVEL)
+    else:
+        raise Exception('Invalid compression codec: {}'.format(codec))
+
+
+def _decompressor(codec: str):
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('The zstandard package is required to read zstd-compressed files.')
+        return zstandard.ZstdDecompressor().decompress
+    elif codec == 'zlib':
+        return zlib.decompress
+    else:
+        raise Exception('Invalid compression codec: {}'.format(codec))
+
+
+def _random_string(num_chars: int) -> str:
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    return ''.join(random.choice(chars) for _ in range(num_chars))
@@ -0,0 +1,225 @@
+import os
+import stat
+import json
+import random
+import hashlib
+import threading
+from .sha1cacheindex import _walk_cache_subdirectories
+from typing import Optional, List, Dict, Tuple, Callable, Any
+
+# Cache of the indices of local directories (see MountainClient.readDir() and
+# computeDirHash()).
+#
+# For each directory that was read we remember the stat signature of the
+# directory itself (inode, mtime, ctime), the names of its subdirectories and
+# the stats and sha1s of its files. When the directory is read again:
+#
+#   - a directory whose signature is unchanged is not listed again (entries
+#     can only be added, removed or renamed by changing the directory mtime)
+#   - with validation 'stat' (default) each file is stat'ed once, and the
+#     remembered sha1 is reused if the stats are unchanged
+#   - with validation 'mtime' the files of unchanged directories are not
+#     stat'ed at all. This is faster, but in-place modifications of existing
+#     files are not detected.
+#
+# The indices are kept in memory and persisted as json files in the sha1
+# cache directory (<cache>/dir-index/), one per (path, recursive), so they
+# also survive across processes. Set MOUNTAIN_DIR_INDEX_CACHE to 'stat'
+# (default), 'mtime' or 'off'.
+
+_VALIDATION_MODES = ['stat', 'mtime', 'off']
+
+
+class DirIndexCache():
+    def __init__(self, directory: Optional[str]):
+        """Cache of local directory indices
+
+        Parameters
+        ----------
+        directory : Optional[str]
+            Where to persist the indices, or None to only keep them in memory
+        """
+        self._directory = directory
+        # (path, recursive) -> (relative directory path -> node)
+        self._nodes: Dict[Tuple[str, bool], Dict[str, dict]] = dict()
+        self._lock = threading.Lock()
+
+    def readDir(self, path: str, *, recursive: bool, include_sha1: bool,
+                compute_file_sha1s: Callable[[List[str]], List[Optional[str]]],
+                validation: Optional[str]=None) -> Optional[dict]:
+        """Return the index of a local directory in the format of
+        MountainClient.readDir(). compute_file_sha1s is called (once) with the
+        paths of the files whose sha1s are not known."""
+        if validation is None:
+            validation = os.environ.get('MOUNTAIN_DIR_INDEX_CACHE', 'stat')
+        if validation not in _VALIDATION_MODES:
+            raise Exception('Invalid directory index validation mode: {}'.format(validation))
+        path = os.path.abspath(path)
+        key = (path, recursive)
+        if validation == 'off':
+            old_nodes: Dict[str, dict] = dict()
+        else:
+            with self._lock:
+                if key not in self._nodes:
+                    self._nodes[key] = self._load(path, recursive)
+                old_nodes = self._nodes[key]
+        new_nodes: Dict[str, dict] = dict()
+        files_needing_sha1: List[Tuple[dict, dict, str]] = []
+        ret = self._read(path, '', old_nodes=old_nodes, new_nodes=new_nodes, recursive=recursive,
+                         files_needing_sha1=files_needing_sha1 if include_sha1 else None, validation=validation)
+        if files_needing_sha1:
+            sha1s = compute_file_sha1s([path0 for _, _, path0 in files_needing_sha1])
+            for (file0, node_file0, _), sha1 in zip(files_needing_sha1, sha1s):
+                file0['sha1'] = sha1
+                if sha1:
+                    node_file0['sha1'] = sha1
+        if validation == 'off':
+            return ret
+        changed = (files_needing_sha1 or (new_nodes != old_nodes))
+        with self._lock:
+            self._nodes[key] = new_nodes
+        if changed:
+            self._save(path, recursive, new_nodes)
+        return ret
+
+    def cleanup(self) -> int:
+        """Remove the persisted indices of directories that no longer exist.
+        Returns the number of files removed."""
+        if (self._directory is None) or (not os.path.isdir(self._directory)):
+            return 0
+        num_removed = 0
+        for dirpath, fnames in _walk_cache_subdirectories(self._directory):
+            for fname in fnames:
+                if not fname.endswith('.json'):
+                    continue
+                fname0 = os.path.join(dirpath, fname)
+                obj = _read_json_file(fname0)
+                if (obj is None) or (not os.path.isdir(obj.get('path', ''))):
+                    try:
+                        os.unlink(fname0)
+                        num_removed += 1
+                    except:
+                        pass
+        return num_removed
+
+    def _read(self, path: str, relpath: str, *, old_nodes: Dict[str, dict], new_nodes: Dict[str, dict],
+              recursive: bool, files_needing_sha1: Optional[List[Tuple[dict, dict, str]]], validation: str) -> Optional[dict]:
+        try:
+            st = os.stat(path)
+        except:
+            return None
+        signature = [st.st_ino, st.st_mtime_ns, st.st_ctime_ns]
+        old_node = old_nodes.get(relpath, None)
+        if (old_node is not None) and (old_node['signature'] == signature):
+            node = dict(signature=signature, files=dict(), dirs=old_node['dirs'])
+            for name0, file0 in old_node['files'].items():
+                if validation == 'mtime':
+                    node['files'][name0] = file0
+                    continue
+                stat0 = _file_stat(os.path.join(path, name0))
+                if stat0 is None:
+                    # removed or replaced by something that is not a file;
+                    # don't trust this node any more
+                    return self._read(path, relpath, old_nodes=dict(), new_nodes=new_nodes, recursive=recursive,
+                                      files_needing_sha1=files_needing_sha1, validation=validation)
+                node['files'][name0] = _reuse_sha1(stat0, file0)
+        else:
+            node = dict(signature=signature, files=dict(), dirs=[])
+            old_files = old_node['files'] if old_node is not None else dict()
+            try:
+                entries = list(os.scandir(path))
+            except:
+                return None
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat0 = _stat_dict(entry.stat())
+                        node['files'][entry.name] = _reuse_sha1(stat0, old_files.get(entry.name, None))
+                    elif entry.is_dir():
+                        node['dirs'].append(entry.name)
+                except OSError:
+                    # removed while we were listing
+                    pass
+        new_nodes[relpath] = node
+
+        ret: dict = dict(
+            files={},
+            dirs={}
+        )
+        for name0, file0 in node['files'].items():
+            ret['files'][name0] = dict(
+                size=file0['size']
+            )
+            if files_needing_sha1 is not None:
+                if file0.get('sha1', None):
+                    ret['files'][name0]['sha1'] = file0['sha1']
+                else:
+                    files_needing_sha1.append((ret['files'][name0], file0, os.path.join(path, name0)))
+        for name0 in node['dirs']:
+            ret['dirs'][name0] = {}
+            if recursive:
+                ret['dirs'][name0] = self._read(os.path.join(path, name0), relpath + '/' + name0, old_nodes=old_nodes, new_nodes=new_nodes,
+                                                recursive=recursive, files_needing_sha1=files_needing_sha1, validation=validation)
+        return ret
+
+    def _index_path(self, path: str, recursive: bool) -> Optional[str]:
+        if self._directory is None:
+            return None
+        hash0 = hashlib.sha1(json.dumps([path, recursive]).encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, hash0[0], hash0[1:3], hash0 + '.json')
+
+    def _load(self, path: str, recursive: bool) -> Dict[str, dict]:
+        index_path = self._index_path(path, recursive)
+        if index_path is None:
+            return dict()
+        obj = _read_json_file(index_path)
+        if (obj is None) or (obj.get('path', None) != path) or (obj.get('recursive', None) != recursive):
+            return dict()
+        return obj['nodes']
+
+    def _save(self, path: str, recursive: bool, nodes: Dict[str, dict]) -> None:
+        index_path = self._index_path(path, recursive)
+        if index_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            tmp_path = index_path + '.tmp.' + _random_string(6)
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(path=path, recursive=recursive, nodes=nodes), f)
+            os.replace(tmp_path, index_path)
+        except:
+            print('Warning: unable to save directory index: {}'.format(index_path))
+
+
+def _stat_dict(st: os.stat_result) -> dict:
+    return dict(size=st.st_size, ino=st.st_ino, mtime=st.st_mtime_ns, ctime=st.st_ctime_ns)
+
+
+def _file_stat(path: str) -> Optional[dict]:
+    try:
+        st = os.stat(path)
+    except:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return _stat_dict(st)
+
+
+def _reuse_sha1(stat0: dict, old_file: Optional[dict]) -> dict:
+    # keep the known sha1 if the file has not changed
+    if (old_file is not None) and old_file.get('sha1', None) and all([old_file[k] == stat0[k] for k in ['size', 'ino', 'mtime', 'ctime']]):
+        return dict(stat0, sha1=old_file['sha1'])
+    return stat0
+
+
+def _read_json_file(path: str) -> Any:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except:
+        return None
+
+
+def _random_string(num_chars: int) -> str:
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    return ''.join(random.choice(chars) for _ in range(num_chars))
@@ -1,26 +1,33 @@
+import os
 import fcntl
 import errno
 import time
 import random
-from typing import IO, Optional
+import threading
+import mtlogging
+from typing import IO, Optional, Dict
 
 
 class FileLock():
-    def __init__(self, path: str, exclusive: bool=True, _disable_lock: bool=False):
+    def __init__(self, path: str, exclusive: bool=True, _disable_lock: bool=False, *, blocking: Optional[bool]=None, timeout: Optional[float]=None, share_descriptor: bool=False):
         """Lock a file via fcntl.flock using an exclusive or non-exclusive lock.
-        
+
         Example usage:
         ```
         with FileLock('some_file.txt.lock', exclusive=True):
             # Do something with some_file.txt
         ```
-        
+
         Rather than locking a file directly, it is helpful to lock an adjacent
         .lock file.
 
         Exclusive locks are useful for read/write access whereas non-exclusive
         locks are useful for readonly access.
 
+        When the histograms of mtlogging are enabled (see
+        mtlogging.enable_histograms()), the time spent waiting for each lock
+        is recorded in the 'filelock_wait' histogram.
+
         Parameters
         ----------
         path : str
@@ -29,36 +36,193 @@ class FileLock():
             Whether the lock should be exclusive, by default True
         _disable_lock : bool, optional
             For testing purposes, do not actually lock, by default False
+        blocking : Optional[bool], optional
+            Wait for the lock in the kernel rather than polling with random
+            sleeps. By default True if the FILELOCK_MODE environment variable
+            is set to 'blocking'.
+        timeout : Optional[float], optional
+            Raise an exception if the lock could not be acquired within this
+            number of seconds, by default None (wait forever)
+        share_descriptor : bool, optional
+            For non-exclusive locks, share a single file descriptor (and
+            thus a single flock) between the threads of this process that
+            hold non-exclusive locks on the same path with this option, by
+            default False. The shared lock is held as long as any of these
+            threads holds it, so a steady stream of readers can keep writers
+            in other processes waiting indefinitely.
         """
         self._path = path
         self._file: Optional[IO] = None
         self._disable_lock = _disable_lock
         self._exclusive = exclusive
+        if blocking is None:
+            blocking = (os.environ.get('FILELOCK_MODE', 'poll') == 'blocking')
+        self._blocking = blocking
+        self._timeout = timeout
+        self._share_descriptor = share_descriptor
+        self._shared_entry: Optional[_SharedLockEntry] = None
 
     def __enter__(self) -> None:
         if self._disable_lock:
             return
-        self._file = open(self._path, 'w+')
+        timer = time.time()
+        try:
+            if self._exclusive or (not self._share_descriptor):
+                self._file = self._acquire()
+            else:
+                self._shared_entry = self._acquire_shared()
+        finally:
+            if mtlogging.histograms_enabled():
+                mtlogging.observe('filelock_wait', self._path, time.time() - timer)
+
+    def __exit__(self, type, value: object, traceback) -> None:
+        if self._disable_lock:
+            return
+        if self._shared_entry is not None:
+            _release_shared(self._path, self._shared_entry)
+            self._shared_entry = None
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def _acquire(self) -> IO:
+        file = open(self._path, 'w+')
+        op = fcntl.LOCK_EX if self._exclusive else fcntl.LOCK_SH
+        try:
+            if self._blocking:
+                if self._timeout is None:
+                    fcntl.flock(file, op)
+                    return file
+                if _flock_with_timeout(file, op, self._timeout):
+                    return file
+                # the helper thread now owns (and will close) the file
+                file = None
+                raise Exception('Timeout while waiting for lock on {} (exclusive={})'.format(self._path, self._exclusive))
+            self._poll(file, op)
+            return file
+        except:
+            if file is not None:
+                file.close()
+            raise
+
+    def _poll(self, file: IO, op: int) -> None:
+        timer = time.time()
         num_tries = 0
         while True:
             try:
-                if self._exclusive:
-                    fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                else:
-                    fcntl.flock(self._file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                fcntl.flock(file, op | fcntl.LOCK_NB)
                 if num_tries > 10:
                     print('Locked file {} after {} tries (exclusive={})...'.format(self._path, num_tries, self._exclusive))
-                break
+                return
             except IOError as e:
                 if e.errno != errno.EAGAIN:
                     raise
                 else:
+                    if (self._timeout is not None) and (time.time() - timer > self._timeout):
+                        raise Exception('Timeout while waiting for lock on {} (exclusive={})'.format(self._path, self._exclusive))
                     num_tries = num_tries + 1
                     time.sleep(random.uniform(0, 0.1))
 
-    def __exit__(self, type, value: object, traceback) -> None:
-        if self._disable_lock:
+    def _acquire_shared(self) -> '_SharedLockEntry':
+        timer = time.time()
+        while True:
+            with _shared_locks_lock:
+                _check_pid()
+                entry = _shared_locks.get(self._path, None)
+                is_owner = (entry is None)
+                if entry is None:
+                    entry = _SharedLockEntry()
+                    _shared_locks[self._path] = entry
+                entry.refcount += 1
+            if is_owner:
+                try:
+                    entry.file = self._acquire()
+                except:
+                    with _shared_locks_lock:
+                        if _shared_locks.get(self._path, None) is entry:
+                            del _shared_locks[self._path]
+                        entry.failed = True
+                    entry.ready.set()
+                    raise
+                entry.ready.set()
+                return entry
+            timeout = None
+            if self._timeout is not None:
+                timeout = max(0, self._timeout - (time.time() - timer))
+            if not entry.ready.wait(timeout):
+                _release_shared(self._path, entry)
+                raise Exception('Timeout while waiting for lock on {} (exclusive={})'.format(self._path, self._exclusive))
+            if not entry.failed:
+                return entry
+            # the thread that was acquiring the lock failed (for example it
+            # timed out), so try again
+
+
+class _SharedLockEntry():
+    def __init__(self):
+        self.file: Optional[IO] = None
+        self.refcount = 0
+        self.ready = threading.Event()
+        self.failed = False
+
+
+# path -> shared lock held (or being acquired) by this process
+_shared_locks: Dict[str, _SharedLockEntry] = dict()
+_shared_locks_lock = threading.Lock()
+_shared_locks_pid = os.getpid()
+
+
+def _check_pid() -> None:
+    # locks held by the parent are not shared with a forked child
+    global _shared_locks, _shared_locks_pid
+    if _shared_locks_pid != os.getpid():
+        _shared_locks = dict()
+        _shared_locks_pid = os.getpid()
+
+
+def _release_shared(path: str, entry: _SharedLockEntry) -> None:
+    with _shared_locks_lock:
+        entry.refcount -= 1
+        if entry.refcount > 0:
             return
-        if self._file is not None:
-            fcntl.flock(self._file, fcntl.LOCK_UN)
-            self._file.close()
+        if _shared_locks.get(path, None) is entry:
+            del _shared_locks[path]
+    if entry.file is not None:
+        fcntl.flock(entry.file, fcntl.LOCK_UN)
+        entry.file.close()
+
+
+def _flock_with_timeout(file: IO, op: int, timeout: float) -> bool:
+    # Blocking flock() can't be interrupted from another thread, so wait for
+    # it on a helper thread. If the timeout expires first, the helper thread
+    # releases the lock and closes the file once it is eventually acquired.
+    cond = threading.Condition()
+    state = dict(done=False, abandoned=False)
+
+    def target():
+        acquired = False
+        try:
+            fcntl.flock(file, op)
+            acquired = True
+        except:
+            pass
+        with cond:
+            state['done'] = True
+            state['acquired'] = acquired
+            if state['abandoned']:
+                if acquired:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+                file.close()
+            cond.notify_all()
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    with cond:
+        cond.wait_for(lambda: state['done'], timeout=timeout)
+        if not state['done']:
+            state['abandoned'] = True
+            return False
+        if not state['acquired']:
+            raise Exception('Unable to lock file: {}'.format(file.name))
+        return True
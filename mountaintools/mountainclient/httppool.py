@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from typing import Optional, Dict, Any, Tuple
+
+# One keep-alive requests session per base url (scheme://host:port), shared by
+# the pairio client, the kachery checks/uploads and the file downloader, so
+# that repeated requests to the same server reuse their TCP/TLS connections.
+#
+# The pool size (max connections kept open per server) and the number of
+# retries can be set with the MOUNTAIN_HTTP_POOL_SIZE and
+# MOUNTAIN_HTTP_NUM_RETRIES environment variables, or with
+# MountainClient.configHttp().
+#
+# Requests that do not pass a timeout get the default (connect, read) timeout
+# of the pool, so that a server that stops responding is retried rather than
+# waited for forever. 5xx responses and read timeouts are only retried for
+# idempotent methods: a POST may have taken effect on the server even if it
+# failed, so it is only retried when the connection fails.
+
+_RETRY_STATUS_CODES = [500, 502, 503, 504]
+_IDEMPOTENT_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+_DEFAULT_TIMEOUT = (10, 60)
+
+
+class HttpPool():
+    def __init__(self, *, pool_size: int=16, num_retries: int=3, retry_delay: float=0.2, max_retry_delay: float=5, timeout: Tuple[float, float]=_DEFAULT_TIMEOUT):
+        self._pool_size = pool_size
+        self._num_retries = num_retries
+        self._timeout = timeout
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._sessions: Dict[str, requests.Session] = dict()
+        self._metrics: Dict[str, dict] = dict()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def configure(self, *, pool_size: Optional[int]=None, num_retries: Optional[int]=None, timeout: Optional[Tuple[float, float]]=None) -> None:
+        with self._lock:
+            if pool_size is not None:
+                self._pool_size = pool_size
+                # new sessions will be created with the new pool size
+                self._close_sessions()
+            if num_retries is not None:
+                self._num_retries = num_retries
+            if timeout is not None:
+                self._timeout = timeout
+
+    def session(self, url: str) -> requests.Session:
+        """Return the shared session for the server of this url"""
+        base_url = _base_url(url)
+        with self._lock:
+            if self._pid != os.getpid():
+                # don't share connections with the parent process after a fork
+                self._pid = os.getpid()
+                self._sessions = dict()
+            if base_url not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+                session.mount(base_url, adapter)
+                self._sessions[base_url] = session
+            return self._sessions[base_url]
+
+    def request(self, method: str, url: str, *, data_path: Optional[str]=None, **kwargs) -> requests.Response:
+        """Send a request using the shared session for the server, retrying
+        connection errors with exponential backoff (and, for idempotent
+        methods, timeouts and 5xx responses).
+
+        Parameters
+        ----------
+        method : str
+            'GET', 'POST', 'HEAD', ...
+        url : str
+            The url
+        data_path : Optional[str], optional
+            Path of a file to stream as the request body (it is reopened on
+            each attempt), by default None
+        **kwargs
+            Passed on to requests.Session.request(). The timeout defaults to
+            the (connect, read) timeout of the pool.
+
+        Returns
+        -------
+        requests.Response
+            The response
+        """
+        session = self.session(url)
+        metrics = self._host_metrics(url)
+        kwargs.setdefault('timeout', self._timeout)
+        idempotent = (method.upper() in _IDEMPOTENT_METHODS)
+        num_tries = 0
+        while True:
+            timer = time.time()
+            try:
+                if data_path is not None:
+                    with open(data_path, 'rb') as f:
+                        response = session.request(method, url, data=f, **kwargs)
+                else:
+                    response = session.request(method, url, **kwargs)
+                error: Optional[str] = None
+                retry = idempotent
+                if response.status_code in _RETRY_STATUS_CODES:
+                    error = 'status code {}'.format(response.status_code)
+            except requests.ConnectionError as e:
+                # including timeouts while connecting
+                response = None
+                error = str(e)
+                retry = True
+            except requests.Timeout as e:
+                response = None
+                error = str(e)
+                retry = idempotent
+            elapsed = time.time() - timer
+            with self._lock:
+                metrics['num_requests'] += 1
+                metrics['elapsed_sec'] += elapsed
+                if response is not None:
+                    metrics['num_bytes_received'] += int(response.headers.get('content-length', 0) or 0)
+                if error is not None:
+                    metrics['num_errors'] += 1
+            if error is None:
+                return response
+            if (not retry) or (num_tries >= self._num_retries):
+                if response is not None:
+                    return response
+                raise Exception('Unable to open url ({}): {}'.format(error, url))
+            delay = min(self._retry_delay * 2 ** num_tries, self._max_retry_delay) * random.uniform(0.5, 1.5)
+            num_tries = num_tries + 1
+            with self._lock:
+                metrics['num_retries'] += 1
+            print('Retrying http request in {:.2f} sec ({}): {}'.format(delay, error, url))
+            time.sleep(delay)
+
+    def getJson(self, url: str) -> Any:
+        response = self.request('GET', url)
+        if response.status_code != 200:
+            raise Exception('Unable to open url ({}): {}'.format(response.status_code, url))
+        try:
+            return response.json()
+        except:
+            raise Exception('Unable to load json from url: ' + url)
+
+    def metrics(self) -> Dict[str, dict]:
+        """Return the request metrics per host"""
+        with self._lock:
+            return json.loads(json.dumps(self._metrics))
+
+    def resetMetrics(self) -> None:
+        with self._lock:
+            self._metrics = dict()
+
+    def _host_metrics(self, url: str) -> dict:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._metrics:
+                self._metrics[host] = dict(
+                    num_requests=0,
+                    num_errors=0,
+                    num_retries=0,
+                    num_bytes_received=0,
+                    elapsed_sec=0.0
+                )
+            return self._metrics[host]
+
+    def _close_sessions(self) -> None:
+        for session in self._sessions.values():
+            try:
+                session.close()
+            except:
+                pass
+        self._sessions = dict()
+
+
+def _base_url(url: str) -> str:
+    parsed = urlparse(url)
+    return '{}://{}/'.format(parsed.scheme, parsed.netloc)
+
+
+_http_pool = HttpPool(
+    pool_size=int(os.environ.get('MOUNTAIN_HTTP_POOL_SIZE', '16')),
+    num_retries=int(os.environ.get('MOUNTAIN_HTTP_NUM_RETRIES', '3'))
+)
+
+
+def get_http_pool() -> HttpPool:
+    return _http_pool
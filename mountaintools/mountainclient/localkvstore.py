@@ -0,0 +1,311 @@
+import os
+import sqlite3
+import threading
+from .filelock import FileLock
+from typing import Optional, List, Dict, Tuple
+
+# Alternative storage backend for the local key/value database of
+# MountainClientLocal (getValue/setValue).
+#
+# The legacy layout ('files') stores every value as an individual text file
+# <database>/<h[0:2]>/<h[2:4]>/<keyhash> (subkeys in <keyhash>.dir/<subkey>.txt)
+# guarded by a FileLock. With many processes writing at the same time (for
+# example job cache signatures from hundreds of slurm workers) the lock
+# spinning and the churn of tiny files dominate.
+#
+# The 'sqlite' backend stores the values in WAL-mode SQLite databases
+# <database>/kvstore/shard-XX.db, with the shard selected by the key hash.
+# Readers never block, each write is a single short transaction, and writers
+# to different shards do not contend. setValue(..., overwrite=False) is an
+# atomic compare-and-set (INSERT OR IGNORE), so exactly one of several
+# concurrent callers succeeds.
+#
+# Select the backend with the MOUNTAIN_DB_BACKEND environment variable
+# ('files' by default). Existing databases can be converted with
+# bin/mt-migrate-local-db.
+
+_DEFAULT_NUM_SHARDS = 16
+# Below the default limit of sqlite on the number of parameters of a query
+_MAX_QUERY_PARAMETERS = 500
+
+
+class LocalKVStoreSqlite():
+    def __init__(self, database_path: str, *, num_shards: Optional[int]=None):
+        """Sharded key/value store for the local database
+
+        Connections are opened lazily per process and per thread, so a store
+        object may be shared between threads and survives a fork.
+
+        Parameters
+        ----------
+        database_path : str
+            The local database directory
+        num_shards : Optional[int], optional
+            The number of shards. By default uses the number of shards of an
+            existing store, or 16 for a new one.
+        """
+        self._database_path = database_path
+        self._directory = os.path.join(database_path, 'kvstore')
+        if num_shards is None:
+            num_shards = _read_num_shards(self._directory)
+        self._num_shards = num_shards
+        self._local = threading.local()
+
+    def directory(self) -> str:
+        return self._directory
+
+    def numShards(self) -> int:
+        return self._num_shards
+
+    def getValue(self, keyhash: str, subkey: Optional[str]=None) -> Optional[str]:
+        conn = self._conn(keyhash)
+        if subkey is None:
+            row = conn.execute('SELECT value FROM kv WHERE keyhash = ?', (keyhash,)).fetchone()
+        else:
+            row = conn.execute('SELECT value FROM kv_subkeys WHERE keyhash = ? AND subkey = ?', (keyhash, subkey)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def getValues(self, keyhashes: List[str]) -> List[Optional[str]]:
+        """Return the values (without subkeys) for many key hashes, with one
+        query per shard"""
+        values: Dict[str, str] = dict()
+        by_shard: Dict[int, List[str]] = dict()
+        for keyhash in set(keyhashes):
+            by_shard.setdefault(self._shard_of(keyhash), []).append(keyhash)
+        for keyhashes0 in by_shard.values():
+            conn = self._conn(keyhashes0[0])
+            for ii in range(0, len(keyhashes0), _MAX_QUERY_PARAMETERS):
+                chunk = keyhashes0[ii:ii + _MAX_QUERY_PARAMETERS]
+                rows = conn.execute('SELECT keyhash, value FROM kv WHERE keyhash IN ({})'.format(','.join('?' * len(chunk))), chunk).fetchall()
+                for row in rows:
+                    values[row[0]] = row[1]
+        return [values.get(keyhash, None) for keyhash in keyhashes]
+
+    def getSubKeys(self, keyhash: str) -> List[str]:
+        rows = self._conn(keyhash).execute('SELECT subkey FROM kv_subkeys WHERE keyhash = ?', (keyhash,)).fetchall()
+        return [row[0] for row in rows]
+
+    def getSubKeyValues(self, keyhash: str) -> Dict[str, str]:
+        rows = self._conn(keyhash).execute('SELECT subkey, value FROM kv_subkeys WHERE keyhash = ?', (keyhash,)).fetchall()
+        return dict([(row[0], row[1]) for row in rows])
+
+    def setValue(self, keyhash: str, subkey: Optional[str], value: Optional[str], *, overwrite: bool) -> bool:
+        """Set (or remove, if value is None) a value. If overwrite is False,
+        the call fails (returns False) when a value already exists. Setting a
+        value with overwrite=False is an atomic compare-and-set."""
+        if value is None:
+            conn = self._conn(keyhash)
+            with conn:
+                if not overwrite:
+                    # take the write lock before the check, so that a value
+                    # set in the meantime by another process is not removed
+                    conn.execute('BEGIN IMMEDIATE')
+                    if self.getValue(keyhash, subkey) is not None:
+                        return False
+                if subkey is None:
+                    conn.execute('DELETE FROM kv WHERE keyhash = ?', (keyhash,))
+                else:
+                    conn.execute('DELETE FROM kv_subkeys WHERE keyhash = ? AND subkey = ?', (keyhash, subkey))
+            return True
+        verb = 'INSERT OR REPLACE' if overwrite else 'INSERT OR IGNORE'
+        conn = self._conn(keyhash)
+        with conn:
+            if subkey is None:
+                cursor = conn.execute(verb + ' INTO kv (keyhash, value) VALUES (?, ?)', (keyhash, value))
+            else:
+                cursor = conn.execute(verb + ' INTO kv_subkeys (keyhash, subkey, value) VALUES (?, ?, ?)', (keyhash, subkey, value))
+        # with INSERT OR IGNORE no row is changed if the value already exists
+        return cursor.rowcount == 1
+
+    def removeSubKeys(self, keyhash: str) -> None:
+        conn = self._conn(keyhash)
+        with conn:
+            conn.execute('DELETE FROM kv_subkeys WHERE keyhash = ?', (keyhash,))
+
+    def importDirectory(self, database_path: Optional[str]=None, *, remove_files: bool=False, verbose: bool=False) -> Tuple[int, int]:
+        """Import the values stored in the legacy file layout of a local
+        database directory. Values already in the store are kept.
+
+        Parameters
+        ----------
+        database_path : Optional[str], optional
+            The database directory to import, by default the directory of this
+            store
+        remove_files : bool, optional
+            Remove the imported files afterwards, by default False (their
+            .lock files are left in place, since other processes may hold
+            them)
+        verbose : bool, optional
+            Print progress, by default False
+
+        Returns
+        -------
+        Tuple[int, int]
+            The number of values and the number of subkey values imported
+        """
+        if database_path is None:
+            database_path = self._database_path
+        num_values = 0
+        num_subkey_values = 0
+        for name1 in sorted(_safe_list_dir(database_path)):
+            path1 = os.path.join(database_path, name1)
+            if (len(name1) != 2) or (not os.path.isdir(path1)):
+                continue
+            if verbose:
+                print('Importing {}'.format(path1))
+            for name2 in sorted(_safe_list_dir(path1)):
+                path2 = os.path.join(path1, name2)
+                if not os.path.isdir(path2):
+                    continue
+                values: List[Tuple[str, str]] = []
+                subkey_values: List[Tuple[str, str, str]] = []
+                imported_paths: List[str] = []
+                for fname in _safe_list_dir(path2):
+                    path0 = os.path.join(path2, fname)
+                    if fname.endswith('.dir') and os.path.isdir(path0):
+                        keyhash = fname[:-4]
+                        with FileLock(path0 + '.lock', exclusive=False):
+                            for fname2 in _safe_list_dir(path0):
+                                if fname2.endswith('.txt'):
+                                    txt = _read_text_file(os.path.join(path0, fname2))
+                                    if txt is not None:
+                                        subkey_values.append((keyhash, fname2[:-4], txt))
+                        imported_paths.append(path0)
+                    elif (not fname.endswith('.lock')) and os.path.isfile(path0):
+                        with FileLock(path0 + '.lock', exclusive=False):
+                            txt = _read_text_file(path0)
+                        if txt is not None:
+                            values.append((fname, txt))
+                        imported_paths.append(path0)
+                self._import_values(values, subkey_values)
+                num_values = num_values + len(values)
+                num_subkey_values = num_subkey_values + len(subkey_values)
+                if remove_files:
+                    for path0 in imported_paths:
+                        _remove_path(path0)
+                    _remove_dir_if_empty(path2)
+            if remove_files:
+                _remove_dir_if_empty(path1)
+        return (num_values, num_subkey_values)
+
+    def _import_values(self, values: List[Tuple[str, str]], subkey_values: List[Tuple[str, str, str]]) -> None:
+        for shard in range(self._num_shards):
+            values0 = [v for v in values if self._shard_of(v[0]) == shard]
+            subkey_values0 = [v for v in subkey_values if self._shard_of(v[0]) == shard]
+            if (not values0) and (not subkey_values0):
+                continue
+            conn = self._conn(values0[0][0] if values0 else subkey_values0[0][0])
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO kv (keyhash, value) VALUES (?, ?)', values0)
+                conn.executemany('INSERT OR IGNORE INTO kv_subkeys (keyhash, subkey, value) VALUES (?, ?, ?)', subkey_values0)
+
+    def _shard_of(self, keyhash: str) -> int:
+        try:
+            return int(keyhash[0:4], 16) % self._num_shards
+        except ValueError:
+            # keys of the form ~<hash> may use arbitrary strings
+            return sum(keyhash.encode('utf-8')) % self._num_shards
+
+    def _conn(self, keyhash: str) -> sqlite3.Connection:
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            # new thread, or we are in a forked child process
+            self._local.pid = pid
+            self._local.conns = dict()
+        shard = self._shard_of(keyhash)
+        if shard not in self._local.conns:
+            self._local.conns[shard] = self._open(shard)
+        return self._local.conns[shard]
+
+    def _open(self, shard: int) -> sqlite3.Connection:
+        _make_dirs(self._directory)
+        _write_num_shards(self._directory, self._num_shards)
+        conn = sqlite3.connect(os.path.join(self._directory, 'shard-{:02d}.db'.format(shard)), timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS kv (keyhash TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS kv_subkeys (keyhash TEXT, subkey TEXT, value TEXT, PRIMARY KEY (keyhash, subkey))')
+        return conn
+
+
+_stores: Dict[str, LocalKVStoreSqlite] = dict()
+_stores_lock = threading.Lock()
+
+
+def get_local_kv_store(database_path: str) -> LocalKVStoreSqlite:
+    """Return the (shared) sqlite store for a local database directory"""
+    key = os.path.abspath(database_path)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = LocalKVStoreSqlite(database_path)
+        return _stores[key]
+
+
+def local_kv_store_exists(database_path: str) -> bool:
+    return os.path.exists(os.path.join(database_path, 'kvstore', 'num_shards'))
+
+
+def _read_num_shards(directory: str) -> int:
+    txt = _read_text_file(os.path.join(directory, 'num_shards'))
+    if txt is None:
+        return _DEFAULT_NUM_SHARDS
+    return int(txt.strip())
+
+
+def _write_num_shards(directory: str, num_shards: int) -> None:
+    # The number of shards is fixed once the store has been created
+    fname = os.path.join(directory, 'num_shards')
+    if os.path.exists(fname):
+        if _read_num_shards(directory) != num_shards:
+            raise Exception('Inconsistent number of shards for local kv store: {}'.format(directory))
+        return
+    tmp_fname = fname + '.tmp.{}'.format(os.getpid())
+    with open(tmp_fname, 'w') as f:
+        f.write(str(num_shards))
+    os.rename(tmp_fname, fname)
+
+
+def _read_text_file(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except:
+        return None
+
+
+def _make_dirs(path: str) -> None:
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except:
+            if not os.path.exists(path):
+                raise Exception('Unexpected problem. Unable to create directory: ' + path)
+
+
+def _remove_path(path: str) -> None:
+    try:
+        if os.path.isdir(path):
+            for fname in os.listdir(path):
+                os.remove(os.path.join(path, fname))
+            os.rmdir(path)
+        else:
+            os.remove(path)
+    except:
+        print('Warning: unable to remove {}'.format(path))
+
+
+def _remove_dir_if_empty(path: str) -> None:
+    try:
+        os.rmdir(path)
+    except:
+        pass
+
+
+def _safe_list_dir(path: str) -> List[str]:
+    try:
+        return os.listdir(path)
+    except:
+        return []
@@ -0,0 +1,90 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple, Dict, Set
+
+
+class LruMemo():
+    def __init__(self, *, max_entries: int=10000, max_bytes: int=100 * 1024 * 1024):
+        """A thread-safe, size-bounded LRU memo. Entries may have a time to live
+        and may belong to a group so that related entries can be invalidated
+        together.
+
+        Parameters
+        ----------
+        max_entries : int, optional
+            The maximum number of entries, by default 10000
+        max_bytes : int, optional
+            The maximum total size of the entries, by default 100 MiB. The size
+            of an entry is the length of its value if it is a string or bytes,
+            or 1 otherwise.
+        """
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        # key -> (value, size, expires, group)
+        self._entries: 'OrderedDict[Any, Tuple[Any, int, Optional[float], Any]]' = OrderedDict()
+        self._groups: Dict[Any, Set[Any]] = dict()
+        self._num_bytes = 0
+        self._num_hits = 0
+        self._num_misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Tuple[bool, Any]:
+        """Return (found, value)"""
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                expires = entry[2]
+                if (expires is None) or (time.time() < expires):
+                    self._entries.move_to_end(key)
+                    self._num_hits += 1
+                    return (True, entry[0])
+                self._remove(key)
+            self._num_misses += 1
+            return (False, None)
+
+    def set(self, key: Any, value: Any, *, ttl: Optional[float]=None, group: Any=None) -> None:
+        size = len(value) if isinstance(value, (str, bytes)) else 1
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self._max_bytes:
+                # too large to keep (the old value is no longer valid)
+                return
+            self._entries[key] = (value, size, expires, group)
+            self._num_bytes += size
+            if group is not None:
+                self._groups.setdefault(group, set()).add(key)
+            while (len(self._entries) > self._max_entries) or (self._num_bytes > self._max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def invalidateGroup(self, group: Any) -> None:
+        with self._lock:
+            for key in list(self._groups.get(group, [])):
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = OrderedDict()
+            self._groups = dict()
+            self._num_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                num_hits=self._num_hits,
+                num_misses=self._num_misses,
+                num_entries=len(self._entries),
+                num_bytes=self._num_bytes
+            )
+
+    def _remove(self, key: Any) -> None:
+        _, size, _, group = self._entries.pop(key)
+        self._num_bytes -= size
+        if group is not None:
+            keys = self._groups.get(group, None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._groups[group]
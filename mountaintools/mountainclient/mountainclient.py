@@ -2,17 +2,38 @@ import json
 # import simplejson
 import os
 import sys
-import requests
 import traceback
+import threading
 from .mountainremoteclient import MountainRemoteClient
 from .mountainremoteclient import _http_get_json
+from .httppool import get_http_pool
+from .memo import LruMemo
+from .openfile import MmapFile, HttpRangeFile
+from .steady_download_and_compute_sha1 import download_rate_limit
 import time
 import mtlogging
-from .aux import _read_text_file, _sha1_of_object, _create_temporary_fname
+from .aux import _read_text_file, _sha1_of_object, _sha1_of_string, _create_temporary_fname
 from .aux import deprecated
 from typing import Union, List, Any, Optional, Tuple
 from .mttyping import StrOrStrList, StrOrDict
 from .mountainclientlocal import MountainClientLocal
+from concurrent.futures import ThreadPoolExecutor
+
+_KACHERY_BATCH_CHECK_SIZE = 1000
+_KACHERY_CHECK_NUM_WORKERS = 16
+# kachery url -> whether the server supports POST /check/sha1
+_kachery_batch_check_supported: dict = dict()
+
+# The results of kachery lookups are recorded in the local database, which is
+# shared by all processes (e.g., the slurm workers of a batch), so that the
+# kacheries are not asked about the same files over and over. Files are never
+# removed from a kachery, so files that were found are remembered for longer
+# than files that were not (these may be uploaded at any time). The records
+# are kept as subkeys of 16 keys (by the first digit of the sha1), so that
+# the expired ones can be found and removed by cleanupLocalCache(). See
+# configKacheryLookupCache().
+_KACHERY_LOOKUP_FOUND_TTL = float(os.environ.get('MOUNTAIN_KACHERY_LOOKUP_TTL', 7 * 24 * 3600))
+_KACHERY_LOOKUP_NOT_FOUND_TTL = float(os.environ.get('MOUNTAIN_KACHERY_MISS_TTL', 120))
 
 env_path = os.path.join(os.environ.get('HOME', ''), '.mountaintools', '.env')
 if os.path.exists(env_path):
@@ -158,6 +179,12 @@ class MountainClient():
         self._values_by_alias = dict()
         self._config_download_from = []
         self._local_db = MountainClientLocal(parent=self)
+        self._memo: Optional[LruMemo] = None
+        self._memo_key_ttl = 5.0
+        if os.environ.get('MOUNTAIN_MEMO', '') == 'TRUE':
+            self.configMemo(True)
+        self._kachery_lookup_found_ttl = _KACHERY_LOOKUP_FOUND_TTL
+        self._kachery_lookup_not_found_ttl = _KACHERY_LOOKUP_NOT_FOUND_TTL
 
         self._initialize_kacheries()
         self._read_pairio_tokens()
@@ -188,6 +215,148 @@ class MountainClient():
         self._verbose = value
         self._local_db.configVerbose(value)
 
+    def configMemo(self, enabled: bool=True, *, max_entries: int=10000, max_bytes: int=100 * 1024 * 1024, key_ttl: float=5.0) -> None:
+        """Turn on or off the in-process memo for getValue(), loadText() and
+        loadObject(). The memo may also be turned on by setting the
+        MOUNTAIN_MEMO=TRUE environment variable.
+
+        Content-addressed reads (sha1:// and sha1dir:// paths) never change, so
+        they are kept until evicted by the LRU size limits. Key lookups are kept
+        for key_ttl seconds, and are invalidated by setValue() on this client.
+        Values set by other processes may therefore take up to key_ttl seconds
+        to be seen.
+
+        Parameters
+        ----------
+        enabled : bool, optional
+            Whether to use the memo, by default True
+        max_entries : int, optional
+            The maximum number of memoized values, by default 10000
+        max_bytes : int, optional
+            The maximum total size of the memoized text, by default 100 MiB
+        key_ttl : float, optional
+            How long (in seconds) key lookups are memoized, by default 5.0
+        """
+        if enabled:
+            self._memo = LruMemo(max_entries=max_entries, max_bytes=max_bytes)
+            self._memo_key_ttl = key_ttl
+        else:
+            self._memo = None
+
+    def configKacheryLookupCache(self, enabled: bool=True, *, found_ttl: float=_KACHERY_LOOKUP_FOUND_TTL, not_found_ttl: float=_KACHERY_LOOKUP_NOT_FOUND_TTL) -> None:
+        """Configure how long the results of kachery lookups are remembered.
+
+        The results are recorded in the local database, so they are shared by
+        all processes that use it. Files that were not found are looked up
+        again after not_found_ttl seconds (they may have been uploaded in the
+        meantime). The defaults may also be set using the
+        MOUNTAIN_KACHERY_LOOKUP_TTL and MOUNTAIN_KACHERY_MISS_TTL environment
+        variables.
+
+        Parameters
+        ----------
+        enabled : bool, optional
+            Whether to use the recorded results, by default True
+        found_ttl : float, optional
+            How long (in seconds) files found on a kachery are remembered, by
+            default 7 days
+        not_found_ttl : float, optional
+            How long (in seconds) files not found on a kachery are
+            remembered, by default 120
+        """
+        if enabled:
+            self._kachery_lookup_found_ttl = found_ttl
+            self._kachery_lookup_not_found_ttl = not_found_ttl
+        else:
+            self._kachery_lookup_found_ttl = 0
+            self._kachery_lookup_not_found_ttl = 0
+
+    def memoStats(self) -> dict:
+        """Return the hit and miss counters of the memo (see configMemo()).
+
+        Returns
+        -------
+        dict
+            num_hits, num_misses, num_entries and num_bytes
+        """
+        if self._memo is None:
+            return dict(num_hits=0, num_misses=0, num_entries=0, num_bytes=0)
+        return self._memo.stats()
+
+    def configHttp(self, *, pool_size: Optional[int]=None, num_retries: Optional[int]=None, timeout: Optional[Tuple[float, float]]=None) -> None:
+        """Configure the shared http connections used for pairio and kachery
+        requests and file downloads. Connections to each server are kept
+        alive and reused.
+
+        Parameters
+        ----------
+        pool_size : Optional[int], optional
+            The maximum number of connections kept open to each server
+            (default 16, or the MOUNTAIN_HTTP_POOL_SIZE environment variable)
+        num_retries : Optional[int], optional
+            The number of times failed requests are retried, with exponential
+            backoff (default 3, or the MOUNTAIN_HTTP_NUM_RETRIES environment
+            variable). 5xx responses and read timeouts are only retried for
+            idempotent requests (not POST).
+        timeout : Optional[Tuple[float, float]], optional
+            The (connect, read) timeout in seconds of requests that do not
+            set their own (default (10, 60))
+        """
+        get_http_pool().configure(pool_size=pool_size, num_retries=num_retries, timeout=timeout)
+
+    def httpMetrics(self) -> dict:
+        """Return per-host statistics of the http requests made by this
+        process.
+
+        Returns
+        -------
+        dict
+            For each host: num_requests, num_errors, num_retries,
+            num_bytes_received and elapsed_sec.
+        """
+        return get_http_pool().metrics()
+
+    def getConfig(self) -> dict:
+        """Return the configuration of this client: the pairio and kachery
+        servers and tokens, and the settings of configDownloadFrom(),
+        configVerbose() and configKacheryLookupCache(). It may be passed to
+        setConfig() of a client in another process.
+
+        Returns
+        -------
+        dict
+            The configuration
+        """
+        return dict(
+            pairio_url=self._pairio_url,
+            kachery_urls=dict(self._kachery_urls),
+            kachery_upload_tokens=dict(self._kachery_upload_tokens),
+            kachery_download_tokens=dict(self._kachery_download_tokens),
+            pairio_tokens=dict(self._pairio_tokens),
+            download_from=list(self._config_download_from),
+            verbose=self._verbose,
+            kachery_lookup_found_ttl=self._kachery_lookup_found_ttl,
+            kachery_lookup_not_found_ttl=self._kachery_lookup_not_found_ttl
+        )
+
+    def setConfig(self, config: dict) -> None:
+        """Set the configuration of this client (see getConfig()).
+
+        Parameters
+        ----------
+        config : dict
+            The configuration returned by getConfig()
+        """
+        self._pairio_url = config['pairio_url']
+        self._kachery_urls = dict(config['kachery_urls'])
+        self._kachery_upload_tokens = dict(config['kachery_upload_tokens'])
+        self._kachery_download_tokens = dict(config['kachery_download_tokens'])
+        self._pairio_tokens = dict(config['pairio_tokens'])
+        self._config_download_from = list(config['download_from'])
+        self.configVerbose(config['verbose'])
+        self._kachery_lookup_found_ttl = config['kachery_lookup_found_ttl']
+        self._kachery_lookup_not_found_ttl = config['kachery_lookup_not_found_ttl']
+
     @mtlogging.log(name='MountainClient:getValue')
     def getValue(self, *,
                  key: StrOrDict,
@@ -228,8 +397,17 @@ class MountainClient():
         str or None
             The string if found in the database. Otherwise returns None.
         """
-        ret = self._get_value(key=key, subkey=subkey,
-                              collection=collection, check_alt=check_alt)
+        if self._memo is not None:
+            key_str = _memo_key_str(key)
+            memo_key = ('value', collection, key_str, subkey, check_alt)
+            found, ret = self._memo.get(memo_key)
+            if not found:
+                ret = self._get_value(key=key, subkey=subkey,
+                                      collection=collection, check_alt=check_alt)
+                self._memo.set(memo_key, ret, ttl=self._memo_key_ttl, group=('value', collection, key_str))
+        else:
+            ret = self._get_value(key=key, subkey=subkey,
+                                  collection=collection, check_alt=check_alt)
         if parse_json and ret:
             try:
                 ret = json.loads(ret)
@@ -238,6 +416,40 @@ class MountainClient():
                 return None
         return ret
 
+    def getValues(self, *,
+                  keys: List[StrOrDict],
+                  collection: Optional[str]=None,
+                  check_alt: bool=False
+                  ) -> List[Optional[str]]:
+        """
+        Retrieve the values of many keys (without subkeys) at once. With the
+        sqlite backend of the local database (see MOUNTAIN_DB_BACKEND) this
+        is one query per shard, which is much faster than calling getValue()
+        for each key. With the default files backend, and for remote
+        collections, the keys are still looked up one at a time. The memo
+        (see configMemo()) is not used.
+
+        Parameters
+        ----------
+        keys : list of str or dict
+            The keys used to look up the values
+        collection : str, optional
+            The name of the remote pairio collection from which to retrieve the
+            values. If not specified, the local key/value database will be
+            used.
+        check_alt : bool, optional
+            Whether to check alternate locations [may be deprecated soon]
+
+        Returns
+        -------
+        list of str or None
+            The values, in the same order as the keys (None for keys that
+            were not found)
+        """
+        if collection:
+            return [self._get_value(key=key, subkey=None, collection=collection, check_alt=check_alt) for key in keys]
+        return self._local_db.getValues(keys=keys, check_alt=check_alt)
+
     @mtlogging.log(name='MountainClient:setValue')
     def setValue(self, *, key: StrOrDict, subkey: Optional[str]=None, value: Union[str, None], overwrite: bool=True, collection: Optional[str]=None) -> bool:
         """
@@ -270,7 +482,11 @@ class MountainClient():
         bool
             True if successful
         """
-        return self._set_value(key=key, subkey=subkey, value=value, overwrite=overwrite, collection=collection)
+        try:
+            return self._set_value(key=key, subkey=subkey, value=value, overwrite=overwrite, collection=collection)
+        finally:
+            if self._memo is not None:
+                self._memo.invalidateGroup(('value', collection, _memo_key_str(key)))
 
     @mtlogging.log(name='MountainClient:getSubKeys')
     def getSubKeys(self, key: StrOrDict, collection: str=None) -> Optional[List[str]]:
@@ -328,16 +544,27 @@ class MountainClient():
             if not path:
                 return None
 
+        # content-addressed files never change
+        memo_key = None
+        if (self._memo is not None) and (key is None) and path and (path.startswith('sha1://') or path.startswith('sha1dir://')):
+            memo_key = ('text', path)
+            found, txt = self._memo.get(memo_key)
+            if found:
+                return txt
+
         fname = self.realizeFile(
             key=key, path=path, subkey=subkey, collection=collection, download_from=download_from, local_only=local_only, remote_only=remote_only)
         if fname is None:
             return None
         try:
             with open(fname) as f:
-                return f.read()
+                txt = f.read()
         except:
             print('Unexpected problem reading file in loadText: ' + fname)
             return None
+        if memo_key is not None:
+            self._memo.set(memo_key, txt)
+        return txt
 
     @mtlogging.log(name='MountainClient:saveText')
     def saveText(self, text: str, *,
@@ -682,11 +909,254 @@ class MountainClient():
                 return None
         return self._realize_file(path=path, resolve_locally=False, local_only=local_only, remote_only=remote_only, download_from=download_from)
 
+    @mtlogging.log(name='MountainClient:findFiles')
+    def findFiles(self, paths: List[str], *,
+                  local_only: bool=False,
+                  remote_only: bool=False,
+                  download_from: Optional[StrOrStrList]=None
+                  ) -> List[Optional[str]]:
+        """
+        Batch version of findFile(). The files that are not found locally are
+        looked up on each remote kachery with a single batch request (or with
+        concurrent single requests for kachery servers that do not support
+        batch checks).
+
+        Parameters
+        ----------
+        paths : List[str]
+            The paths or URIs of the files to find.
+        local_only : bool, optional
+            Whether to only find the files locally, by default False
+        remote_only : bool, optional
+            Whether to only find the files remotely, by default False
+        download_from : Optional[StrOrStrList], optional
+            The names of the remote kacheries to search, by default None
+
+        Returns
+        -------
+        List[Optional[str]]
+            For each path, either the local path of the file, the http URL of
+            the remote file, or None if the file was not found.
+        """
+        ret: List[Optional[str]] = [None for _ in paths]
+        remote_sha1s: List[Tuple[int, str]] = []
+        for ii, path in enumerate(paths):
+            if path and path.startswith('key://'):
+                path = self.resolveKeyPath(path)
+                if not path:
+                    continue
+            if not remote_only:
+                ret[ii] = self._local_db.realizeFile(path=path, local_only=local_only, resolve_locally=False)
+                if ret[ii]:
+                    continue
+            if local_only:
+                continue
+            if path.startswith('sha1://') or path.startswith('sha1dir://'):
+                sha1 = self.computeFileSha1(path)
+                if sha1:
+                    remote_sha1s.append((ii, sha1))
+        for df0 in self._get_download_froms(download_from):
+            if not remote_sha1s:
+                break
+            found = self._find_many_on_kachery(download_from=df0, sha1s=[sha1 for _, sha1 in remote_sha1s])
+            not_found: List[Tuple[int, str]] = []
+            for (ii, sha1), (url, size) in zip(remote_sha1s, found):
+                if url and (size is not None):
+                    ret[ii] = url
+                else:
+                    not_found.append((ii, sha1))
+            remote_sha1s = not_found
+        return ret
+
+    @mtlogging.log(name='MountainClient:prefetchFiles')
+    def prefetchFiles(self, paths: List[str], *,
+                      num_workers: int=4,
+                      max_bytes: Optional[int]=None,
+                      max_bytes_per_sec: Optional[float]=None,
+                      download_from: Optional[StrOrStrList]=None,
+                      verbose: bool=False
+                      ) -> dict:
+        """
+        Download files into the local SHA-1 cache ahead of time, so that
+        later calls to realizeFile() do not block. The files are deduplicated
+        by SHA-1, those that are already local are skipped, the others are
+        looked up on the kacheries with batch requests and then downloaded
+        concurrently.
+
+        Parameters
+        ----------
+        paths : List[str]
+            The paths or URIs of the files. Local paths are ignored.
+        num_workers : int, optional
+            The number of files downloaded concurrently, by default 4
+        max_bytes : Optional[int], optional
+            The maximum total number of bytes to download, by default None (no
+            limit). Files beyond the limit (in the given order) are skipped.
+        max_bytes_per_sec : Optional[float], optional
+            The maximum total download rate, by default None (no limit). It
+            applies to all downloads of this process while prefetching.
+        download_from : Optional[StrOrStrList], optional
+            The names of the remote kacheries to download from, by default
+            None (the configured kacheries)
+        verbose : bool, optional
+            Print the files that are downloaded, by default False
+
+        Returns
+        -------
+        dict
+            Statistics: num_files (distinct files), num_local, num_downloaded,
+            num_bytes_downloaded, num_skipped (beyond max_bytes),
+            num_not_found, num_failed and elapsed_sec
+        """
+        timer = time.time()
+        ret = dict(num_files=0, num_local=0, num_downloaded=0, num_bytes_downloaded=0, num_skipped=0, num_not_found=0, num_failed=0, elapsed_sec=0.0)
+        sha1s: List[str] = []
+        sha1s_set = set()
+        for path in paths:
+            try:
+                path = self._maybe_resolve(path)
+            except KeyError:
+                ret['num_not_found'] += 1
+                continue
+            if not (path.startswith('sha1://') or path.startswith('sha1dir://')):
+                continue
+            sha1 = self.computeFileSha1(path)
+            if not sha1:
+                ret['num_not_found'] += 1
+                continue
+            if sha1 not in sha1s_set:
+                sha1s.append(sha1)
+                sha1s_set.add(sha1)
+        ret['num_files'] = len(sha1s)
+
+        remote_sha1s: List[str] = []
+        for sha1 in sha1s:
+            if self._local_db.realizeFile(path='sha1://' + sha1, local_only=True):
+                ret['num_local'] += 1
+            else:
+                remote_sha1s.append(sha1)
+
+        found: dict = dict()
+        for df0 in self._get_download_froms(download_from):
+            not_found = [sha1 for sha1 in remote_sha1s if sha1 not in found]
+            if not not_found:
+                break
+            for sha1, (url, size) in zip(not_found, self._find_many_on_kachery(download_from=df0, sha1s=not_found)):
+                if url and (size is not None):
+                    found[sha1] = (url, size)
+
+        to_download: List[Tuple[str, str, int]] = []
+        num_bytes = 0
+        for sha1 in remote_sha1s:
+            if sha1 not in found:
+                ret['num_not_found'] += 1
+                continue
+            url, size = found[sha1]
+            if (max_bytes is not None) and (num_bytes + size > max_bytes):
+                ret['num_skipped'] += 1
+                continue
+            num_bytes = num_bytes + size
+            to_download.append((sha1, url, size))
+
+        def download(item: Tuple[str, str, int]) -> bool:
+            sha1, url, size = item
+            if verbose:
+                print('Prefetching sha1://{} ({} bytes)'.format(sha1, size))
+            try:
+                return bool(self._local_db.realizeFileFromUrl(url=url, sha1=sha1, size=size))
+            except:
+                traceback.print_exc()
+                print('WARNING: unable to prefetch file: sha1://{}'.format(sha1))
+                return False
+
+        if to_download:
+            with download_rate_limit(max_bytes_per_sec):
+                with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                    results = list(executor.map(download, to_download))
+            for (_, _, size), result in zip(to_download, results):
+                if result:
+                    ret['num_downloaded'] += 1
+                    ret['num_bytes_downloaded'] += size
+                else:
+                    ret['num_failed'] += 1
+        ret['elapsed_sec'] = time.time() - timer
+        return ret
+
+    @mtlogging.log(name='MountainClient:openFile')
+    def openFile(self, path: str, *,
+                 local_only: bool=False,
+                 remote_only: bool=False,
+                 download_from: Optional[StrOrStrList]=None,
+                 block_size: int=1024 * 1024
+                 ) -> Optional[Any]:
+        """
+        Open a file for reading without downloading it. Returns a seekable,
+        read-only binary file object, or None if the file is not found.
+
+        Local files (including files in the local cache) are read through a
+        memory map. Remote files are read with http range requests, in blocks
+        of block_size bytes. Recently read blocks are kept in memory, and for
+        sha1:// and sha1dir:// content they are also stored in the local
+        cache, so they are not fetched again.
+
+        Parameters
+        ----------
+        path : str
+            The path or URI of the file (local path, sha1://, sha1dir://,
+            key:// or http(s)://).
+        local_only : bool, optional
+            Whether to only open the file if it is available locally, by
+            default False
+        remote_only : bool, optional
+            Whether to only open the file remotely, by default False
+        download_from : Optional[StrOrStrList], optional
+            The names of the remote kacheries to search, by default None
+        block_size : int, optional
+            The size of the blocks fetched by range requests, by default 1 MiB
+
+        Returns
+        -------
+        Optional[Any]
+            The file object (use it as a context manager or close it).
+        """
+        if path and path.startswith('key://'):
+            path = self.resolveKeyPath(path)
+            if not path:
+                return None
+        is_http = path.startswith('http://') or path.startswith('https://')
+        if (not remote_only) and (path.startswith('sha1://') or path.startswith('sha1dir://')):
+            # read chunked or compressed content without expanding it
+            sha1 = self.computeFileSha1(path)
+            f = self._local_db.openFile(sha1) if sha1 else None
+            if f is not None:
+                return f
+        if (not remote_only) and (not is_http):
+            local_path = self._local_db.realizeFile(path=path, local_only=local_only, resolve_locally=False)
+            if local_path:
+                return MmapFile(local_path)
+        if local_only:
+            return None
+        if is_http:
+            response = get_http_pool().request('HEAD', path, allow_redirects=True)
+            if (response.status_code != 200) or ('content-length' not in response.headers):
+                return None
+            return HttpRangeFile(path, size=int(response.headers['content-length']), block_size=block_size)
+        if path.startswith('sha1://') or path.startswith('sha1dir://'):
+            sha1 = self.computeFileSha1(path)
+            if not sha1:
+                return None
+            for df0 in self._get_download_froms(download_from):
+                url, size = self._find_on_kachery(download_from=df0, sha1=sha1)
+                if url and (size is not None):
+                    return HttpRangeFile(url, size=size, block_size=block_size, block_cache_dir=self._local_db.blockCacheDir(sha1))
+        return None
+
     def createSnapshot(self, path: str, *,
                        upload_to: Optional[StrOrStrList]=None,
                        download_recursive=False,
                        upload_recursive=False,
-                       dest_path: Optional[str]=None
+                       dest_path: Optional[str]=None,
+                       num_upload_workers: int=4
                        ) -> Optional[str]:
         """
         Create an immutable snapshot of a file or directory, optionally upload
@@ -710,6 +1180,11 @@ class MountainClient():
         dest_path : Optional[str], optional
             A key:// path where the returned URI is stored on pairio, by default
             None.
+        num_upload_workers : int, optional
+            When uploading recursively, the number of files uploaded
+            concurrently, by default 4. Files that are already on the kachery
+            are skipped, so an interrupted upload can be resumed by calling
+            createSnapshot() again.
         
         Returns
         -------
@@ -749,7 +1224,7 @@ class MountainClient():
                     print('Problem saving files to local cache.')
                     return None
             if upload_to and upload_recursive:
-                if not self._create_snapshot_helper_save_dd(basepath=path, dd=dd, upload_to=upload_to):
+                if not self._create_snapshot_helper_save_dd(basepath=path, dd=dd, upload_to=upload_to, num_upload_workers=num_upload_workers):
                     print('Problem saving files to local cache.')
                     return None
 
@@ -787,7 +1262,8 @@ class MountainClient():
                         upload_to: Optional[StrOrStrList]=None,
                         download_recursive=False,
                         upload_recursive=False,
-                        dest_paths=None
+                        dest_paths=None,
+                        num_upload_workers: int=4
                         ) -> List[Optional[str]]:
         """Create multiple snapshots. See createSnapshot().
         
@@ -803,6 +1279,8 @@ class MountainClient():
             Same as upload_recursive in createSnapshot(), by default False
         dest_paths : [type], optional
             A list of dest_paths as in createSnapshot(), by default None
+        num_upload_workers : int, optional
+            Same as num_upload_workers in createSnapshot(), by default 4
         
         Returns
         -------
@@ -814,7 +1292,7 @@ class MountainClient():
             dest_paths = [None for path in paths]
         return [
             self.createSnapshot(path=path, upload_to=upload_to, download_recursive=download_recursive,
-                                upload_recursive=upload_recursive, dest_path=dest_paths[ii])
+                                upload_recursive=upload_recursive, dest_path=dest_paths[ii], num_upload_workers=num_upload_workers)
             for ii, path in enumerate(paths)
         ]
 
@@ -972,6 +1450,38 @@ class MountainClient():
         except KeyError:
             return None
 
+    @mtlogging.log(name='MountainClient:computeFileSha1s')
+    def computeFileSha1s(self, paths: List[str], *, num_workers: int=8) -> List[Optional[str]]:
+        """Return the SHA-1 hashes of many local or remote files at once. This
+        is much faster than calling computeFileSha1() in a loop: local files
+        are stat'ed up front, previously computed hashes are retrieved from the
+        local cache index in a single query, and the remaining files are hashed
+        in parallel.
+
+        Parameters
+        ----------
+        paths : List[str]
+            The paths to local files or sha1:// or sha1dir:// URIs.
+        num_workers : int, optional
+            The number of threads used to hash files that are not yet in the
+            cache index, by default 8
+
+        Returns
+        -------
+        List[Optional[str]]
+            The SHA-1 file hashes (None for files that do not exist), in the
+            same order as paths.
+        """
+        resolved_paths: List[str] = []
+        for path in paths:
+            try:
+                resolved_paths.append(self._maybe_resolve(path))
+            except KeyError:
+                resolved_paths.append('')
+        ret = self._local_db.computeFileSha1s(paths=[path for path in resolved_paths if path], num_workers=num_workers)
+        ret_iter = iter(ret)
+        return [next(ret_iter) if path else None for path in resolved_paths]
+
     def sha1OfObject(self, obj: dict) -> str:
         """Compute the SHA-1 hash of a simple dict as the SHA-1 hash
         of the JSON text generated in a reproducible way.
@@ -1121,6 +1631,85 @@ class MountainClient():
             admin_token=admin_token
         )
 
+    def pinFiles(self, paths: List[str]) -> Any:
+        """Protect the locally cached files for these sha1:// or sha1dir:// URIs
+        from eviction by cleanupLocalCache() while the returned context is
+        active. Other paths are ignored.
+
+        Example usage:
+        ```
+        with mt.pinFiles(job.getFilesToRealize()):
+            # run the job
+        ```
+
+        Parameters
+        ----------
+        paths : List[str]
+            The sha1:// or sha1dir:// URIs of the files to pin.
+
+        Returns
+        -------
+        Any
+            A context manager that releases the pins on exit (or when its
+            release() method is called).
+        """
+        return self._local_db.pinFiles(paths)
+
+    @mtlogging.log(name='MountainClient:cleanupLocalCache')
+    def cleanupLocalCache(self, *, max_bytes: Optional[int]=None, policy: str='lru', dry_run: bool=False, verbose: bool=False, compress_idle_sec: Optional[float]=None, shared_max_bytes: Optional[int]=None) -> dict:
+        """Garbage collect the local cache directory. Stale index entries,
+        orphaned .record.json, .hints.json and .lock files, and abandoned
+        temporary files are removed. If compress_idle_sec is given, files that
+        have not been accessed for that long are compressed (they are expanded
+        again when realized). If max_bytes is given, cached files are evicted
+        until the cache is at most that size. Files pinned by running jobs
+        (see pinFiles()) are never evicted. If there is a shared cache tier
+        (SHA1_CACHE_SHARED_DIR), pending write-backs are written to it first,
+        and it is cleaned up to shared_max_bytes if that is given. Expired
+        records of kachery lookups (see configKacheryLookupCache()) are
+        removed from the local database.
+
+        Parameters
+        ----------
+        max_bytes : Optional[int], optional
+            The maximum total size of the cached files, by default None (no
+            eviction)
+        policy : str, optional
+            'lru' (least recently accessed first) or 'largest' (largest first),
+            by default 'lru'
+        dry_run : bool, optional
+            Only report what would be evicted, by default False
+        verbose : bool, optional
+            Print the evicted files, by default False
+        compress_idle_sec : Optional[float], optional
+            Compress the files that have not been accessed for this number of
+            seconds, by default None (no compression)
+        shared_max_bytes : Optional[int], optional
+            The maximum total size of the shared cache tier, by default None
+            (the shared tier is not cleaned up)
+
+        Returns
+        -------
+        dict
+            Statistics of the cleanup.
+        """
+        ret = self._local_db.cleanupLocalCache(max_bytes=max_bytes, policy=policy, dry_run=dry_run, verbose=verbose, compress_idle_sec=compress_idle_sec, shared_max_bytes=shared_max_bytes)
+        ret['num_kachery_lookups_removed'] = self._prune_kachery_lookups() if not dry_run else 0
+        return ret
+
+    def cacheTierStats(self) -> dict:
+        """Returns the lookup statistics of the local cache in this process:
+        local_hits, shared_hits (files promoted from the shared tier), misses,
+        num_bytes_promoted, num_files_written_to_shared and
+        num_bytes_written_to_shared.
+
+        Returns
+        -------
+        dict
+            The statistics
+        """
+        return self._local_db.cacheTierStats()
+
     def localCacheDir(self) -> str:
         """Returns the path of the directory used for the local cache.
         
@@ -1141,6 +1730,17 @@ class MountainClient():
         """
         return self._local_db.alternateLocalCacheDirs()
 
+    def localDatabasePath(self) -> str:
+        """Returns the path of the directory used for the local key/value
+        database (see setValue() and getValue()).
+
+        Returns
+        -------
+        str
+            Path to the database directory.
+        """
+        return self._local_db.localDatabasePath()
+
     @mtlogging.log(name='MountainClient:getSha1Url')
     def getSha1Url(self, path: str, *, basename: Optional[str]=None) -> Optional[str]:
         """Return a sha1:// URI representing the file.
@@ -1310,16 +1910,7 @@ class MountainClient():
                 return None
             path = 'sha1://' + sha1
             # the proceed
-        download_froms: List[str] = []
-        if download_from is not None:
-            if type(download_from) == str:
-                download_froms.append(str(download_from))
-            else:
-                download_froms.extend(download_from)
-        else:
-            # behovior changed on 6/15/19... if download_from is explicitly given then don't use configured kacheries
-            for kname in self._config_download_from:
-                download_froms.append(kname)
+        download_froms = self._get_download_froms(download_from)
         if path.startswith('sha1://'):
             list0 = path.split('/')
             sha1 = list0[2]
@@ -1327,11 +1918,28 @@ class MountainClient():
                 url, size = self._find_on_kachery(download_from=df0, sha1=sha1)
                 if url and (size is not None):
                     if resolve_locally:
-                        return self._local_db.realizeFileFromUrl(url=url, sha1=sha1, size=size, dest_path=dest_path, show_progress=show_progress)
+                        ret = self._local_db.realizeFileFromUrl(url=url, sha1=sha1, size=size, dest_path=dest_path, show_progress=show_progress)
+                        if ret is None:
+                            # don't rely on the recorded lookup next time
+                            self._forget_kachery_lookup(download_from=df0, sha1=sha1)
+                        return ret
                     else:
                         return url
         return None
 
+    def _get_download_froms(self, download_from: Optional[StrOrStrList]) -> List[str]:
+        download_froms: List[str] = []
+        if download_from is not None:
+            if type(download_from) == str:
+                download_froms.append(str(download_from))
+            else:
+                download_froms.extend(download_from)
+        else:
+            # behovior changed on 6/15/19... if download_from is explicitly given then don't use configured kacheries
+            for kname in self._config_download_from:
+                download_froms.append(kname)
+        return download_froms
+
     @mtlogging.log()
     def _save_file(self, *,
                    path: str,
@@ -1376,16 +1984,21 @@ class MountainClient():
                            path: str,
                            sha1: str,
                            kachery_url: str,
-                           upload_token: Optional[str]
+                           upload_token: Optional[str],
+                           check_first: bool=True
                            ) -> bool:
-        url_check_path0 = '/check/sha1/' + sha1
-        url_check = kachery_url + url_check_path0
-        resp_obj = _http_get_json(url_check, verbose=self._verbose)
-        if not resp_obj['success']:
-            print('Warning: Problem checking for upload: ' + resp_obj['error'])
-            return False
+        if check_first:
+            url_check_path0 = '/check/sha1/' + sha1
+            url_check = kachery_url + url_check_path0
+            resp_obj = _http_get_json(url_check, verbose=self._verbose)
+            if not resp_obj['success']:
+                print('Warning: Problem checking for upload: ' + resp_obj['error'])
+                return False
+            found = resp_obj['found']
+        else:
+            found = False
 
-        if not resp_obj['found']:
+        if not found:
             url_path0 = '/set/sha1/' + sha1
             signature = _sha1_of_object(
                 {'path': url_path0, 'token': upload_token})
@@ -1406,6 +2019,7 @@ class MountainClient():
             if not resp_obj.get('success', False):
                 print('Problem posting file data: ' + resp_obj.get('error', ''))
                 return False
+            self._record_kachery_lookup(kachery_url=kachery_url, sha1=sha1, size=size0)
             return True
         else:
             # print('Already on server (***)')
@@ -1418,57 +2032,185 @@ class MountainClient():
         kachery_url = self._resolve_kachery_url(download_from)
 
         if kachery_url:
-            check_url = kachery_url + '/check/sha1/' + sha1
-            try:
-                obj = _http_get_json(check_url, verbose=self._verbose)
-            except:
-                traceback.print_exc()
-                print('WARNING: failed in check to kachery {}: {}'.format(
-                    download_from, check_url))
-                return (None, None)
-            if not obj['success']:
-                print('WARNING: problem checking kachery {}: {}'.format(
-                    download_from, check_url))
-                return (None, None)
-            if not obj['found']:
-                return (None, None)
-            url0 = kachery_url + '/get/sha1/' + sha1
-            if download_from in self._kachery_download_tokens:
-                download_token0 = self._kachery_download_tokens[download_from]
-                url_path0 = '/get/sha1/' + sha1
-                signature0 = _sha1_of_object(
-                    {'path': url_path0, 'token': download_token0})
-                url0 = url0 + '?signature=' + signature0
-            return (url0, obj['size'])
+            recorded = self._get_kachery_lookup(kachery_url=kachery_url, sha1=sha1)
+            if recorded is not None:
+                return self._kachery_lookup_result(download_from=download_from, kachery_url=kachery_url, sha1=sha1, size=recorded)
+            return self._check_on_kachery(download_from=download_from, kachery_url=kachery_url, sha1=sha1)
 
         return (None, None)
 
+    def _check_on_kachery(self, *,
+                          download_from: str,
+                          kachery_url: str,
+                          sha1: str
+                          ) -> Tuple[Optional[str], Optional[int]]:
+        check_url = kachery_url + '/check/sha1/' + sha1
+        try:
+            obj = _http_get_json(check_url, verbose=self._verbose)
+        except:
+            traceback.print_exc()
+            print('WARNING: failed in check to kachery {}: {}'.format(
+                download_from, check_url))
+            return (None, None)
+        if not obj['success']:
+            print('WARNING: problem checking kachery {}: {}'.format(
+                download_from, check_url))
+            return (None, None)
+        if not obj['found']:
+            self._record_kachery_lookup(kachery_url=kachery_url, sha1=sha1, size=None)
+            return (None, None)
+        self._record_kachery_lookup(kachery_url=kachery_url, sha1=sha1, size=obj['size'])
+        return (self._kachery_download_url(download_from=download_from, kachery_url=kachery_url, sha1=sha1), obj['size'])
+
+    @mtlogging.log()
+    def _find_many_on_kachery(self, *,
+                              download_from: str,
+                              sha1s: List[str]
+                              ) -> List[Tuple[Optional[str], Optional[int]]]:
+        # Batch version of _find_on_kachery(), using the POST /check/sha1
+        # endpoint, or concurrent single checks for servers that don't have it
+        ret: List[Tuple[Optional[str], Optional[int]]] = [(None, None) for _ in sha1s]
+        kachery_url = self._resolve_kachery_url(download_from)
+        if (not kachery_url) or (not sha1s):
+            return ret
+        # only ask the kachery about the files without a recorded lookup
+        inds: List[int] = []
+        for ii, sha1 in enumerate(sha1s):
+            recorded = self._get_kachery_lookup(kachery_url=kachery_url, sha1=sha1)
+            if recorded is not None:
+                ret[ii] = self._kachery_lookup_result(download_from=download_from, kachery_url=kachery_url, sha1=sha1, size=recorded)
+            else:
+                inds.append(ii)
+        if not inds:
+            return ret
+        if _kachery_batch_check_supported.get(kachery_url, True):
+            check_url = kachery_url + '/check/sha1'
+            for ii in range(0, len(inds), _KACHERY_BATCH_CHECK_SIZE):
+                chunk_inds = inds[ii:ii + _KACHERY_BATCH_CHECK_SIZE]
+                chunk = [sha1s[ind] for ind in chunk_inds]
+                try:
+                    resp = get_http_pool().request('POST', check_url, json=dict(sha1s=chunk))
+                except:
+                    traceback.print_exc()
+                    print('WARNING: failed in batch check to kachery {}: {}'.format(download_from, check_url))
+                    return ret
+                if resp.status_code == 404:
+                    # older kachery server
+                    _kachery_batch_check_supported[kachery_url] = False
+                    break
+                try:
+                    obj = resp.json()
+                except:
+                    obj = dict()
+                if (resp.status_code != 200) or (not obj.get('success', False)) or (len(obj.get('results', [])) != len(chunk)):
+                    print('WARNING: problem in batch check to kachery {}: {}'.format(download_from, check_url))
+                    return ret
+                for ind, sha1, result in zip(chunk_inds, chunk, obj['results']):
+                    size = result['size'] if result['found'] else None
+                    self._record_kachery_lookup(kachery_url=kachery_url, sha1=sha1, size=size)
+                    ret[ind] = self._kachery_lookup_result(download_from=download_from, kachery_url=kachery_url, sha1=sha1, size=size)
+            else:
+                return ret
+        with ThreadPoolExecutor(max_workers=min(_KACHERY_CHECK_NUM_WORKERS, len(inds))) as executor:
+            results = list(executor.map(lambda ind: self._check_on_kachery(download_from=download_from, kachery_url=kachery_url, sha1=sha1s[ind]), inds))
+        for ind, result in zip(inds, results):
+            ret[ind] = result
+        return ret
+
+    def _get_kachery_lookup(self, *, kachery_url: str, sha1: str) -> Optional[int]:
+        # Returns the recorded size of the file on the kachery, -1 if it was
+        # recorded as not found, or None if there is no (recent) record
+        if (self._kachery_lookup_found_ttl <= 0) and (self._kachery_lookup_not_found_ttl <= 0):
+            return None
+        try:
+            txt = self._local_db.getValue(key=_kachery_lookup_key(sha1), subkey=_kachery_lookup_subkey(kachery_url, sha1))
+        except:
+            print('Warning: unable to read recorded kachery lookup for: ' + sha1)
+            return None
+        if txt is None:
+            return None
+        try:
+            obj = json.loads(txt)
+            size = obj['size']
+        except:
+            return None
+        if self._kachery_lookup_expired(obj):
+            return None
+        return size if size is not None else -1
+
+    def _kachery_lookup_expired(self, obj: dict) -> bool:
+        ttl = self._kachery_lookup_found_ttl if obj['size'] is not None else self._kachery_lookup_not_found_ttl
+        elapsed = time.time() - obj['timestamp']
+        return (elapsed < 0) or (elapsed > ttl)
+
+    def _record_kachery_lookup(self, *, kachery_url: str, sha1: str, size: Optional[int]) -> None:
+        ttl = self._kachery_lookup_found_ttl if size is not None else self._kachery_lookup_not_found_ttl
+        if ttl <= 0:
+            return
+        try:
+            self._local_db.setValue(key=_kachery_lookup_key(sha1), subkey=_kachery_lookup_subkey(kachery_url, sha1), value=json.dumps(dict(size=size, timestamp=time.time())), overwrite=True)
+        except:
+            print('Warning: unable to record kachery lookup for: ' + sha1)
+
+    def _forget_kachery_lookup(self, *, download_from: str, sha1: str) -> None:
+        kachery_url = self._resolve_kachery_url(download_from)
+        if not kachery_url:
+            return
+        try:
+            self._local_db.setValue(key=_kachery_lookup_key(sha1), subkey=_kachery_lookup_subkey(kachery_url, sha1), value=None, overwrite=True)
+        except:
+            pass
+
+    def _prune_kachery_lookups(self) -> int:
+        # Remove the expired records of kachery lookups. Returns the number removed.
+        num_removed = 0
+        for digit in '0123456789abcdef':
+            key = _kachery_lookup_key(digit)
+            try:
+                records = json.loads(self._local_db.getValue(key=key, subkey='-') or '{}')
+            except:
+                print('Warning: unable to read recorded kachery lookups.')
+                continue
+            for subkey, txt in records.items():
+                try:
+                    expired = self._kachery_lookup_expired(json.loads(txt))
+                except:
+                    expired = True
+                if not expired:
+                    continue
+                try:
+                    self._local_db.setValue(key=key, subkey=subkey, value=None, overwrite=True)
+                    num_removed += 1
+                except:
+                    # removed by another process
+                    pass
+        return num_removed
+
+    def _kachery_lookup_result(self, *, download_from: str, kachery_url: str, sha1: str, size: Optional[int]) -> Tuple[Optional[str], Optional[int]]:
+        if (size is None) or (size < 0):
+            return (None, None)
+        return (self._kachery_download_url(download_from=download_from, kachery_url=kachery_url, sha1=sha1), size)
+
+    def _kachery_download_url(self, *, download_from: str, kachery_url: str, sha1: str) -> str:
+        url0 = kachery_url + '/get/sha1/' + sha1
+        if download_from in self._kachery_download_tokens:
+            download_token0 = self._kachery_download_tokens[download_from]
+            url_path0 = '/get/sha1/' + sha1
+            signature0 = _sha1_of_object(
+                {'path': url_path0, 'token': download_token0})
+            url0 = url0 + '?signature=' + signature0
+        return url0
+
     def _read_file_system_dir(self, *,
                               path: str,
                               recursive: bool,
                               include_sha1: bool
                               ) -> Optional[dict]:
-        ret: dict = dict(
-            files={},
-            dirs={}
-        )
-        list0 = _safe_list_dir(path)
-        if list0 is None:
-            return None
-        for name0 in list0:
-            path0 = path + '/' + name0
-            if os.path.isfile(path0):
-                ret['files'][name0] = dict(
-                    size=os.path.getsize(path0)
-                )
-                if include_sha1:
-                    ret['files'][name0]['sha1'] = self.computeFileSha1(path0)
-            elif os.path.isdir(path0):
-                ret['dirs'][name0] = {}
-                if recursive:
-                    ret['dirs'][name0] = self._read_file_system_dir(
-                        path=path0, recursive=recursive, include_sha1=include_sha1)
-        return ret
+        # unchanged subdirectories and files are taken from the directory
+        # index cache (see dirindex.py); the missing sha1s are computed in a
+        # single batch
+        return self._local_db.dirIndexCache().readDir(
+            path, recursive=recursive, include_sha1=include_sha1, compute_file_sha1s=self.computeFileSha1s)
 
     def _parse_key_path(self, key_path: str) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str], Optional[str]]:
         list0 = key_path.split('/')
@@ -1489,23 +2231,85 @@ class MountainClient():
 
     def _create_snapshot_helper_save_dd(self, *,
                                         basepath: str, dd: dict,
-                                        upload_to: Optional[StrOrStrList]
+                                        upload_to: Optional[StrOrStrList],
+                                        num_upload_workers: int=4
                                         ) -> bool:
-        for fname in dd['files'].keys():
-            fpath = os.path.join(basepath, fname)
-            if not self.saveFile(path=fpath, upload_to=upload_to):
-                if not upload_to:
+        files: List[Tuple[str, Optional[str], int]] = []
+        self._create_snapshot_helper_collect_files(basepath=basepath, dd=dd, files=files)
+        if not upload_to:
+            for fpath, _, _ in files:
+                if not self.saveFile(path=fpath):
                     print('Unable to copy file to local cache: ' +
                           fpath, file=sys.stderr)
-                else:
-                    print('Unable to upload file: ' + fpath, file=sys.stderr)
+                    return False
+            return True
+        if type(upload_to) == str:
+            upload_to = [str(upload_to)]
+        for ut in upload_to:
+            if not self._upload_files_to_kachery(files=files, upload_to=ut, num_workers=num_upload_workers):
                 return False
+        return True
+
+    def _create_snapshot_helper_collect_files(self, *, basepath: str, dd: dict, files: List[Tuple[str, Optional[str], int]]) -> None:
+        for fname, file0 in dd['files'].items():
+            files.append((os.path.join(basepath, fname), file0.get('sha1', None), file0.get('size', 0)))
         for dname, dd0 in dd['dirs'].items():
-            dpath = os.path.join(basepath, dname)
-            if not self._create_snapshot_helper_save_dd(basepath=dpath, dd=dd0, upload_to=upload_to):
+            self._create_snapshot_helper_collect_files(basepath=os.path.join(basepath, dname), dd=dd0, files=files)
+
+    @mtlogging.log()
+    def _upload_files_to_kachery(self, *, files: List[Tuple[str, Optional[str], int]], upload_to: str, num_workers: int) -> bool:
+        # Upload many files to a kachery: one batch check to find the files
+        # that are already there (which also makes an interrupted upload
+        # resumable), then concurrent streaming uploads of the rest
+        kachery_url = self._resolve_kachery_url(upload_to)
+        if not kachery_url:
+            raise Exception(
+                'Unable to resolve kachery url for: {}'.format(upload_to))
+        if upload_to not in self._kachery_upload_tokens.keys():
+            raise Exception(
+                'Kachery upload token not found for: {}'.format(upload_to))
+        upload_token = self._kachery_upload_tokens[upload_to]
+
+        files_by_sha1: dict = dict()
+        for fpath, sha1, size in files:
+            if not sha1:
+                sha1 = self.computeFileSha1(fpath)
+                if not sha1:
+                    print('Unable to compute sha1 of file: ' + fpath, file=sys.stderr)
+                    return False
+            if sha1 not in files_by_sha1:
+                files_by_sha1[sha1] = (fpath, size)
+        sha1s = list(files_by_sha1.keys())
+        found = self._find_many_on_kachery(download_from=upload_to, sha1s=sha1s)
+        to_upload = [(files_by_sha1[sha1][0], sha1, files_by_sha1[sha1][1]) for sha1, (url, _) in zip(sha1s, found) if not url]
+        if not to_upload:
+            return True
+
+        progress = _TransferProgress(label='Uploaded', num_files=len(to_upload), num_bytes=sum([size for _, _, size in to_upload]))
+        print('Uploading {} files ({}) to {}; {} files were already there'.format(
+            len(to_upload), _format_file_size(progress.numBytes()), upload_to, len(sha1s) - len(to_upload)))
+
+        def upload_file(file: Tuple[str, str, int]) -> bool:
+            fpath, sha1, size = file
+            try:
+                path = self.realizeFile(fpath)
+                if not path:
+                    print('Unable to realize file for upload: ' + fpath, file=sys.stderr)
+                    return False
+                if not self._upload_to_kachery(path=path, sha1=sha1, kachery_url=kachery_url, upload_token=upload_token, check_first=False):
+                    print('Unable to upload file: ' + fpath, file=sys.stderr)
+                    return False
+            except Exception as e:
+                print('Unable to upload file {}: {}'.format(fpath, str(e)), file=sys.stderr)
                 return False
-        return True
-    
+            progress.addFile(size)
+            return True
+
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            results = list(executor.map(upload_file, to_upload))
+        progress.report(final=True)
+        return all(results)
+
     def _maybe_resolve(self, path: str) -> str:
         if not path or not path.startswith('key://'):
             return path
@@ -1522,11 +2326,10 @@ def _http_post_file_data(url: str, fname: str, verbose: Optional[bool]=None) ->
         verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
     if verbose:
         print('_http_post_file_data::: ' + fname)
-    with open(fname, 'rb') as f:
-        try:
-            obj = requests.post(url, data=f)
-        except:
-            raise Exception('Error posting file data.')
+    try:
+        obj = get_http_pool().request('POST', url, data_path=fname)
+    except:
+        raise Exception('Error posting file data.')
     if obj.status_code != 200:
         raise Exception('Error posting file data: {} {}'.format(
             obj.status_code, obj.content.decode('utf-8')))
@@ -1535,6 +2338,55 @@ def _http_post_file_data(url: str, fname: str, verbose: Optional[bool]=None) ->
     return json.loads(obj.content)
 
 
+def _memo_key_str(key: StrOrDict) -> str:
+    if (type(key) == dict) or (type(key) == list):
+        return json.dumps(key, sort_keys=True, separators=(',', ':'))
+    return str(key)
+
+
+def _kachery_lookup_key(sha1: str) -> dict:
+    return dict(name='kachery_lookups', shard=sha1[0])
+
+
+def _kachery_lookup_subkey(kachery_url: str, sha1: str) -> str:
+    return '{}-{}'.format(sha1, _sha1_of_string(kachery_url))
+
+
+class _TransferProgress():
+    # Thread-safe progress and throughput reporting for concurrent transfers
+    def __init__(self, *, label: str, num_files: int, num_bytes: int, interval: float=5):
+        self._label = label
+        self._num_files = num_files
+        self._num_bytes = num_bytes
+        self._interval = interval
+        self._num_files_done = 0
+        self._num_bytes_done = 0
+        self._timer = time.time()
+        self._last_report = self._timer
+        self._lock = threading.Lock()
+
+    def numBytes(self) -> int:
+        return self._num_bytes
+
+    def addFile(self, size: int) -> None:
+        with self._lock:
+            self._num_files_done += 1
+            self._num_bytes_done += size
+            if time.time() - self._last_report < self._interval:
+                return
+            self._last_report = time.time()
+        self.report()
+
+    def report(self, final: bool=False) -> None:
+        with self._lock:
+            elapsed = time.time() - self._timer
+            rate = self._num_bytes_done / elapsed if elapsed > 0 else 0
+            print('{} {} of {} files ({} of {}) in {:.1f} sec ({}/s){}'.format(
+                self._label, self._num_files_done, self._num_files,
+                _sizeof_fmt(self._num_bytes_done), _sizeof_fmt(self._num_bytes),
+                elapsed, _sizeof_fmt(rate), '' if final else '...'))
+
+
 # thanks: https://stackoverflow.com/questions/1094841/reusable-library-to-get-human-readable-version-of-file-size
 
 
@@ -1561,13 +2413,6 @@ def _create_temporary_file_for_text(*, text: str) -> str:
     return tmp_fname
 
 
-def _safe_list_dir(path: str) -> Optional[List[str]]:
-    try:
-        ret = os.listdir(path)
-        return ret
-    except:
-        return None
-
 if 'SHA1_CACHE_DIR' not in os.environ:
     if 'KBUCKET_CACHE_DIR' in os.environ:
         pass
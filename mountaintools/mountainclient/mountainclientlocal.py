@@ -4,8 +4,11 @@ import shutil
 import mtlogging
 import pathlib
 from .sha1cache import Sha1Cache
+from .dirindex import DirIndexCache
+from .openfile import MmapFile
 from .filelock import FileLock
-from typing import Union, List, Optional
+from .localkvstore import LocalKVStoreSqlite, get_local_kv_store, local_kv_store_exists
+from typing import Union, List, Optional, Any
 from .mttyping import StrOrDict
 from .aux import _read_text_file, _write_text_file, _sha1_of_string
 
@@ -24,6 +27,9 @@ class MountainClientLocal():
 
     def getSubKeys(self, *, key: Union[str, dict]) -> Optional[List[str]]:
         keyhash = _hash_of_key(key)
+        kvstore = self._get_kv_store()
+        if kvstore is not None:
+            return kvstore.getSubKeys(keyhash)
         subkey_db_path = self._get_subkey_file_path_for_keyhash(
             keyhash, _create=False)
         if not os.path.exists(subkey_db_path):
@@ -43,6 +49,11 @@ class MountainClientLocal():
         if subkey is not None:
             if check_alt:
                 raise Exception('Cannot use check_alt together with subkey.')
+            kvstore = self._get_kv_store(_db_path)
+            if kvstore is not None:
+                if subkey == '-':
+                    return json.dumps(kvstore.getSubKeyValues(keyhash))
+                return kvstore.getValue(keyhash, subkey)
             if subkey == '-':
                 subkeys = self.getSubKeys(key=key)
                 if subkeys is None:
@@ -64,24 +75,51 @@ class MountainClientLocal():
                     return txt
         else:
             # not a subkey
+            kvstore = self._get_kv_store(_db_path)
+            if kvstore is not None:
+                val = kvstore.getValue(keyhash)
+                if (val is None) and check_alt:
+                    return self._get_value_alt(key=key)
+                return val
             db_path = self._get_file_path_for_keyhash(
                 keyhash, _db_path=_db_path, _create=False)
             fname0 = db_path
             if not os.path.exists(fname0):
                 if check_alt:
-                    alternate_db_paths = self.alternateLocalDatabasePaths()
-                    for db_path in alternate_db_paths:
-                        val = self.getValue(
-                            key=key, subkey=None, check_alt=None, _db_path=db_path, _disable_lock=True)
-                        if val:
-                            return val
+                    return self._get_value_alt(key=key)
                 return None
             with FileLock(fname0 + '.lock', _disable_lock=_disable_lock, exclusive=False):
                 txt = _read_text_file(fname0)
                 return txt
 
+    def getValues(self, *, keys: List[StrOrDict], check_alt: bool=False, _db_path: Optional[str]=None) -> List[Optional[str]]:
+        kvstore = self._get_kv_store(_db_path)
+        if kvstore is not None:
+            ret = kvstore.getValues([_hash_of_key(key) for key in keys])
+        else:
+            ret = [self.getValue(key=key, _db_path=_db_path, _disable_lock=(_db_path is not None)) for key in keys]
+        if check_alt:
+            for db_path in self.alternateLocalDatabasePaths():
+                inds = [ii for ii, val in enumerate(ret) if val is None]
+                if not inds:
+                    break
+                vals = self.getValues(keys=[keys[ii] for ii in inds], _db_path=db_path)
+                for ii, val in zip(inds, vals):
+                    if val:
+                        ret[ii] = val
+        return ret
+
     def setValue(self, *, key: StrOrDict, subkey: Optional[str], value: Union[str, None], overwrite: bool) -> bool:
         keyhash = _hash_of_key(key)
+        kvstore = self._get_kv_store()
+        if kvstore is not None:
+            if subkey == '-':
+                if value is not None:
+                    raise Exception(
+                        'Cannot set all subkeys with value that is not None')
+                kvstore.removeSubKeys(keyhash)
+                return True
+            return kvstore.setValue(keyhash, subkey, value, overwrite=overwrite)
         if subkey is not None:
             if subkey == '-':
                 if value is not None:
@@ -213,6 +251,51 @@ class MountainClientLocal():
         else:
             return self._sha1_cache.computeFileSha1(path=path, _cache_only=_cache_only)
 
+    @mtlogging.log(name='MountainClientLocal:computeFileSha1s')
+    def computeFileSha1s(self, paths: List[str], *, num_workers: int=8, _cache_only: bool=False) -> List[Optional[str]]:
+        ret: List[Optional[str]] = [None for _ in paths]
+        local_inds = []
+        for ii, path in enumerate(paths):
+            if path.startswith('kbucket://') or path.startswith('sha1://') or path.startswith('sha1dir://'):
+                ret[ii] = self.computeFileSha1(path=path, _cache_only=_cache_only)
+            else:
+                local_inds.append(ii)
+        if local_inds:
+            sha1s = self._sha1_cache.computeFileSha1s(paths=[paths[ii] for ii in local_inds], num_workers=num_workers, _cache_only=_cache_only)
+            for ii, sha1 in zip(local_inds, sha1s):
+                ret[ii] = sha1
+        return ret
+
+    def pinFiles(self, paths: List[str]) -> Any:
+        sha1s = []
+        for path in paths:
+            if path.startswith('sha1://') or path.startswith('sha1dir://'):
+                # sha1dir:// paths are resolved using the directory object
+                sha1 = self.computeFileSha1(path=path)
+                if sha1:
+                    sha1s.append(sha1)
+        return self._sha1_cache.pinFiles(sha1s)
+
+    def cleanupLocalCache(self, *, max_bytes: Optional[int], policy: str, dry_run: bool, verbose: bool, compress_idle_sec: Optional[float]=None, shared_max_bytes: Optional[int]=None) -> dict:
+        return self._sha1_cache.cleanup(max_bytes=max_bytes, policy=policy, dry_run=dry_run, verbose=verbose, compress_idle_sec=compress_idle_sec, shared_max_bytes=shared_max_bytes)
+
+    def cacheTierStats(self) -> dict:
+        return self._sha1_cache.tierStats()
+
+    def openFile(self, sha1: str) -> Optional[Any]:
+        # a whole cached file is memory-mapped; otherwise it is read from the
+        # chunk store or the compressed tier
+        path = self._sha1_cache.findFile(sha1, _reassemble=False)
+        if path is not None:
+            return MmapFile(path)
+        return self._sha1_cache.openFile(sha1)
+
+    def blockCacheDir(self, sha1: str) -> str:
+        return self._sha1_cache.blockCacheDir(sha1)
+
+    def dirIndexCache(self) -> DirIndexCache:
+        return self._sha1_cache.dirIndexCache()
+
     def localCacheDir(self) -> str:
         return self._sha1_cache.directory()
 
@@ -225,6 +308,30 @@ class MountainClientLocal():
     def alternateLocalDatabasePaths(self) -> List[str]:
         return _get_default_alternate_local_db_paths()
 
+    def localDatabaseBackend(self) -> str:
+        return _get_local_db_backend()
+
+    def _get_value_alt(self, *, key: StrOrDict) -> Optional[str]:
+        alternate_db_paths = self.alternateLocalDatabasePaths()
+        for db_path in alternate_db_paths:
+            val = self.getValue(
+                key=key, subkey=None, check_alt=None, _db_path=db_path, _disable_lock=True)
+            if val:
+                return val
+        return None
+
+    def _get_kv_store(self, _db_path: Optional[str]=None) -> Optional[LocalKVStoreSqlite]:
+        # Returns None for databases that use the legacy file layout. The
+        # backend of the local database is configured (MOUNTAIN_DB_BACKEND)
+        # whereas alternate databases are read with whatever they contain.
+        if _db_path:
+            if local_kv_store_exists(_db_path):
+                return get_local_kv_store(_db_path)
+            return None
+        if _get_local_db_backend() == 'sqlite':
+            return get_local_kv_store(self.localDatabasePath())
+        return None
+
     def _get_file_path_for_keyhash(self, keyhash: str, *, _create: bool, _db_path: Optional[str]=None) -> str:
         if _db_path:
             database_path = _db_path
@@ -259,8 +366,9 @@ class MountainClientLocal():
         return path
 
     def _realize_file_from_sha1(self, *, sha1: str, dest_path: Optional[str]=None, show_progress: bool=False) -> Optional[str]:
-        # try to find the file in cache
-        fname = self._sha1_cache.findFile(sha1)
+        # try to find the file in cache (if it is only in the chunk store, it
+        # is reassembled directly at the destination)
+        fname = self._sha1_cache.findFile(sha1, _reassemble=(dest_path is None))
         if fname is not None:
             if (dest_path is not None) and (os.path.abspath(fname) != os.path.abspath(dest_path)):
                 if os.path.exists(dest_path):
@@ -274,11 +382,13 @@ class MountainClientLocal():
                     already_there = False
                 if not already_there:
                     if show_progress:
-                        print('Copying file {} -> {}'.format(fname, dest_path))
-                    shutil.copyfile(fname, dest_path)
-                    self._sha1_cache.reportFileSha1(dest_path, sha1)
+                        print('Materializing file ({}) {} -> {}'.format(self._sha1_cache.linkMode(), fname, dest_path))
+                    self._sha1_cache.materializeFile(sha1, fname, dest_path)
                 return os.path.abspath(dest_path)
             return os.path.abspath(fname)
+        if dest_path is not None:
+            if self._sha1_cache.reassembleFile(sha1, dest_path):
+                return os.path.abspath(dest_path)
         return None
 
 
@@ -302,6 +412,13 @@ def _get_default_local_db_path() -> str:
     return ret
 
 
+def _get_local_db_backend() -> str:
+    backend = os.environ.get('MOUNTAIN_DB_BACKEND', 'files')
+    if backend not in ['files', 'sqlite']:
+        raise Exception('Invalid local database backend: {}'.format(backend))
+    return backend
+
+
 def _get_default_alternate_local_db_paths() -> List[str]:
     val = os.environ.get('MOUNTAIN_DIR_ALT', None)
     if not val:
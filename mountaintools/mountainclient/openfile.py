@@ -0,0 +1,233 @@
+import io
+import os
+import mmap
+import random
+from .httppool import get_http_pool
+from .memo import LruMemo
+from typing import Optional, Dict, List
+
+# Seekable, read-only file objects returned by MountainClient.openFile().
+#
+# MmapFile reads a local file through a read-only memory map.
+#
+# HttpRangeFile reads a remote file with http range requests over the pooled
+# keep-alive session of the server. The content is fetched in fixed-size
+# blocks. Recently used blocks are kept in memory. For content-addressed files
+# (sha1://) the blocks are also stored on disk in the sha1 cache
+# (<cache>/blocks/<sha1>/), so that other processes and later sessions do not
+# fetch them again.
+
+_DEFAULT_BLOCK_SIZE = 1024 * 1024
+# The maximum number of consecutive missing blocks fetched with a single range request
+_MAX_BLOCKS_PER_REQUEST = 16
+_TIMEOUT = 60
+
+
+class MmapFile(io.RawIOBase):
+    def __init__(self, path: str):
+        """Read-only file object over a memory map of a local file"""
+        super().__init__()
+        self._path = path
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        # an empty file cannot be memory mapped
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._size > 0 else None
+        self._position = 0
+
+    def path(self) -> str:
+        return self._path
+
+    def size(self) -> int:
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        self._position = _seek_position(self._position, self._size, offset, whence)
+        return self._position
+
+    def readinto(self, b) -> int:
+        num = max(0, min(len(b), self._size - self._position))
+        if num > 0:
+            assert self._mmap is not None
+            b[0:num] = self._mmap[self._position:self._position + num]
+            self._position += num
+        return num
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+        super().close()
+
+
+class HttpRangeFile(io.RawIOBase):
+    def __init__(self, url: str, *, size: int, block_size: int=_DEFAULT_BLOCK_SIZE, block_cache_dir: Optional[str]=None, memory_cache_bytes: int=64 * 1024 * 1024):
+        """Read-only file object that reads a remote file with http range
+        requests
+
+        Parameters
+        ----------
+        url : str
+            The url of the file (the server must support range requests)
+        size : int
+            The size of the file
+        block_size : int, optional
+            The size of the blocks that are fetched, by default 1 MiB
+        block_cache_dir : Optional[str], optional
+            A directory in which to store the fetched blocks, by default None
+            (only use the memory cache). Only use this for immutable content.
+        memory_cache_bytes : int, optional
+            The maximum total size of the blocks kept in memory, by default 64 MiB
+        """
+        super().__init__()
+        self._url = url
+        self._size = size
+        self._block_size = block_size
+        self._block_cache_dir = block_cache_dir
+        self._memo = LruMemo(max_bytes=memory_cache_bytes)
+        self._position = 0
+        self._num_requests = 0
+        self._num_bytes_fetched = 0
+
+    def url(self) -> str:
+        return self._url
+
+    def size(self) -> int:
+        return self._size
+
+    def stats(self) -> dict:
+        return dict(num_requests=self._num_requests, num_bytes_fetched=self._num_bytes_fetched, memory_cache=self._memo.stats())
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        self._position = _seek_position(self._position, self._size, offset, whence)
+        return self._position
+
+    def readinto(self, b) -> int:
+        end = min(self._position + len(b), self._size)
+        if end <= self._position:
+            return 0
+        first_block = self._position // self._block_size
+        last_block = (end - 1) // self._block_size
+        blocks = self._get_blocks(first_block, last_block)
+        num = 0
+        for ii in range(first_block, last_block + 1):
+            block_start = ii * self._block_size
+            i1 = max(self._position, block_start) - block_start
+            i2 = min(end, block_start + len(blocks[ii])) - block_start
+            b[num:num + i2 - i1] = blocks[ii][i1:i2]
+            num = num + i2 - i1
+        self._position += num
+        return num
+
+    def _get_blocks(self, first_block: int, last_block: int) -> Dict[int, bytes]:
+        ret: Dict[int, bytes] = dict()
+        missing: List[int] = []
+        for ii in range(first_block, last_block + 1):
+            found, data = self._memo.get(ii)
+            if not found:
+                data = self._read_cached_block(ii)
+                if data is not None:
+                    self._memo.set(ii, data)
+            if data is not None:
+                ret[ii] = data
+            else:
+                missing.append(ii)
+        # fetch runs of consecutive missing blocks with single requests
+        runs: List[List[int]] = []
+        for ii in missing:
+            if runs and (runs[-1][-1] == ii - 1) and (len(runs[-1]) < _MAX_BLOCKS_PER_REQUEST):
+                runs[-1].append(ii)
+            else:
+                runs.append([ii])
+        for run in runs:
+            start = run[0] * self._block_size
+            end = min((run[-1] + 1) * self._block_size, self._size)
+            data = self._fetch_range(start, end)
+            for ii in run:
+                block = data[(ii - run[0]) * self._block_size:(ii - run[0] + 1) * self._block_size]
+                self._memo.set(ii, block)
+                self._write_cached_block(ii, block)
+                ret[ii] = block
+        return ret
+
+    def _fetch_range(self, start: int, end: int) -> bytes:
+        headers = {
+            'Range': 'bytes={}-{}'.format(start, end - 1)
+        }
+        response = get_http_pool().request('GET', self._url, headers=headers, timeout=_TIMEOUT)
+        self._num_requests += 1
+        if response.status_code != 206:
+            raise Exception('Unexpected status code for range request ({}): {}'.format(response.status_code, self._url))
+        data = response.content
+        if len(data) != end - start:
+            raise Exception('Incomplete range {}-{} ({} bytes received): {}'.format(start, end - 1, len(data), self._url))
+        self._num_bytes_fetched += len(data)
+        return data
+
+    def _block_path(self, ii: int) -> str:
+        assert self._block_cache_dir is not None
+        return os.path.join(self._block_cache_dir, '{}-{}'.format(self._block_size, ii))
+
+    def _read_cached_block(self, ii: int) -> Optional[bytes]:
+        if self._block_cache_dir is None:
+            return None
+        try:
+            with open(self._block_path(ii), 'rb') as f:
+                data = f.read()
+        except:
+            return None
+        expected_size = min(self._block_size, self._size - ii * self._block_size)
+        if len(data) != expected_size:
+            return None
+        return data
+
+    def _write_cached_block(self, ii: int, data: bytes) -> None:
+        if self._block_cache_dir is None:
+            return
+        try:
+            if not os.path.exists(self._block_cache_dir):
+                os.makedirs(self._block_cache_dir, exist_ok=True)
+            path = self._block_path(ii)
+            tmp_path = path + '.downloading.' + _random_string(6)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except:
+            print('Warning: unable to write block to cache: {}'.format(self._block_cache_dir))
+
+
+def _seek_position(position: int, size: int, offset: int, whence: int) -> int:
+    if whence == io.SEEK_SET:
+        ret = offset
+    elif whence == io.SEEK_CUR:
+        ret = position + offset
+    elif whence == io.SEEK_END:
+        ret = size + offset
+    else:
+        raise ValueError('Invalid whence: {}'.format(whence))
+    if ret < 0:
+        raise ValueError('Negative seek position: {}'.format(ret))
+    return ret
+
+
+def _random_string(num_chars: int) -> str:
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    return ''.join(random.choice(chars) for _ in range(num_chars))
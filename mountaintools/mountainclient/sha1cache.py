@@ -1,23 +1,57 @@
-import json
 import os
+import sys
+import json
+import stat
+import fcntl
+import errno
+import socket
 import shutil
 import hashlib
+import threading
 from shutil import copyfile
 from .steady_download_and_compute_sha1 import steady_download_and_compute_sha1
 import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+from .sha1cacheindex import Sha1CacheIndex, get_sha1_cache_index, _stat_objects_match, _get_stat_object, _walk_cache_subdirectories
+from .chunkstore import ChunkStore
+from .coldstore import ColdStore
+from .dirindex import DirIndexCache
 from .filelock import FileLock
 import mtlogging
 from typing import Optional, List, Any, Dict, Tuple, Union
 
-# TODO: implement cleanup() for Sha1Cache
-# removing .record.json and .hints.json files that are no longer relevant
+# Last access times are written to the index at most this often per sha1 (per process)
+_TOUCH_INTERVAL = 60
+# Temporary .copying.*, .downloading* and .linking.* files older than this are considered abandoned
+_STALE_TEMP_FILE_AGE = 24 * 3600
+# Ways of materializing a file from/into the cache (see Sha1Cache.linkMode())
+_LINK_MODES = ['copy', 'reflink', 'hardlink', 'symlink', 'auto']
+# ioctl request number for cloning a file on linux (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+# Pins recorded by processes on other hosts (whose liveness we cannot check) expire after this long
+_REMOTE_PIN_MAX_AGE = 7 * 24 * 3600
+# Chunks not referenced by any manifest are removed once they are older than this (they may belong to a file being added)
+_UNREFERENCED_CHUNK_AGE = 3600
+# The buffer size for hashing and for copying files into the cache
+_IO_BLOCK_SIZE = 4 * 1024 * 1024
+# How files added to the cache are written to the shared tier (see Sha1Cache.sharedDirectory())
+_SHARED_WRITE_MODES = ['through', 'back', 'none']
 
 
 class Sha1Cache():
     def __init__(self):
         self._directory = None
         self._alternate_directories = None
+        self._index_backend: Optional[str] = None
+        self._link_mode: Optional[str] = None
+        self._chunking: Optional[bool] = None
+        self._last_touch_times: Dict[str, float] = dict()
+        self._dir_index_caches: Dict[str, DirIndexCache] = dict()
+        self._shared_directory: Optional[str] = None
+        self._shared_write_mode: Optional[str] = None
+        self._shared_caches: Dict[str, 'Sha1Cache'] = dict()
+        self._tier_stats = dict(local_hits=0, shared_hits=0, misses=0, num_bytes_promoted=0, num_files_written_to_shared=0, num_bytes_written_to_shared=0)
 
     def directory(self) -> str:
         if self._directory:
@@ -41,63 +75,255 @@ class Sha1Cache():
     def setAlternateDirectories(self, directories: List[str]) -> None:
         self._alternate_directories = directories
 
-    def findFile(self, sha1: str) -> Optional[str]:
+    def sharedDirectory(self) -> Optional[str]:
+        """The directory of the shared tier (e.g., a cache on a cluster file
+        system), or None if there is none. Set with setSharedDirectory() or
+        the SHA1_CACHE_SHARED_DIR environment variable.
+
+        With a shared tier, this cache is the node-local tier in front of it:
+        files found only in the shared tier are promoted (copied) into the
+        local tier when they are read, and files added to the local tier are
+        written to the shared tier according to sharedWriteMode(). Each tier
+        has its own size limit (see cleanup()). Unlike the shared tier, the
+        alternate directories are only searched, and nothing is copied from
+        or to them.
+        """
+        if self._shared_directory:
+            return self._shared_directory
+        return os.getenv('SHA1_CACHE_SHARED_DIR', None) or None
+
+    def setSharedDirectory(self, directory: Optional[str]) -> None:
+        self._shared_directory = directory
+
+    def sharedWriteMode(self) -> str:
+        """How files added to the local tier are written to the shared tier:
+
+        'through' (default): immediately
+        'back': later, by flushSharedWrites() (which is called by cleanup()
+        before anything is evicted)
+        'none': never
+
+        Set with setSharedWriteMode() or SHA1_CACHE_SHARED_WRITE.
+        """
+        mode = self._shared_write_mode or os.getenv('SHA1_CACHE_SHARED_WRITE', 'through')
+        if mode not in _SHARED_WRITE_MODES:
+            raise Exception('Invalid shared write mode: {}'.format(mode))
+        return mode
+
+    def setSharedWriteMode(self, mode: Optional[str]) -> None:
+        if (mode is not None) and (mode not in _SHARED_WRITE_MODES):
+            raise Exception('Invalid shared write mode: {}'.format(mode))
+        self._shared_write_mode = mode
+
+    def tierStats(self) -> dict:
+        """Statistics of the lookups by findFile() in this process: hits in
+        the local tier, hits in the shared tier (promoted), misses, and the
+        bytes promoted and written to the shared tier"""
+        return dict(self._tier_stats)
+
+    def flushSharedWrites(self) -> int:
+        """Write the files that are pending in write-back mode to the shared
+        tier. Returns the number of files written."""
+        shared = self._shared_cache()
+        writeback_dir = os.path.join(self.directory(), 'writeback')
+        if (shared is None) or (not os.path.isdir(writeback_dir)):
+            return 0
+        num_written = 0
+        for sha1 in os.listdir(writeback_dir):
+            if not _is_sha1(sha1):
+                continue
+            path = self._find_file(sha1, _reassemble=True)
+            if path is not None:
+                try:
+                    if self._write_to_shared(shared, sha1, path):
+                        num_written += 1
+                except:
+                    print('Warning: unable to write file to shared cache: {}'.format(path))
+                    continue
+            _safe_remove_file(os.path.join(writeback_dir, sha1))
+        return num_written
+
+    def setIndexBackend(self, backend: Optional[str]) -> None:
+        """Set the index backend ('sqlite' or 'json'). None means use the
+        SHA1_CACHE_INDEX environment variable (default 'sqlite')."""
+        self._index_backend = backend
+
+    def linkMode(self) -> str:
+        """How files are materialized into the cache (copyFileToCache()) and
+        out of it (materializeFile()):
+
+        'copy' (default): always copy the data
+        'reflink': copy-on-write clone where the file system supports it (FICLONE), otherwise copy
+        'hardlink': hard link when on the same device, otherwise copy
+        'symlink': symbolic link to the cached file (only when materializing out of the cache; hard link into it)
+        'auto': reflink, then hard link, then copy
+
+        Set with setLinkMode() or the SHA1_CACHE_LINK_MODE environment variable.
+        Linked files share their data with the cache, so they must not be
+        modified in place. Cached files that are linked out are made read-only,
+        and a cached file whose stats change is detected and removed by
+        findFile(). Symbolic links to a cached file dangle once it is evicted
+        by cleanup().
+        """
+        mode = self._link_mode or os.getenv('SHA1_CACHE_LINK_MODE', 'copy')
+        if mode not in _LINK_MODES:
+            raise Exception('Invalid sha1 cache link mode: {}'.format(mode))
+        return mode
+
+    def setLinkMode(self, mode: Optional[str]) -> None:
+        if (mode is not None) and (mode not in _LINK_MODES):
+            raise Exception('Invalid sha1 cache link mode: {}'.format(mode))
+        self._link_mode = mode
+
+    def chunking(self) -> bool:
+        """Whether files copied or downloaded into the cache are also stored
+        in the content-defined chunk store (<cache>/chunks), where
+        near-duplicate files share most of their data.
+
+        Files copied into the cache are then stored as chunks, and as whole
+        files reassembled from the chunks. The whole files (and downloaded
+        files) are evicted first by cleanup(), since they can be recreated
+        from the chunks, and are reassembled into the cache on demand by
+        findFile() (or read through openFile()).
+
+        Set with setChunking() or SHA1_CACHE_CHUNKING=TRUE. Files already in
+        the chunk store remain available when chunking is turned off.
+        """
+        if self._chunking is not None:
+            return self._chunking
+        return os.getenv('SHA1_CACHE_CHUNKING', 'FALSE') == 'TRUE'
+
+    def setChunking(self, enabled: Optional[bool]) -> None:
+        self._chunking = enabled
+
+    def openFile(self, sha1: str) -> Optional[Any]:
+        """Return a read-only binary file object for the content with this
+        sha1, reading directly from the chunk store or the compressed tier if
+        the file is not cached as a whole, or None if it is not available
+        locally"""
+        path = self.findFile(sha1, _reassemble=False)
+        if path is not None:
+            return open(path, 'rb')
+        f = self._chunk_store().openFile(sha1)
+        if f is None:
+            f = self._cold_store().openFile(sha1)
+        if f is not None:
+            self._touch(sha1)
+        return f
+
+    def reassembleFile(self, sha1: str, dest_path: str) -> bool:
+        """Write the content with this sha1 from the chunk store or the
+        compressed tier to dest_path. Returns False if it is in neither."""
+        if not self._chunk_store().reassembleFile(sha1, dest_path):
+            if not self._cold_store().decompressFile(sha1, dest_path):
+                return False
+        self._touch(sha1)
+        self.reportFileSha1(dest_path, sha1)
+        return True
+
+    def blockCacheDir(self, sha1: str) -> str:
+        """The directory where blocks of the content with this sha1 that were
+        fetched with range requests are stored (see
+        MountainClient.openFile()). It is removed by cleanup() once the whole
+        file is in the cache or the blocks have not been used for a day."""
+        return os.path.join(self.directory(), 'blocks', sha1[0], sha1[1:3], sha1)
+
+    def dirIndexCache(self) -> DirIndexCache:
+        """The cache of local directory indices (see MountainClient.readDir()),
+        persisted in the dir-index/ subdirectory. Indices of directories that
+        no longer exist are removed by cleanup()."""
+        directory = self.directory()
+        if directory not in self._dir_index_caches:
+            self._dir_index_caches[directory] = DirIndexCache(os.path.join(directory, 'dir-index'))
+        return self._dir_index_caches[directory]
+
+    def findFile(self, sha1: str, _reassemble: bool=True) -> Optional[str]:
+        path = self._find_file(sha1, _reassemble=_reassemble)
+        if path is None:
+            path = self._promote_from_shared(sha1)
+            if path is not None:
+                self._tier_stats['shared_hits'] += 1
+            else:
+                self._tier_stats['misses'] += 1
+        else:
+            self._tier_stats['local_hits'] += 1
+        return path
+
+    def _find_file(self, sha1: str, _reassemble: bool) -> Optional[str]:
         path, alternate_paths = self._get_path_ext(
             sha1, create=False, return_alternates=True)
         # if file is available return it
-        if os.path.exists(path):
+        if os.path.exists(path) and (not self._linked_file_was_modified(path)):
+            self._touch(sha1)
             return path
         # return first alternate path that exists
         for altpath in alternate_paths:
             if os.path.exists(altpath):
                 return altpath
-        hints_fname = path + '.hints.json'
-        # if path.hints.json exists then read it
-        if os.path.exists(hints_fname):
-            hints = _read_json_file(hints_fname, delete_on_error=True)
-            if hints and ('files' in hints):
-                files = hints['files']
-                matching_files = []
-                for file in files:
-                    path0 = file['stat']['path']
-                    if os.path.exists(path0) and os.path.isfile(path0):
-                        stat_obj0 = _get_stat_object(path0)
-                        if stat_obj0:
-                            if (_stat_objects_match(stat_obj0, file['stat'])):
-                                matching_files.append(file)
-                if matching_files:
-                    hints['files'] = matching_files
-                    try:
-                        _write_json_file(hints, hints_fname)
-                    except:
-                        print('Warning: problem writing hints file: ' + hints_fname)
-                    return matching_files[0]['stat']['path']
-                else:
-                    _safe_remove_file(hints_fname)
-            else:
-                print(
-                    'Warning: failed to load hints json file, or invalid file. Removing: ' + hints_fname)
-                _safe_remove_file(hints_fname)
+        # otherwise check the hints in the index for other local files with this content
+        index = self._index()
+        hints = index.getHints(sha1)
+        if hints:
+            matching_stats = []
+            for stat_obj in hints:
+                path0 = stat_obj['path']
+                if os.path.exists(path0) and os.path.isfile(path0):
+                    stat_obj0 = _get_stat_object(path0)
+                    if stat_obj0:
+                        if (_stat_objects_match(stat_obj0, stat_obj)):
+                            matching_stats.append(stat_obj)
+            if len(matching_stats) != len(hints):
+                index.setHints(sha1, matching_stats)
+            if matching_stats:
+                return matching_stats[0]['path']
+        # finally reassemble it from the chunk store, or expand it from the
+        # compressed tier
+        if _reassemble and self._chunk_store().hasFile(sha1):
+            path = self._get_path(sha1, create=True)
+            if self._chunk_store().reassembleFile(sha1, path):
+                self._touch(sha1)
+                return path
+        if _reassemble and self._cold_store().hasFile(sha1):
+            path = self._get_path(sha1, create=True)
+            if self._cold_store().decompressFile(sha1, path):
+                self._touch(sha1)
+                return path
         return None
 
     def downloadFile(self, url: str, sha1: str, target_path: Optional[str]=None, size: Optional[int]=None, verbose: bool=False, show_progress: bool=False) -> Optional[str]:
-        alternate_target_path = False
-        if target_path is None:
-            target_path = self._get_path(sha1, create=True)
-        else:
-            alternate_target_path = True
+        path0 = self._get_path(sha1, create=True)
+        # processes downloading the same file take turns, and the first one
+        # puts it in the cache. The lock and the partial download are kept in
+        # the cache directory also when downloading to target_path, so that
+        # nothing is left next to the files of the caller (the lock file is
+        # left in place, see cleanup()).
+        with FileLock(path0 + '.lock', exclusive=True):
+            if target_path is None:
+                if os.path.exists(path0):
+                    self._touch(sha1)
+                    return path0
+                self._download_file(url, sha1, target_path=path0, path_tmp=path0 + '.downloading', alternate_target_path=False, size=size, verbose=verbose, show_progress=show_progress)
+                target_path = path0
+            else:
+                self._download_file(url, sha1, target_path=target_path, path_tmp=path0 + '.downloading', alternate_target_path=True, size=size, verbose=verbose, show_progress=show_progress)
+        self._file_added(sha1, target_path)
+        return target_path
 
-        path_tmp = target_path + '.downloading.' + _random_string(6)
+    def _download_file(self, url: str, sha1: str, *, target_path: str, path_tmp: str, alternate_target_path: bool, size: Optional[int], verbose: bool, show_progress: bool) -> None:
+        # path_tmp is not random, so that an interrupted download can be resumed
         if (verbose) or (show_progress) or ((size is not None) and (size > 10000)):
             print(
                 'Downloading file --- ({}): {} -> {}'.format(_format_file_size(size), url, target_path))
 
         timer = time.time()
-        sha1b = steady_download_and_compute_sha1(url=url, target_path=path_tmp)
+        sha1b = steady_download_and_compute_sha1(url=url, target_path=path_tmp, show_progress=show_progress)
         elapsed = time.time() - timer
 
         if (verbose) or (show_progress) or ((size is not None) and size > 10000):
-            print('Downloaded file ({}) in {} sec.'.format(_format_file_size(size), elapsed))
+            if size and (elapsed > 0):
+                print('Downloaded file ({}) in {:.2f} sec ({:.1f} MiB/s).'.format(_format_file_size(size), elapsed, size / elapsed / (1024 * 1024)))
+            else:
+                print('Downloaded file ({}) in {:.2f} sec.'.format(_format_file_size(size), elapsed))
 
         if not sha1b:
             if os.path.exists(path_tmp):
@@ -110,17 +336,32 @@ class Sha1Cache():
         if alternate_target_path:
             if os.path.exists(target_path):
                 _safe_remove_file(target_path)
-            _rename_file(path_tmp, target_path, remove_if_exists=True)
+            # target_path may be on another device than the cache
+            _rename_or_copy(path_tmp, target_path)
+            if os.path.exists(path_tmp):
+                _safe_remove_file(path_tmp)
             self.reportFileSha1(target_path, sha1)
         else:
             if not os.path.exists(target_path):
                 _rename_file(path_tmp, target_path, remove_if_exists=False)
             else:
                 _safe_remove_file(path_tmp)
-        return target_path
+            self._touch(sha1)
+            if self.chunking() and (not self._chunk_store().hasFile(sha1)):
+                self._chunk_store().addFile(target_path, sha1)
 
     def moveFileToCache(self, path: str) -> str:
-        sha1 = self.computeFileSha1(path)
+        sha1 = self.computeFileSha1(path, _cache_only=True)
+        if (sha1 is None) and (not _same_device(path, self.directory())):
+            # the file can't be renamed into the cache, so copy it while hashing
+            path0, sha1, added = self._ingest_file(path)
+            if added:
+                self._file_added(sha1, path0)
+            self._touch(sha1)
+            _safe_remove_file(path)
+            return path0
+        if sha1 is None:
+            sha1 = self.computeFileSha1(path)
         path0 = self._get_path(sha1, create=True)
         if os.path.exists(path0):
             if path != path0:
@@ -129,19 +370,74 @@ class Sha1Cache():
             tmp_fname = path0 + '.copying.' + _random_string(6)
             _rename_or_copy(path, tmp_fname)
             _rename_file(tmp_fname, path0, remove_if_exists=False)
-
+            self._file_added(sha1, path0)
+        self._touch(sha1)
         return path0
 
     @mtlogging.log()
     def copyFileToCache(self, path: str) -> Tuple[str, str]:
-        sha1 = self.computeFileSha1(path)
+        """Copy or link (according to linkMode()) a file into the cache.
+        Returns the path of the cached file and the sha1. When chunking() is
+        enabled and the file is not already cached as a whole, it is stored in
+        the chunk store, and the returned path is the cached file reassembled
+        from its chunks (a copy that does not depend on the original file,
+        which cleanup() evicts first, since it can be recreated from the
+        chunks).
+
+        If the sha1 of the file is not yet known and the file is copied, it is
+        hashed while it is copied, so that it is read only once."""
+        sha1 = self.computeFileSha1(path, _cache_only=True)
+        if (sha1 is None) and (self.linkMode() == 'copy') and (not self.chunking()):
+            path0, sha1, added = self._ingest_file(path)
+            self.reportFileSha1(path, sha1)
+            if added:
+                self._file_added(sha1, path0)
+            self._touch(sha1)
+            return path0, sha1
+        if sha1 is None:
+            sha1 = self.computeFileSha1(path)
         path0 = self._get_path(sha1, create=True)
+        if (not os.path.exists(path0)) and self.chunking():
+            if not self._chunk_store().hasFile(sha1):
+                self._chunk_store().addFile(path, sha1)
+            if not self._chunk_store().reassembleFile(sha1, path0):
+                raise Exception('Unable to reassemble file from the chunk store: {}'.format(path))
+            self._file_added(sha1, path0)
+            self._touch(sha1)
+            return path0, sha1
         if not os.path.exists(path0):
             tmp_path = path0 + '.copying.' + _random_string(6)
-            copyfile(path, tmp_path)
+            mode = _materialize_file(path, tmp_path, mode=self.linkMode(), allow_symlink=False)
             _rename_file(tmp_path, path0, remove_if_exists=False)
+            index = self._index()
+            if mode == 'hardlink':
+                index.setLinkedStat(path0, _get_stat_object(path0))
+                # linking changed the ctime of the source file
+                self.reportFileSha1(path, sha1)
+            elif index.getLinkedStat(path0) is not None:
+                index.removeLinkedStat(path0)
+            self._file_added(sha1, path0)
+        self._touch(sha1)
         return path0, sha1
 
+    @mtlogging.log()
+    def materializeFile(self, sha1: str, path: str, dest_path: str) -> str:
+        """Copy or link (according to linkMode()) a file with known sha1 (for
+        example a file returned by findFile()) to dest_path. Returns the mode
+        that was used."""
+        is_cache_file = (os.path.abspath(path) == self._get_path(sha1, create=False))
+        mode = _materialize_file(path, dest_path, mode=self.linkMode(), allow_symlink=is_cache_file)
+        if mode in ['hardlink', 'symlink']:
+            if is_cache_file:
+                # the data is now shared with a file outside the cache
+                _make_read_only(path)
+                self._index().setLinkedStat(path, _get_stat_object(path))
+            elif mode == 'hardlink':
+                # linking changed the ctime of the source file
+                self.reportFileSha1(path, sha1)
+        self.reportFileSha1(dest_path, sha1)
+        return mode
+
     @mtlogging.log()
     def computeFileSha1(self, path: str, _known_sha1: str = None, _cache_only: bool = False) -> Optional[str]:
         path = os.path.abspath(path)
@@ -153,17 +449,14 @@ class Sha1Cache():
                 return basename
 
         aa = _get_stat_object(path)
-        aa_hash = _compute_string_sha1(json.dumps(aa, sort_keys=True))
+        if aa is None:
+            return None
 
-        path0 = self._get_path(aa_hash, create=True) + '.record.json'
+        index = self._index()
         if not _known_sha1:
-            if os.path.exists(path0):
-                obj = _read_json_file(path0, delete_on_error=True)
-                if obj:
-                    bb = obj['stat']
-                    if _stat_objects_match(aa, bb):
-                        if obj.get('sha1', None):
-                            return obj['sha1']
+            sha1 = index.getSha1(aa)
+            if sha1:
+                return sha1
 
         if _known_sha1 is None:
             if _cache_only:
@@ -175,32 +468,492 @@ class Sha1Cache():
         if not sha1:
             return None
 
-        obj = dict(
-            sha1=sha1,
-            stat=aa
+        index.addRecord(sha1, aa)
+        return sha1
+
+    @mtlogging.log()
+    def computeFileSha1s(self, paths: List[str], *, num_workers: int=8, _cache_only: bool=False) -> List[Optional[str]]:
+        """Batch version of computeFileSha1(). All files are stat'ed up front,
+        the cached hashes are retrieved with a single index query, and the
+        remaining files are hashed in parallel on a thread pool (hashlib
+        releases the GIL)."""
+        paths = [os.path.abspath(path) for path in paths]
+        ret: List[Optional[str]] = [None for _ in paths]
+        stat_objs: List[Optional[dict]] = [None for _ in paths]
+        lookup_inds = []
+        for ii, path in enumerate(paths):
+            basename = os.path.basename(path)
+            if (len(basename) == 40) and (self._get_path(sha1=basename, create=False) == path):
+                # it is itself a file in the cache
+                ret[ii] = basename
+                continue
+            stat_objs[ii] = _get_stat_object(path)
+            if stat_objs[ii] is not None:
+                lookup_inds.append(ii)
+        if not lookup_inds:
+            return ret
+
+        index = self._index()
+        sha1s = index.getSha1s([stat_objs[ii] for ii in lookup_inds])
+        compute_inds = []
+        for ii, sha1 in zip(lookup_inds, sha1s):
+            if sha1:
+                ret[ii] = sha1
+            else:
+                compute_inds.append(ii)
+        if (not compute_inds) or _cache_only:
+            return ret
+
+        if (num_workers <= 1) or (len(compute_inds) == 1):
+            computed_sha1s = [_compute_file_sha1(paths[ii]) for ii in compute_inds]
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                computed_sha1s = list(executor.map(_compute_file_sha1, [paths[ii] for ii in compute_inds]))
+        records = []
+        for ii, sha1 in zip(compute_inds, computed_sha1s):
+            if sha1:
+                ret[ii] = sha1
+                records.append((sha1, stat_objs[ii]))
+        index.addRecords(records)
+        return ret
+
+    def reportFileSha1(self, path: str, sha1: str) -> None:
+        self.computeFileSha1(path, _known_sha1=sha1)
+
+    def pinFiles(self, sha1s: List[str]) -> '_Sha1CachePins':
+        """Protect the cached files for these sha1s from eviction by cleanup()
+        while the returned context is active (for example while a job is
+        running). Pins are recorded in the pins/ subdirectory of the cache, one
+        file per process, and pins of processes that no longer exist are
+        ignored."""
+        return _Sha1CachePins(directory=self.directory(), sha1s=sha1s)
+
+    @mtlogging.log()
+    def cleanup(self, max_bytes: Optional[int]=None, policy: str='lru', dry_run: bool=False, verbose: bool=False, compress_idle_sec: Optional[float]=None, shared_max_bytes: Optional[int]=None) -> dict:
+        """Garbage collect the cache directory.
+
+        Removes index entries for files that no longer exist or have changed,
+        orphaned .record.json, .hints.json and .lock files and abandoned
+        temporary files. If compress_idle_sec is given, cached files that
+        have not been accessed for that long are moved to the compressed tier
+        (<cache>/cold, see coldstore.py), from which they are expanded again
+        by findFile() or read directly by openFile(). If max_bytes is given,
+        cached files are then evicted (according to policy) until the total
+        size of the cache is at most max_bytes. Files that can be reassembled
+        from the chunk store or expanded from the compressed tier are evicted
+        first, then the other files, then files in the compressed tier, then
+        files in the chunk store. Files pinned by running jobs are never
+        evicted or compressed.
+
+        With a shared tier (see sharedDirectory()), the pending write-backs
+        are written to it first, and if shared_max_bytes is given the shared
+        tier is then cleaned up in the same way.
+
+        Parameters
+        ----------
+        max_bytes : Optional[int], optional
+            The maximum total size of the cached files, by default None (no
+            eviction)
+        policy : str, optional
+            'lru' to evict the least recently accessed files first, or
+            'largest' to evict the largest files first, by default 'lru'
+        dry_run : bool, optional
+            Only report what would be evicted, by default False
+        verbose : bool, optional
+            Print the evicted files, by default False
+        compress_idle_sec : Optional[float], optional
+            Compress the files that have not been accessed for this number of
+            seconds, by default None (no compression)
+        shared_max_bytes : Optional[int], optional
+            The maximum total size of the files in the shared tier, by default
+            None (the shared tier is not cleaned up)
+
+        Returns
+        -------
+        dict
+            Statistics of the cleanup (those of the shared tier under 'shared')
+        """
+        # nothing may be evicted before it is written back
+        num_written = self.flushSharedWrites() if not dry_run else 0
+        ret = self._cleanup(max_bytes=max_bytes, policy=policy, dry_run=dry_run, verbose=verbose, compress_idle_sec=compress_idle_sec)
+        ret['num_files_written_to_shared'] = num_written
+        shared = self._shared_cache()
+        if (shared is not None) and (shared_max_bytes is not None):
+            ret['shared'] = shared.cleanup(max_bytes=shared_max_bytes, policy=policy, dry_run=dry_run, verbose=verbose)
+        return ret
+
+    def _cleanup(self, *, max_bytes: Optional[int], policy: str, dry_run: bool, verbose: bool, compress_idle_sec: Optional[float]) -> dict:
+        if policy not in ['lru', 'largest']:
+            raise Exception('Invalid cleanup policy: {}'.format(policy))
+        directory = self.directory()
+        index = self._index()
+        ret = dict(
+            num_index_entries_removed=0,
+            num_orphaned_files_removed=0,
+            num_files=0,
+            num_bytes=0,
+            num_files_evicted=0,
+            num_bytes_evicted=0,
+            num_files_pinned=0,
+            num_chunks=0,
+            num_chunk_bytes=0,
+            num_chunked_files=0,
+            num_chunked_files_evicted=0,
+            num_files_compressed=0,
+            num_bytes_compressed=0,
+            num_compressed_files=0,
+            num_compressed_bytes=0,
+            num_compressed_files_evicted=0
         )
+
+        if not dry_run:
+            ret['num_index_entries_removed'] = index.pruneRecords()
+
+        # find the cached files, and remove orphaned lock files and abandoned temporary files
+        cached_files: List[Tuple[str, str, os.stat_result]] = []
+        now = time.time()
+        for dirpath, fnames in _walk_cache_subdirectories(directory):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                if _is_sha1(fname):
+                    try:
+                        cached_files.append((fname, path, os.stat(path)))
+                    except:
+                        pass
+                elif dry_run:
+                    continue
+                elif fname.endswith('.lock'):
+                    if not os.path.exists(path[:-len('.lock')]):
+                        if _remove_stale_lock_file(path, now - _STALE_TEMP_FILE_AGE):
+                            ret['num_orphaned_files_removed'] += 1
+                elif ('.copying.' in fname) or ('.downloading' in fname) or ('.linking.' in fname):
+                    try:
+                        if now - os.path.getmtime(path) > _STALE_TEMP_FILE_AGE:
+                            os.unlink(path)
+                            ret['num_orphaned_files_removed'] += 1
+                    except:
+                        pass
+        if not dry_run:
+            # files that were being copied into the cache by _ingest_file()
+            ingest_dir = os.path.join(directory, 'ingest')
+            for fname in (os.listdir(ingest_dir) if os.path.isdir(ingest_dir) else []):
+                try:
+                    if now - os.path.getmtime(os.path.join(ingest_dir, fname)) > _STALE_TEMP_FILE_AGE:
+                        os.unlink(os.path.join(ingest_dir, fname))
+                        ret['num_orphaned_files_removed'] += 1
+                except:
+                    pass
+        ret['num_files'] = len(cached_files)
+        ret['num_bytes'] = sum([st.st_size for _, _, st in cached_files])
+
+        # blocks fetched with range requests
+        if not dry_run:
+            cached_sha1s = set([sha1 for sha1, _, _ in cached_files])
+            for dirpath, fnames in _walk_cache_subdirectories(os.path.join(directory, 'blocks')):
+                for fname in fnames:
+                    block_dir = os.path.join(dirpath, fname)
+                    if (fname in cached_sha1s) or _all_files_older_than(block_dir, now - _STALE_TEMP_FILE_AGE):
+                        shutil.rmtree(block_dir, ignore_errors=True)
+                        ret['num_orphaned_files_removed'] += 1
+            # indices of directories that no longer exist
+            ret['num_orphaned_files_removed'] += self.dirIndexCache().cleanup()
+
+        # the chunk store
+        chunk_store = self._chunk_store()
+        manifests = chunk_store.listFiles()
+        chunks = chunk_store.listChunks()
+        chunk_refcounts: Dict[str, int] = dict()
+        for _, manifest in manifests:
+            for chunk_sha1, _ in manifest['chunks']:
+                chunk_refcounts[chunk_sha1] = chunk_refcounts.get(chunk_sha1, 0) + 1
+        for chunk_sha1, (path, st) in list(chunks.items()):
+            if (chunk_sha1 not in chunk_refcounts) and (not dry_run) and (now - st.st_mtime > _UNREFERENCED_CHUNK_AGE):
+                chunk_store.removeChunk(chunk_sha1)
+                del chunks[chunk_sha1]
+                ret['num_orphaned_files_removed'] += 1
+        ret['num_chunks'] = len(chunks)
+        ret['num_chunk_bytes'] = sum([st.st_size for _, st in chunks.values()])
+        ret['num_chunked_files'] = len(manifests)
+        ret['num_bytes'] += ret['num_chunk_bytes']
+        chunked_sha1s = set([sha1 for sha1, _ in manifests])
+        pinned = _get_pinned_sha1s(directory)
+
+        # move the files that have not been accessed recently to the compressed tier
+        cold_store = self._cold_store()
+        if compress_idle_sec is not None:
+            cold_sha1s = set([sha1 for sha1, _, _ in cold_store.listFiles()])
+            access_times = index.getLastAccessTimes([sha1 for sha1, _, _ in cached_files])
+            remaining_files: List[Tuple[str, str, os.stat_result]] = []
+            for sha1, path, st in cached_files:
+                last_access = max(access_times.get(sha1, 0), st.st_atime, st.st_mtime)
+                if (sha1 in pinned) or (sha1 in chunked_sha1s) or (now - last_access < compress_idle_sec):
+                    remaining_files.append((sha1, path, st))
+                    continue
+                if not dry_run:
+                    if sha1 not in cold_sha1s:
+                        try:
+                            compressed_size = cold_store.addFile(path, sha1)
+                        except:
+                            print('Warning: unable to compress file: ' + path)
+                            compressed_size = None
+                        if compressed_size is None:
+                            remaining_files.append((sha1, path, st))
+                            continue
+                    if not self._remove_cached_file(path):
+                        remaining_files.append((sha1, path, st))
+                        continue
+                    ret['num_files'] -= 1
+                    ret['num_bytes'] -= st.st_size
+                if verbose:
+                    print('{} {} ({})'.format('Would compress' if dry_run else 'Compressed', path, _format_file_size(st.st_size)))
+                ret['num_files_compressed'] += 1
+                ret['num_bytes_compressed'] += st.st_size
+            if not dry_run:
+                cached_files = remaining_files
+        cold_files = cold_store.listFiles()
+        cold_sha1s = set([sha1 for sha1, _, _ in cold_files])
+        ret['num_compressed_files'] = len(cold_files)
+        ret['num_compressed_bytes'] = sum([st.st_size for _, _, st in cold_files])
+        ret['num_bytes'] += ret['num_compressed_bytes']
+
+        if (max_bytes is None) or (ret['num_bytes'] <= max_bytes):
+            return ret
+
+        # files that can be reassembled from the chunk store or expanded from
+        # the compressed tier go first
+        reconstructible_sha1s = chunked_sha1s | cold_sha1s
+        last_access_times = index.getLastAccessTimes(list(set([sha1 for sha1, _, _ in cached_files]) | reconstructible_sha1s)) if policy == 'lru' else dict()
+        if policy == 'lru':
+            cached_files.sort(key=lambda x: (x[0] not in reconstructible_sha1s, max(last_access_times.get(x[0], 0), x[2].st_atime, x[2].st_mtime)))
+        else:
+            cached_files.sort(key=lambda x: (x[0] not in reconstructible_sha1s, -x[2].st_size))
+
+        num_bytes = ret['num_bytes']
+        evicted_sha1s = []
+        for sha1, path, st in cached_files:
+            if num_bytes <= max_bytes:
+                break
+            if sha1 in pinned:
+                ret['num_files_pinned'] += 1
+                continue
+            if verbose:
+                print('{} {} ({})'.format('Would evict' if dry_run else 'Evicting', path, _format_file_size(st.st_size)))
+            if not dry_run:
+                if not self._remove_cached_file(path):
+                    continue
+            evicted_sha1s.append(sha1)
+            num_bytes = num_bytes - st.st_size
+            ret['num_files_evicted'] += 1
+            ret['num_bytes_evicted'] += st.st_size
+
+        # then files in the compressed tier
+        if policy == 'lru':
+            cold_files.sort(key=lambda x: max(last_access_times.get(x[0], 0), x[2].st_mtime))
+        else:
+            cold_files.sort(key=lambda x: -x[2].st_size)
+        for sha1, path, st in cold_files:
+            if num_bytes <= max_bytes:
+                break
+            if sha1 in pinned:
+                ret['num_files_pinned'] += 1
+                continue
+            if verbose:
+                print('{} compressed file {} ({})'.format('Would evict' if dry_run else 'Evicting', sha1, _format_file_size(st.st_size)))
+            if not dry_run:
+                cold_store.removeFile(sha1)
+            evicted_sha1s.append(sha1)
+            num_bytes = num_bytes - st.st_size
+            ret['num_compressed_files_evicted'] += 1
+            ret['num_bytes_evicted'] += st.st_size
+
+        # then files in the chunk store, freeing the chunks that are no longer referenced
+        if policy == 'lru':
+            manifests.sort(key=lambda x: last_access_times.get(x[0], 0))
+        else:
+            manifests.sort(key=lambda x: -x[1]['size'])
+        for sha1, manifest in manifests:
+            if num_bytes <= max_bytes:
+                break
+            if sha1 in pinned:
+                ret['num_files_pinned'] += 1
+                continue
+            if verbose:
+                print('{} chunked file {} ({})'.format('Would evict' if dry_run else 'Evicting', sha1, _format_file_size(manifest['size'])))
+            if not dry_run:
+                chunk_store.removeFile(sha1)
+            for chunk_sha1, _ in manifest['chunks']:
+                chunk_refcounts[chunk_sha1] -= 1
+                if (chunk_refcounts[chunk_sha1] == 0) and (chunk_sha1 in chunks):
+                    path, st = chunks[chunk_sha1]
+                    if not dry_run:
+                        try:
+                            if os.path.getmtime(path) > now:
+                                # reused by a file that is being added right now
+                                continue
+                        except:
+                            continue
+                        chunk_store.removeChunk(chunk_sha1)
+                    num_bytes = num_bytes - st.st_size
+                    ret['num_bytes_evicted'] += st.st_size
+            evicted_sha1s.append(sha1)
+            ret['num_chunked_files_evicted'] += 1
+        if not dry_run:
+            # keep the access times of files that are still in the chunk store or the compressed tier
+            evicted_sha1s = [sha1 for sha1 in set(evicted_sha1s) if not (chunk_store.hasFile(sha1) or cold_store.hasFile(sha1))]
+            index.forget(evicted_sha1s)
+            for sha1 in evicted_sha1s:
+                self._last_touch_times.pop(sha1, None)
+        return ret
+
+    def _remove_cached_file(self, path: str) -> bool:
         try:
-            _write_json_file(obj, path0)
+            os.unlink(path)
         except:
-            print('Warning: problem writing .record.json file: ' + path0)
+            print('Warning: unable to remove file from cache: ' + path)
+            return False
+        index = self._index()
+        if index.getLinkedStat(path) is not None:
+            index.removeLinkedStat(path)
+        return True
 
-        path1 = self._get_path(sha1, create=True, directory=self.directory()) + '.hints.json'
-        if os.path.exists(path1):
-            hints = _read_json_file(path1, delete_on_error=True)
-        else:
-            hints = None
-        if not hints:
-            hints = {'files': []}
-        hints['files'].append(obj)
+    def _linked_file_was_modified(self, path: str) -> bool:
+        # Check whether a cached file that shares its data with a file outside
+        # the cache was modified in place (in which case it is removed)
+        index = self._index()
+        linked_stat = index.getLinkedStat(path)
+        if linked_stat is None:
+            return False
+        stat_obj = _get_stat_object(path)
+        if (stat_obj is not None) and all([stat_obj[k] == linked_stat[k] for k in ['size', 'ino', 'mtime']]):
+            return False
+        print('Warning: cached file was modified through a link. Removing: ' + path)
+        _safe_remove_file(path)
+        index.removeLinkedStat(path)
+        return True
+
+    def _touch(self, sha1: str) -> None:
+        # record the access time in the index, but not too often
+        now = time.time()
+        if now - self._last_touch_times.get(sha1, 0) < _TOUCH_INTERVAL:
+            return
+        self._last_touch_times[sha1] = now
         try:
-            _write_json_file(hints, path1)
+            self._index().touch([sha1], timestamp=now)
         except:
-            print('Warning: problem writing .hints.json file: ' + path1)
-        # todo: use hints for findFile
-        return sha1
+            print('Warning: unable to record access time in sha1 cache index for: ' + sha1)
 
-    def reportFileSha1(self, path: str, sha1: str) -> None:
-        self.computeFileSha1(path, _known_sha1=sha1)
+    def _chunk_store(self) -> ChunkStore:
+        return ChunkStore(os.path.join(self.directory(), 'chunks'))
+
+    def _cold_store(self) -> ColdStore:
+        return ColdStore(os.path.join(self.directory(), 'cold'))
+
+    def _shared_cache(self) -> Optional['Sha1Cache']:
+        directory = self.sharedDirectory()
+        if (not directory) or (os.path.abspath(directory) == os.path.abspath(self.directory())):
+            return None
+        if directory not in self._shared_caches:
+            shared = Sha1Cache()
+            shared.setDirectory(directory)
+            shared.setIndexBackend(self._index_backend)
+            shared.setLinkMode('copy')
+            shared.setChunking(False)
+            self._shared_caches[directory] = shared
+        return self._shared_caches[directory]
+
+    def _promote_from_shared(self, sha1: str) -> Optional[str]:
+        shared = self._shared_cache()
+        if shared is None:
+            return None
+        shared_path = shared._get_path(sha1, create=False)
+        if not os.path.exists(shared_path):
+            return None
+        shared._touch(sha1)
+        try:
+            path = self._add_file_with_sha1(shared_path, sha1)
+        except:
+            # e.g., the local tier is full
+            print('Warning: unable to promote file from shared cache: {}'.format(shared_path))
+            return shared_path
+        self._tier_stats['num_bytes_promoted'] += os.path.getsize(path)
+        return path
+
+    def _ingest_file(self, path: str) -> Tuple[str, str, bool]:
+        # Copy a file into the cache while computing its sha1 (in a single
+        # pass over the data). Returns the path in the cache, the sha1 and
+        # whether the file was new to the cache.
+        stat0 = _get_stat_object(path)
+        if stat0 is None:
+            raise Exception('Unable to stat file: {}'.format(path))
+        ingest_dir = os.path.join(self.directory(), 'ingest')
+        if not os.path.exists(ingest_dir):
+            os.makedirs(ingest_dir, exist_ok=True)
+        tmp_path = os.path.join(ingest_dir, 'file.copying.' + _random_string(10))
+        try:
+            hh = hashlib.sha1()
+            buf = bytearray(_IO_BLOCK_SIZE)
+            view = memoryview(buf)
+            with open(path, 'rb', buffering=0) as f, open(tmp_path, 'wb', buffering=0) as f_out:
+                while True:
+                    num = f.readinto(buf)
+                    if not num:
+                        break
+                    hh.update(view[:num])
+                    _write_all(f_out, view[:num])
+            if _get_stat_object(path) != stat0:
+                raise Exception('File was modified while copying it into the cache: {}'.format(path))
+            sha1 = hh.hexdigest()
+            path0 = self._get_path(sha1, create=True)
+            if os.path.exists(path0):
+                return path0, sha1, False
+            _rename_file(tmp_path, path0, remove_if_exists=False)
+            return path0, sha1, True
+        finally:
+            if os.path.exists(tmp_path):
+                _safe_remove_file(tmp_path)
+
+    def _add_file_with_sha1(self, path: str, sha1: str) -> str:
+        # copy a file whose sha1 is known into the cache
+        path0 = self._get_path(sha1, create=True)
+        if not os.path.exists(path0):
+            tmp_path = path0 + '.copying.' + _random_string(6)
+            try:
+                shutil.copyfile(path, tmp_path)
+                _rename_file(tmp_path, path0, remove_if_exists=False)
+            finally:
+                if os.path.exists(tmp_path):
+                    _safe_remove_file(tmp_path)
+        self._touch(sha1)
+        return path0
+
+    def _file_added(self, sha1: str, path: str) -> None:
+        # a file with new content was added to the (local tier of the) cache
+        shared = self._shared_cache()
+        if shared is None:
+            return
+        mode = self.sharedWriteMode()
+        if mode == 'through':
+            try:
+                self._write_to_shared(shared, sha1, path)
+            except:
+                print('Warning: unable to write file to shared cache: {}'.format(path))
+        elif mode == 'back':
+            writeback_dir = os.path.join(self.directory(), 'writeback')
+            if not os.path.exists(writeback_dir):
+                os.makedirs(writeback_dir, exist_ok=True)
+            with open(os.path.join(writeback_dir, sha1), 'w'):
+                pass
+
+    def _write_to_shared(self, shared: 'Sha1Cache', sha1: str, path: str) -> bool:
+        if os.path.exists(shared._get_path(sha1, create=False)):
+            return False
+        shared._add_file_with_sha1(path, sha1)
+        self._tier_stats['num_files_written_to_shared'] += 1
+        self._tier_stats['num_bytes_written_to_shared'] += os.path.getsize(path)
+        return True
+
+    def _index(self) -> Sha1CacheIndex:
+        return get_sha1_cache_index(self.directory(), backend=self._index_backend)
 
     def _get_path(self, sha1: str, *, create: bool=True, directory: Optional[str]=None) -> str:
         return str(self._get_path_ext(sha1, create=create, directory=directory, return_alternates=False))
@@ -233,72 +986,229 @@ def _compute_file_sha1(path: str) -> Optional[str]:
         return None
     if (os.path.getsize(path) > 1024 * 1024 * 100):
         print('Computing sha1 of {}'.format(path))
-    BLOCKSIZE = 65536
     sha = hashlib.sha1()
-    with open(path, 'rb') as file:
-        buf = file.read(BLOCKSIZE)
-        while len(buf) > 0:
-            sha.update(buf)
-            buf = file.read(BLOCKSIZE)
+    buf = bytearray(_IO_BLOCK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            num = file.readinto(buf)
+            if not num:
+                break
+            sha.update(view[:num])
     return sha.hexdigest()
 
 
-def _get_stat_object(fname: str) -> Optional[Dict]:
+def _write_all(f, data) -> None:
+    while len(data) > 0:
+        num = f.write(data)
+        data = data[num:]
+
+
+def _same_device(path: str, directory: str) -> bool:
     try:
-        stat0 = os.stat(fname)
-        obj = dict(
-            path=fname,
-            size=stat0.st_size,
-            ino=stat0.st_ino,
-            mtime=stat0.st_mtime,
-            ctime=stat0.st_ctime
-        )
-        return obj
+        return os.stat(path).st_dev == os.stat(directory).st_dev
     except:
-        return None
+        return False
+
 
+class _Sha1CachePins():
+    def __init__(self, *, directory: str, sha1s: List[str]):
+        self._directory = directory
+        self._sha1s = list(set(sha1s))
+        self._active = False
+        self._pid = os.getpid()
+        self._add()
 
-def _stat_objects_match(aa: object, bb: object) -> bool:
-    str1 = json.dumps(aa, sort_keys=True)
-    str2 = json.dumps(bb, sort_keys=True)
-    return (str1 == str2)
+    def __enter__(self) -> '_Sha1CachePins':
+        return self
 
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.release()
 
-def _compute_string_sha1(txt: str) -> str:
-    hash_object = hashlib.sha1(txt.encode('utf-8'))
-    return hash_object.hexdigest()
+    def release(self) -> None:
+        if (not self._active) or (os.getpid() != self._pid):
+            return
+        self._active = False
+        with _pins_lock:
+            counts = _process_pins.get(self._directory, dict())
+            for sha1 in self._sha1s:
+                counts[sha1] = counts.get(sha1, 0) - 1
+                if counts[sha1] <= 0:
+                    del counts[sha1]
+            _write_pins_file(self._directory, counts)
 
+    def _add(self) -> None:
+        if not self._sha1s:
+            return
+        self._active = True
+        with _pins_lock:
+            if _process_pins_pid[0] != os.getpid():
+                # we are in a forked child process; the pins of the parent are recorded by the parent
+                _process_pins.clear()
+                _process_pins_pid[0] = os.getpid()
+            counts = _process_pins.setdefault(self._directory, dict())
+            for sha1 in self._sha1s:
+                counts[sha1] = counts.get(sha1, 0) + 1
+            _write_pins_file(self._directory, counts)
 
-def _safe_remove_file(fname: str) -> None:
-    try:
-        os.remove(fname)
-    except:
-        print('Warning: unable to remove file that we thought existed: ' + fname)
 
+# directory -> (sha1 -> count) for the pins held by this process
+_process_pins: Dict[str, Dict[str, int]] = dict()
+_process_pins_pid = [os.getpid()]
+_pins_lock = threading.Lock()
 
-@mtlogging.log()
-def _read_json_file(path: str, *, delete_on_error: bool=False) -> Any:
-    with FileLock(path + '.lock', exclusive=False):
+
+def _pins_file_path(directory: str) -> str:
+    return os.path.join(directory, 'pins', '{}-{}.json'.format(socket.gethostname(), os.getpid()))
+
+
+def _write_pins_file(directory: str, counts: Dict[str, int]) -> None:
+    fname = _pins_file_path(directory)
+    if not counts:
+        if os.path.exists(fname):
+            _safe_remove_file(fname)
+        return
+    if not os.path.exists(os.path.dirname(fname)):
+        try:
+            os.makedirs(os.path.dirname(fname))
+        except:
+            if not os.path.exists(os.path.dirname(fname)):
+                raise Exception('Unable to make directory: ' + os.path.dirname(fname))
+    obj = dict(host=socket.gethostname(), pid=os.getpid(), sha1s=sorted(counts.keys()))
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(obj, f)
+    os.rename(tmp_fname, fname)
+
+
+def _get_pinned_sha1s(directory: str) -> set:
+    ret: set = set()
+    pins_dir = os.path.join(directory, 'pins')
+    if not os.path.exists(pins_dir):
+        return ret
+    hostname = socket.gethostname()
+    for fname in os.listdir(pins_dir):
+        if not fname.endswith('.json'):
+            continue
+        path = os.path.join(pins_dir, fname)
         try:
             with open(path) as f:
-                return json.load(f)
+                obj = json.load(f)
+            mtime = os.path.getmtime(path)
         except:
-            if delete_on_error:
-                print('Warning: Unable to read or parse json file. Deleting: ' + path)
-                try:
-                    os.unlink(path)
-                except:
-                    print('Warning: unable to delete file: ' + path)
-                    pass
-            else:
-                print('Warning: Unable to read or parse json file: ' + path)
-            return None
+            continue
+        if obj.get('host', None) == hostname:
+            if not _pid_exists(obj.get('pid', 0)):
+                # the process exited without releasing its pins
+                _safe_remove_file(path)
+                continue
+        elif time.time() - mtime > _REMOTE_PIN_MAX_AGE:
+            continue
+        ret.update(obj.get('sha1s', []))
+    return ret
+
+
+def _pid_exists(pid: int) -> bool:
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
 
 
-def _write_json_file(obj: object, path: str) -> None:
-    with FileLock(path + '.lock', exclusive=True):
-        with open(path, 'w') as f:
-            json.dump(obj, f)
+def _remove_stale_lock_file(path: str, timestamp: float) -> bool:
+    # A lock file may only be removed when nobody will lock it again:
+    # otherwise a process that opened it before the removal and one that
+    # creates it anew could both hold the lock. Opening a lock file (see
+    # FileLock) truncates it, which updates its modification time, so only
+    # lock files that have not been used since timestamp (and are not held,
+    # e.g. by a long download) are removed.
+    try:
+        if os.path.getmtime(path) > timestamp:
+            return False
+        with open(path, 'r') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # in use
+                return False
+            os.unlink(path)
+            return True
+    except:
+        return False
+
+
+def _all_files_older_than(directory: str, timestamp: float) -> bool:
+    try:
+        for fname in os.listdir(directory):
+            if os.path.getmtime(os.path.join(directory, fname)) > timestamp:
+                return False
+    except:
+        return False
+    return True
+
+
+def _is_sha1(name: str) -> bool:
+    if len(name) != 40:
+        return False
+    try:
+        int(name, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def _materialize_file(path: str, dest_path: str, *, mode: str, allow_symlink: bool) -> str:
+    if mode in ['reflink', 'auto']:
+        if _link_file(path, dest_path, _reflink):
+            return 'reflink'
+    if (mode == 'symlink') and allow_symlink:
+        if _link_file(os.path.abspath(path), dest_path, os.symlink):
+            return 'symlink'
+    if mode in ['hardlink', 'symlink', 'auto']:
+        if _link_file(path, dest_path, os.link):
+            return 'hardlink'
+    copyfile(path, dest_path)
+    return 'copy'
+
+
+def _link_file(path: str, dest_path: str, link_function) -> bool:
+    # create the link next to the destination and then rename, so that an
+    # existing destination file is replaced
+    tmp_path = dest_path + '.linking.' + _random_string(6)
+    try:
+        link_function(path, tmp_path)
+    except (OSError, IOError):
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        return False
+    os.replace(tmp_path, dest_path)
+    return True
+
+
+def _reflink(path: str, dest_path: str) -> None:
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflink is only supported on linux')
+    with open(path, 'rb') as f_src:
+        with open(dest_path, 'wb') as f_dest:
+            fcntl.ioctl(f_dest.fileno(), _FICLONE, f_src.fileno())
+
+
+def _make_read_only(path: str) -> None:
+    try:
+        mode = os.stat(path).st_mode
+        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    except:
+        print('Warning: unable to make cached file read-only: ' + path)
+
+
+def _safe_remove_file(fname: str) -> None:
+    try:
+        os.remove(fname)
+    except:
+        print('Warning: unable to remove file that we thought existed: ' + fname)
 
 
 def _rename_or_copy(path1: str, path2: str) -> None:
@@ -0,0 +1,639 @@
+import os
+import re
+import abc
+import json
+import sqlite3
+import hashlib
+import time
+import threading
+from .filelock import FileLock
+import mtlogging
+from typing import Optional, List, Dict, Any, Tuple
+
+# Index backends for the Sha1Cache. An index stores two kinds of information:
+#
+#   records: stat object of a local file -> sha1 of its content
+#   hints: sha1 -> stat objects of local files known to have that content
+#
+# The sqlite backend also keeps the last access time of each cached sha1, which
+# is used by Sha1Cache.cleanup() for LRU eviction.
+#
+# Both backends record the stats of cached files that share their content with
+# files outside the cache (hard links or symbolic links, see
+# Sha1Cache.linkMode()), so that in-place modifications can be detected.
+#
+# The legacy backend ('json') stores these as individual .record.json and
+# .hints.json files next to the cached content. The default backend ('sqlite')
+# stores everything in a single SQLite database per cache directory, in WAL
+# mode unless the cache directory is on a network file system (where the shared
+# memory needed by WAL mode does not work), in which case the default rollback
+# journal is used. Set SHA1_CACHE_INDEX=json to use the legacy backend. The
+# legacy files are imported into the database once, and are left in place for
+# older clients that share the cache.
+
+_MAX_SQL_VARIABLES = 500
+# File systems (as listed in /proc/mounts) on which WAL mode is not safe
+_NETWORK_FILE_SYSTEMS = set([
+    'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', 'ncpfs', '9p', 'lustre', 'gpfs', 'beegfs',
+    'ceph', 'glusterfs', 'fuse.glusterfs', 'fuse.sshfs', 'fuse.s3fs', 'fuse.cephfs', 'panfs'
+])
+
+
+class Sha1CacheIndex(abc.ABC):
+    def __init__(self, directory: str):
+        self._directory = directory
+
+    def directory(self) -> str:
+        return self._directory
+
+    def getSha1(self, stat_obj: dict) -> Optional[str]:
+        """Return the sha1 recorded for a file with this stat object, or None"""
+        return self.getSha1s([stat_obj])[0]
+
+    @abc.abstractmethod
+    def getSha1s(self, stat_objs: List[dict]) -> List[Optional[str]]:
+        """Batch version of getSha1()"""
+        pass
+
+    def addRecord(self, sha1: str, stat_obj: dict) -> None:
+        """Record the sha1 of a file and add the file as a hint for the sha1"""
+        self.addRecords([(sha1, stat_obj)])
+
+    @abc.abstractmethod
+    def addRecords(self, records: List[Tuple[str, dict]]) -> None:
+        """Batch version of addRecord()"""
+        pass
+
+    @abc.abstractmethod
+    def getHints(self, sha1: str) -> List[dict]:
+        """Return the stat objects of local files that were known to have this sha1"""
+        pass
+
+    @abc.abstractmethod
+    def setHints(self, sha1: str, stat_objs: List[dict]) -> None:
+        """Replace the hints for this sha1"""
+        pass
+
+    def touch(self, sha1s: List[str], timestamp: Optional[float]=None) -> None:
+        """Record that the cached files for these sha1s were accessed"""
+        pass
+
+    def getLastAccessTimes(self, sha1s: List[str]) -> Dict[str, float]:
+        """Return the recorded last access times of these sha1s (missing
+        entries are omitted)"""
+        return dict()
+
+    def forget(self, sha1s: List[str]) -> None:
+        """Remove the access information for sha1s that were evicted"""
+        pass
+
+    @abc.abstractmethod
+    def pruneRecords(self) -> int:
+        """Remove the records and hints of files that no longer exist or have
+        changed. Returns the number of entries removed."""
+        pass
+
+    @abc.abstractmethod
+    def setLinkedStat(self, path: str, stat_obj: dict) -> None:
+        """Record the stats of a cached file that is linked to a file outside
+        the cache"""
+        pass
+
+    @abc.abstractmethod
+    def getLinkedStat(self, path: str) -> Optional[dict]:
+        """Return the stats recorded by setLinkedStat(), or None"""
+        pass
+
+    @abc.abstractmethod
+    def removeLinkedStat(self, path: str) -> None:
+        pass
+
+
+class Sha1CacheIndexJson(Sha1CacheIndex):
+    def __init__(self, directory: str):
+        """Legacy index using .record.json and .hints.json files inside the
+        cache directory, each guarded by a FileLock.
+
+        Parameters
+        ----------
+        directory : str
+            The cache directory
+        """
+        super().__init__(directory)
+
+    def getSha1s(self, stat_objs: List[dict]) -> List[Optional[str]]:
+        ret: List[Optional[str]] = []
+        for stat_obj in stat_objs:
+            ret.append(self._get_sha1(stat_obj))
+        return ret
+
+    def addRecords(self, records: List[Tuple[str, dict]]) -> None:
+        for sha1, stat_obj in records:
+            self._add_record(sha1, stat_obj)
+
+    def getHints(self, sha1: str) -> List[dict]:
+        hints_fname = self._get_path(sha1, create=False) + '.hints.json'
+        if not os.path.exists(hints_fname):
+            return []
+        hints = _read_json_file(hints_fname, delete_on_error=True)
+        if (not hints) or ('files' not in hints):
+            print('Warning: failed to load hints json file, or invalid file. Removing: ' + hints_fname)
+            _safe_remove_file(hints_fname)
+            return []
+        return [file['stat'] for file in hints['files']]
+
+    def setHints(self, sha1: str, stat_objs: List[dict]) -> None:
+        hints_fname = self._get_path(sha1, create=True) + '.hints.json'
+        if not stat_objs:
+            if os.path.exists(hints_fname):
+                _safe_remove_file(hints_fname)
+            return
+        hints = dict(files=[dict(sha1=sha1, stat=stat_obj) for stat_obj in stat_objs])
+        try:
+            _write_json_file(hints, hints_fname)
+        except:
+            print('Warning: problem writing hints file: ' + hints_fname)
+
+    def pruneRecords(self) -> int:
+        num_removed = 0
+        for dirpath, fnames in _walk_cache_subdirectories(self._directory):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                if fname.endswith('.record.json'):
+                    obj = _read_json_file_no_lock(path)
+                    if (not obj) or (not obj.get('stat', None)) or (not _stat_object_is_current(obj['stat'])):
+                        _remove_json_file(path)
+                        num_removed = num_removed + 1
+                elif fname.endswith('.link.json'):
+                    if not os.path.exists(path[:-len('.link.json')]):
+                        _remove_json_file(path)
+                        num_removed = num_removed + 1
+                elif fname.endswith('.hints.json'):
+                    obj = _read_json_file_no_lock(path)
+                    files = obj.get('files', []) if obj else []
+                    files_current = [file for file in files if file.get('stat', None) and _stat_object_is_current(file['stat'])]
+                    if not files_current:
+                        _remove_json_file(path)
+                        num_removed = num_removed + 1
+                    elif len(files_current) != len(files):
+                        try:
+                            _write_json_file(dict(files=files_current), path)
+                        except:
+                            print('Warning: problem writing hints file: ' + path)
+                        num_removed = num_removed + len(files) - len(files_current)
+        return num_removed
+
+    def setLinkedStat(self, path: str, stat_obj: dict) -> None:
+        try:
+            _write_json_file(_normalize_stat_object(stat_obj), path + '.link.json')
+        except:
+            print('Warning: problem writing .link.json file: ' + path + '.link.json')
+
+    def getLinkedStat(self, path: str) -> Optional[dict]:
+        if not os.path.exists(path + '.link.json'):
+            return None
+        return _read_json_file(path + '.link.json', delete_on_error=True)
+
+    def removeLinkedStat(self, path: str) -> None:
+        if os.path.exists(path + '.link.json'):
+            _remove_json_file(path + '.link.json')
+
+    def _get_sha1(self, stat_obj: dict) -> Optional[str]:
+        record_fname = self._get_path(_stat_object_hash(stat_obj), create=False) + '.record.json'
+        if not os.path.exists(record_fname):
+            return None
+        obj = _read_json_file(record_fname, delete_on_error=True)
+        if obj and _stat_objects_match(stat_obj, obj['stat']):
+            return obj.get('sha1', None)
+        return None
+
+    def _add_record(self, sha1: str, stat_obj: dict) -> None:
+        obj = dict(
+            sha1=sha1,
+            stat=stat_obj
+        )
+        record_fname = self._get_path(_stat_object_hash(stat_obj), create=True) + '.record.json'
+        try:
+            _write_json_file(obj, record_fname)
+        except:
+            print('Warning: problem writing .record.json file: ' + record_fname)
+
+        hints_fname = self._get_path(sha1, create=True) + '.hints.json'
+        if os.path.exists(hints_fname):
+            hints = _read_json_file(hints_fname, delete_on_error=True)
+        else:
+            hints = None
+        if not hints:
+            hints = {'files': []}
+        hints['files'].append(obj)
+        try:
+            _write_json_file(hints, hints_fname)
+        except:
+            print('Warning: problem writing .hints.json file: ' + hints_fname)
+
+    def _get_path(self, sha1: str, *, create: bool) -> str:
+        path0 = os.path.join(self._directory, sha1[0], sha1[1:3])
+        if create:
+            _make_dirs(path0)
+        return os.path.join(path0, sha1)
+
+
+class Sha1CacheIndexSqlite(Sha1CacheIndex):
+    def __init__(self, directory: str):
+        """Index stored in a single SQLite database inside the cache
+        directory (in WAL mode, unless the directory is on a network file
+        system). Existing .record.json and .hints.json files are imported the
+        first time the database is opened, and are left in place.
+
+        Connections are opened lazily per process and per thread, so an index
+        object may be shared between threads and survives a fork.
+
+        Parameters
+        ----------
+        directory : str
+            The cache directory
+        """
+        super().__init__(directory)
+        self._db_path = os.path.join(directory, 'sha1-cache-index.db')
+        self._local = threading.local()
+
+    def dbPath(self) -> str:
+        return self._db_path
+
+    def getSha1s(self, stat_objs: List[dict]) -> List[Optional[str]]:
+        paths = list(set([stat_obj['path'] for stat_obj in stat_objs if stat_obj]))
+        rows_by_path: Dict[str, Any] = dict()
+        conn = self._conn()
+        for ii in range(0, len(paths), _MAX_SQL_VARIABLES):
+            chunk = paths[ii:ii + _MAX_SQL_VARIABLES]
+            rows = conn.execute(
+                'SELECT path, size, ino, mtime, ctime, sha1 FROM records WHERE path IN ({})'.format(','.join('?' * len(chunk))),
+                chunk
+            ).fetchall()
+            for row in rows:
+                rows_by_path[row[0]] = row
+        ret: List[Optional[str]] = []
+        for stat_obj in stat_objs:
+            row = rows_by_path.get(stat_obj['path'], None) if stat_obj else None
+            if (row is not None) and (_stat_object_from_row(row) == _normalize_stat_object(stat_obj)):
+                ret.append(row[5])
+            else:
+                ret.append(None)
+        return ret
+
+    def addRecords(self, records: List[Tuple[str, dict]]) -> None:
+        if not records:
+            return
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO records (path, size, ino, mtime, ctime, sha1) VALUES (?, ?, ?, ?, ?, ?)',
+                [_row_from_stat_object(stat_obj) + (sha1,) for sha1, stat_obj in records]
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO hints (sha1, path, size, ino, mtime, ctime) VALUES (?, ?, ?, ?, ?, ?)',
+                [(sha1,) + _row_from_stat_object(stat_obj) for sha1, stat_obj in records]
+            )
+
+    def getHints(self, sha1: str) -> List[dict]:
+        rows = self._conn().execute(
+            'SELECT path, size, ino, mtime, ctime FROM hints WHERE sha1 = ?', (sha1,)
+        ).fetchall()
+        return [_stat_object_from_row(row) for row in rows]
+
+    def setHints(self, sha1: str, stat_objs: List[dict]) -> None:
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM hints WHERE sha1 = ?', (sha1,))
+            conn.executemany(
+                'INSERT OR REPLACE INTO hints (sha1, path, size, ino, mtime, ctime) VALUES (?, ?, ?, ?, ?, ?)',
+                [(sha1,) + _row_from_stat_object(stat_obj) for stat_obj in stat_objs]
+            )
+
+    def touch(self, sha1s: List[str], timestamp: Optional[float]=None) -> None:
+        if not sha1s:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO access (sha1, last_access) VALUES (?, ?)',
+                [(sha1, timestamp) for sha1 in sha1s]
+            )
+
+    def getLastAccessTimes(self, sha1s: List[str]) -> Dict[str, float]:
+        ret: Dict[str, float] = dict()
+        conn = self._conn()
+        for ii in range(0, len(sha1s), _MAX_SQL_VARIABLES):
+            chunk = sha1s[ii:ii + _MAX_SQL_VARIABLES]
+            rows = conn.execute(
+                'SELECT sha1, last_access FROM access WHERE sha1 IN ({})'.format(','.join('?' * len(chunk))),
+                chunk
+            ).fetchall()
+            for row in rows:
+                ret[row[0]] = row[1]
+        return ret
+
+    def forget(self, sha1s: List[str]) -> None:
+        if not sha1s:
+            return
+        conn = self._conn()
+        with conn:
+            conn.executemany('DELETE FROM access WHERE sha1 = ?', [(sha1,) for sha1 in sha1s])
+
+    def pruneRecords(self) -> int:
+        conn = self._conn()
+        stale_records = [
+            (row[0],)
+            for row in conn.execute('SELECT path, size, ino, mtime, ctime FROM records').fetchall()
+            if not _stat_object_is_current(_stat_object_from_row(row))
+        ]
+        stale_hints = [
+            (row[0], row[1])
+            for row in conn.execute('SELECT sha1, path, size, ino, mtime, ctime FROM hints').fetchall()
+            if not _stat_object_is_current(_stat_object_from_row(row[1:]))
+        ]
+        stale_links = [
+            (row[0],)
+            for row in conn.execute('SELECT path FROM links').fetchall()
+            if not os.path.exists(row[0])
+        ]
+        with conn:
+            conn.executemany('DELETE FROM records WHERE path = ?', stale_records)
+            conn.executemany('DELETE FROM hints WHERE sha1 = ? AND path = ?', stale_hints)
+            conn.executemany('DELETE FROM links WHERE path = ?', stale_links)
+        # the legacy .record.json and .hints.json files are left to the
+        # clients that may still use them
+        return len(stale_records) + len(stale_hints) + len(stale_links)
+
+    def setLinkedStat(self, path: str, stat_obj: dict) -> None:
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO links (path, size, ino, mtime, ctime) VALUES (?, ?, ?, ?, ?)',
+                _row_from_stat_object(dict(stat_obj, path=path))
+            )
+
+    def getLinkedStat(self, path: str) -> Optional[dict]:
+        row = self._conn().execute(
+            'SELECT path, size, ino, mtime, ctime FROM links WHERE path = ?', (path,)
+        ).fetchone()
+        if row is None:
+            return None
+        return _stat_object_from_row(row)
+
+    def removeLinkedStat(self, path: str) -> None:
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM links WHERE path = ?', (path,))
+
+    def _conn(self) -> sqlite3.Connection:
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            # new thread, or we are in a forked child process
+            self._local.pid = pid
+            self._local.conn = self._open()
+        return self._local.conn
+
+    def _open(self) -> sqlite3.Connection:
+        _make_dirs(self._directory)
+        conn = sqlite3.connect(self._db_path, timeout=60)
+        if _is_network_file_system(self._directory):
+            conn.execute('PRAGMA journal_mode=DELETE')
+        else:
+            conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS records (path TEXT PRIMARY KEY, size INTEGER, ino TEXT, mtime REAL, ctime REAL, sha1 TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS hints (sha1 TEXT, path TEXT, size INTEGER, ino TEXT, mtime REAL, ctime REAL, PRIMARY KEY (sha1, path))')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS access (sha1 TEXT PRIMARY KEY, last_access REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS links (path TEXT PRIMARY KEY, size INTEGER, ino TEXT, mtime REAL, ctime REAL)')
+        row = conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if row is None:
+            self._migrate_json_records(conn)
+        return conn
+
+    def _migrate_json_records(self, conn: sqlite3.Connection) -> None:
+        # Import the .record.json and .hints.json files of the legacy index.
+        # The files themselves are left in place for older clients.
+        # Do this under a lock so that parallel processes don't all scan the
+        # directory at the same time.
+        with FileLock(self._db_path + '.migrate.lock', exclusive=True):
+            row = conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+            if row is not None:
+                return
+            records: List[Tuple[str, dict]] = []
+            hints: List[Tuple[str, dict]] = []
+            for dirpath, _, fnames in os.walk(self._directory):
+                for fname in fnames:
+                    if fname.endswith('.record.json'):
+                        obj = _read_json_file_no_lock(os.path.join(dirpath, fname))
+                        if obj and obj.get('sha1', None) and obj.get('stat', None):
+                            records.append((obj['sha1'], obj['stat']))
+                    elif fname.endswith('.hints.json'):
+                        obj = _read_json_file_no_lock(os.path.join(dirpath, fname))
+                        if obj and ('files' in obj):
+                            for file in obj['files']:
+                                if file.get('sha1', None) and file.get('stat', None):
+                                    hints.append((file['sha1'], file['stat']))
+            if records or hints:
+                print('Migrating {} records and {} hints to sha1 cache index: {}'.format(len(records), len(hints), self._db_path))
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO records (path, size, ino, mtime, ctime, sha1) VALUES (?, ?, ?, ?, ?, ?)',
+                    [_row_from_stat_object(stat_obj) + (sha1,) for sha1, stat_obj in records]
+                )
+                conn.executemany(
+                    'INSERT OR REPLACE INTO hints (sha1, path, size, ino, mtime, ctime) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(sha1,) + _row_from_stat_object(stat_obj) for sha1, stat_obj in hints]
+                )
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', '1')")
+
+
+_indexes: Dict[Tuple[str, str], Sha1CacheIndex] = dict()
+_indexes_lock = threading.Lock()
+
+
+def get_sha1_cache_index(directory: str, backend: Optional[str]=None) -> Sha1CacheIndex:
+    """Return the (shared) index object for a cache directory
+
+    Parameters
+    ----------
+    directory : str
+        The cache directory
+    backend : Optional[str], optional
+        'sqlite' or 'json'. By default uses the SHA1_CACHE_INDEX environment
+        variable, or 'sqlite' if that is not set.
+    """
+    if backend is None:
+        backend = os.getenv('SHA1_CACHE_INDEX', 'sqlite')
+    key = (backend, os.path.abspath(directory))
+    with _indexes_lock:
+        if key not in _indexes:
+            if backend == 'sqlite':
+                _indexes[key] = Sha1CacheIndexSqlite(directory)
+            elif backend == 'json':
+                _indexes[key] = Sha1CacheIndexJson(directory)
+            else:
+                raise Exception('Invalid sha1 cache index backend: {}'.format(backend))
+        return _indexes[key]
+
+
+def _is_network_file_system(path: str) -> bool:
+    # The type of the file system of the longest mount point containing path
+    # (linux only, elsewhere the file system is assumed to be local)
+    try:
+        with open('/proc/mounts', 'r') as f:
+            lines = f.readlines()
+    except:
+        return False
+    path = os.path.realpath(path)
+    fstype = None
+    mount_point0 = ''
+    for line in lines:
+        vals = line.split()
+        if len(vals) < 3:
+            continue
+        # spaces and the like are escaped as octal
+        mount_point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), vals[1])
+        if (path == mount_point) or path.startswith(mount_point.rstrip('/') + '/'):
+            if len(mount_point) >= len(mount_point0):
+                mount_point0 = mount_point
+                fstype = vals[2]
+    return fstype in _NETWORK_FILE_SYSTEMS
+
+
+def _normalize_stat_object(stat_obj: dict) -> dict:
+    return dict(
+        path=stat_obj['path'],
+        size=stat_obj['size'],
+        ino=stat_obj['ino'],
+        mtime=stat_obj['mtime'],
+        ctime=stat_obj['ctime']
+    )
+
+
+# inode numbers are stored as text because they do not always fit in a signed
+# 64-bit sqlite integer
+def _row_from_stat_object(stat_obj: dict) -> tuple:
+    return (stat_obj['path'], stat_obj['size'], str(stat_obj['ino']), stat_obj['mtime'], stat_obj['ctime'])
+
+
+def _stat_object_from_row(row: tuple) -> dict:
+    return dict(
+        path=row[0],
+        size=row[1],
+        ino=int(row[2]),
+        mtime=row[3],
+        ctime=row[4]
+    )
+
+
+def _get_stat_object(fname: str) -> Optional[Dict]:
+    try:
+        stat0 = os.stat(fname)
+        obj = dict(
+            path=fname,
+            size=stat0.st_size,
+            ino=stat0.st_ino,
+            mtime=stat0.st_mtime,
+            ctime=stat0.st_ctime
+        )
+        return obj
+    except:
+        return None
+
+
+def _stat_object_is_current(stat_obj: dict) -> bool:
+    stat_obj0 = _get_stat_object(stat_obj['path'])
+    if stat_obj0 is None:
+        return False
+    return _normalize_stat_object(stat_obj0) == _normalize_stat_object(stat_obj)
+
+
+def _walk_cache_subdirectories(directory: str):
+    # yields (dirpath, fnames) for the <x>/<yz> subdirectories of a cache directory
+    for name1 in _safe_list_dir(directory):
+        if len(name1) != 1:
+            continue
+        dir1 = os.path.join(directory, name1)
+        for name2 in _safe_list_dir(dir1):
+            if len(name2) != 2:
+                continue
+            dir2 = os.path.join(dir1, name2)
+            if os.path.isdir(dir2):
+                yield dir2, _safe_list_dir(dir2)
+
+
+def _safe_list_dir(path: str) -> List[str]:
+    try:
+        return os.listdir(path)
+    except:
+        return []
+
+
+def _stat_objects_match(aa: object, bb: object) -> bool:
+    str1 = json.dumps(aa, sort_keys=True)
+    str2 = json.dumps(bb, sort_keys=True)
+    return (str1 == str2)
+
+
+def _stat_object_hash(stat_obj: dict) -> str:
+    return hashlib.sha1(json.dumps(stat_obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _make_dirs(path: str) -> None:
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except:
+            if not os.path.exists(path):
+                raise Exception('Unable to make directory: ' + path)
+
+
+def _safe_remove_file(fname: str) -> None:
+    try:
+        os.remove(fname)
+    except:
+        print('Warning: unable to remove file that we thought existed: ' + fname)
+
+
+@mtlogging.log()
+def _read_json_file(path: str, *, delete_on_error: bool=False) -> Any:
+    with FileLock(path + '.lock', exclusive=False):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except:
+            if delete_on_error:
+                print('Warning: Unable to read or parse json file. Deleting: ' + path)
+                try:
+                    os.unlink(path)
+                except:
+                    print('Warning: unable to delete file: ' + path)
+                    pass
+            else:
+                print('Warning: Unable to read or parse json file: ' + path)
+            return None
+
+
+def _read_json_file_no_lock(path: str) -> Any:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except:
+        return None
+
+
+def _remove_json_file(path: str) -> None:
+    with FileLock(path + '.lock', exclusive=True):
+        if os.path.exists(path):
+            _safe_remove_file(path)
+
+
+def _write_json_file(obj: object, path: str) -> None:
+    with FileLock(path + '.lock', exclusive=True):
+        with open(path, 'w') as f:
+            json.dump(obj, f)
@@ -1,34 +1,290 @@
-import string
-import random
-import hashlib
 import os
+import json
+import time
+import hashlib
 import requests
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .filelock import FileLock
+from .httppool import get_http_pool
+from typing import Set, Optional, Iterator
+
+_IO_BLOCK_SIZE = 1024 * 1024
+_NUM_RETRIES = 3
+_RETRY_DELAY = 0.2
+_TIMEOUT = 60
+_PROGRESS_INTERVAL = 5
+# Bytes that may be received at once after the download rate limiter was idle (in seconds of the rate)
+_RATE_LIMIT_BURST = 1.0
+
+
+def steady_download_and_compute_sha1(url: str, target_path: str, chunk_size: int=1024 * 1024 * 10, num_workers: int=4, show_progress: bool=False) -> str:
+    """Download a file over http and return the SHA-1 hash of its content.
+
+    Files larger than chunk_size are downloaded as byte ranges by num_workers
+    threads sharing the pooled keep-alive session for the server. The ranges are written with pwrite into
+    a preallocated partial file (target_path + '.part') and the hash is
+    computed in order as the ranges complete. If the download is interrupted,
+    the partial file and its progress file are left in place, and the next
+    call with the same target_path only downloads the missing ranges.
+    Concurrent calls with the same target_path take turns (holding the lock
+    file target_path + '.lock', which is left in place), and a file that is
+    already at target_path (with the expected size) is not downloaded again.
+
+    Parameters
+    ----------
+    url : str
+        The url of the file
+    target_path : str
+        Where to write the file
+    chunk_size : int, optional
+        The size of the byte ranges, by default 10 MiB
+    num_workers : int, optional
+        The number of ranges downloaded concurrently, by default 4
+    show_progress : bool, optional
+        Periodically print progress and throughput, by default False
+
+    Returns
+    -------
+    str
+        The SHA-1 hash of the downloaded file
+    """
+    session = get_http_pool().session(url)
+    response = get_http_pool().request('HEAD', url, allow_redirects=True, timeout=_TIMEOUT)
+    if response.status_code != 200:
+        raise Exception('Unexpected status code for head request ({}): {}'.format(response.status_code, url))
+    size_bytes = response.headers.get('content-length', None)
+    accepts_ranges = (response.headers.get('accept-ranges', '') == 'bytes')
+    # processes downloading to the same target_path take turns (the lock file
+    # is left in place, see Sha1Cache.cleanup())
+    with FileLock(target_path + '.lock', exclusive=True):
+        if _is_complete(target_path, size_bytes):
+            # downloaded by another process while we were waiting
+            return _compute_file_sha1(target_path)
+        if (size_bytes is None) or (int(size_bytes) <= chunk_size) or (not accepts_ranges):
+            return _download_whole(session, url, target_path)
+        return _download_ranges(session, url, target_path, size_bytes=int(size_bytes), chunk_size=chunk_size, num_workers=num_workers, show_progress=show_progress)
+
+
+class _RateLimiter():
+    def __init__(self, max_bytes_per_sec: float):
+        self._max_bytes_per_sec = max_bytes_per_sec
+        self._lock = threading.Lock()
+        # the time at which the bytes received so far are allowed
+        self._next_time = 0.0
+
+    def consume(self, num_bytes: int) -> None:
+        with self._lock:
+            now = time.time()
+            self._next_time = max(self._next_time, now - _RATE_LIMIT_BURST) + num_bytes / self._max_bytes_per_sec
+            delay = self._next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Shared by all downloads of this process (see download_rate_limit())
+_rate_limiter: Optional[_RateLimiter] = None
 
 
-def steady_download_and_compute_sha1(url, target_path, chunk_size=1024 * 1024 * 10):
-    response = requests.head(url)
-    size_bytes = int(response.headers['content-length'])
-    str = ''.join(random.sample(string.ascii_lowercase, 8))
-    path_tmp = target_path + '.tmp.' + str
+@contextmanager
+def download_rate_limit(max_bytes_per_sec: Optional[float]) -> Iterator[None]:
+    """Limit the total rate of all downloads of this process while the
+    context is active (no limit if max_bytes_per_sec is None)"""
+    global _rate_limiter
+    old_rate_limiter = _rate_limiter
+    _rate_limiter = _RateLimiter(max_bytes_per_sec) if max_bytes_per_sec else None
+    try:
+        yield
+    finally:
+        _rate_limiter = old_rate_limiter
+
+
+def _throttle(num_bytes: int) -> None:
+    rate_limiter = _rate_limiter
+    if rate_limiter is not None:
+        rate_limiter.consume(num_bytes)
+
+
+def _download_whole(session: requests.Session, url: str, target_path: str) -> str:
+    path_part = target_path + '.part'
     try:
         hh = hashlib.sha1()
-        with open(path_tmp, 'wb') as f:
-            for ii in range(0, size_bytes, chunk_size):
-                jj = ii + chunk_size
-                if jj > size_bytes:
-                    jj = size_bytes
-                headers = {
-                    'Range': 'bytes={}-{}'.format(ii, jj - 1)
-                }
-                response = requests.get(url, headers=headers, stream=True)
-                for chunk in response.iter_content(chunk_size=5120):
-                    if chunk:  # filter out keep-alive new chunks
-                        hh.update(chunk)
-                        f.write(chunk)
-        os.rename(path_tmp, target_path)
-        sha1 = hh.hexdigest()
-        return sha1
+        response = session.get(url, stream=True, timeout=_TIMEOUT)
+        if response.status_code != 200:
+            raise Exception('Unexpected status code for get request ({}): {}'.format(response.status_code, url))
+        with open(path_part, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=_IO_BLOCK_SIZE):
+                if chunk:  # filter out keep-alive new chunks
+                    _throttle(len(chunk))
+                    hh.update(chunk)
+                    f.write(chunk)
+        os.rename(path_part, target_path)
+        return hh.hexdigest()
     except:
-        if os.path.exists(path_tmp):
-            os.remove(path_tmp)
+        if os.path.exists(path_part):
+            os.remove(path_part)
         raise
+
+
+def _download_ranges(session: requests.Session, url: str, target_path: str, *, size_bytes: int, chunk_size: int, num_workers: int, show_progress: bool) -> str:
+    path_part = target_path + '.part'
+    path_progress = path_part + '.json'
+    num_chunks = (size_bytes + chunk_size - 1) // chunk_size
+
+    completed: Set[int] = set()
+    if os.path.exists(path_part) and (os.path.getsize(path_part) == size_bytes):
+        completed = _load_progress(path_progress, size_bytes=size_bytes, chunk_size=chunk_size)
+    if completed:
+        print('Resuming download of {} ({} of {} chunks already downloaded)'.format(url, len(completed), num_chunks))
+        fd = os.open(path_part, os.O_RDWR)
+    else:
+        fd = os.open(path_part, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        _preallocate(fd, size_bytes)
+
+    try:
+        hh = hashlib.sha1()
+        next_to_hash = 0
+        num_bytes_downloaded = 0
+        timer = time.time()
+        last_report = timer
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = dict()
+            for ii in range(num_chunks):
+                if ii not in completed:
+                    start = ii * chunk_size
+                    end = min(start + chunk_size, size_bytes)
+                    futures[executor.submit(_download_range, session, url, fd, start, end)] = ii
+            pending = set(futures.keys())
+            while True:
+                # hash the completed chunks in order
+                while (next_to_hash < num_chunks) and (next_to_hash in completed):
+                    start = next_to_hash * chunk_size
+                    _hash_range(fd, hh, start, min(start + chunk_size, size_bytes))
+                    next_to_hash = next_to_hash + 1
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                error = None
+                for future in done:
+                    if future.exception() is not None:
+                        error = future.exception()
+                    else:
+                        ii = futures[future]
+                        completed.add(ii)
+                        num_bytes_downloaded = num_bytes_downloaded + min(chunk_size, size_bytes - ii * chunk_size)
+                _save_progress(path_progress, size_bytes=size_bytes, chunk_size=chunk_size, completed=completed)
+                if error is not None:
+                    for future in pending:
+                        future.cancel()
+                    raise error
+                if show_progress and (time.time() - last_report > _PROGRESS_INTERVAL):
+                    last_report = time.time()
+                    print('Downloaded {} of {} chunks ({})'.format(len(completed), num_chunks, _format_throughput(num_bytes_downloaded, last_report - timer)))
+        elapsed = time.time() - timer
+        if show_progress:
+            print('Downloaded {} bytes in {:.2f} sec ({})'.format(num_bytes_downloaded, elapsed, _format_throughput(num_bytes_downloaded, elapsed)))
+    finally:
+        os.close(fd)
+
+    os.rename(path_part, target_path)
+    if os.path.exists(path_progress):
+        os.remove(path_progress)
+    return hh.hexdigest()
+
+
+def _download_range(session: requests.Session, url: str, fd: int, start: int, end: int) -> None:
+    num_tries = 0
+    while True:
+        try:
+            headers = {
+                'Range': 'bytes={}-{}'.format(start, end - 1)
+            }
+            response = session.get(url, headers=headers, stream=True, timeout=_TIMEOUT)
+            if response.status_code != 206:
+                raise Exception('Unexpected status code for range request ({}): {}'.format(response.status_code, url))
+            offset = start
+            for chunk in response.iter_content(chunk_size=_IO_BLOCK_SIZE):
+                if chunk:
+                    _throttle(len(chunk))
+                    _pwrite_all(fd, chunk, offset)
+                    offset = offset + len(chunk)
+            if offset != end:
+                raise Exception('Incomplete range {}-{} ({} bytes received): {}'.format(start, end - 1, offset - start, url))
+            return
+        except Exception:
+            num_tries = num_tries + 1
+            if num_tries > _NUM_RETRIES:
+                raise
+            time.sleep(_RETRY_DELAY * 2 ** (num_tries - 1))
+
+
+def _is_complete(path: str, size_bytes: Optional[str]) -> bool:
+    # the downloads are renamed into place once complete
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    return (size_bytes is None) or (size == int(size_bytes))
+
+
+def _compute_file_sha1(path: str) -> str:
+    hh = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(_IO_BLOCK_SIZE)
+            if not buf:
+                break
+            hh.update(buf)
+    return hh.hexdigest()
+
+
+def _hash_range(fd: int, hh, start: int, end: int) -> None:
+    offset = start
+    while offset < end:
+        buf = os.pread(fd, min(_IO_BLOCK_SIZE, end - offset), offset)
+        if not buf:
+            raise Exception('Unexpected end of partial download file')
+        hh.update(buf)
+        offset = offset + len(buf)
+
+
+def _pwrite_all(fd: int, data: bytes, offset: int) -> None:
+    view = memoryview(data)
+    while len(view) > 0:
+        num_written = os.pwrite(fd, view, offset)
+        view = view[num_written:]
+        offset = offset + num_written
+
+
+def _preallocate(fd: int, size: int) -> None:
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except:
+        # not supported on all platforms and file systems
+        os.ftruncate(fd, size)
+
+
+def _load_progress(path: str, *, size_bytes: int, chunk_size: int) -> Set[int]:
+    try:
+        with open(path) as f:
+            obj = json.load(f)
+    except:
+        return set()
+    if (obj.get('size', None) != size_bytes) or (obj.get('chunk_size', None) != chunk_size):
+        return set()
+    return set(obj.get('completed', []))
+
+
+def _save_progress(path: str, *, size_bytes: int, chunk_size: int, completed: Set[int]) -> None:
+    obj = dict(size=size_bytes, chunk_size=chunk_size, completed=sorted(completed))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.rename(path + '.tmp', path)
+
+
+def _format_throughput(num_bytes: int, elapsed: float) -> str:
+    if elapsed <= 0:
+        return '- MiB/s'
+    return '{:.1f} MiB/s'.format(num_bytes / elapsed / (1024 * 1024))
+
@@ -1 +1,2 @@
 from .mtlogging import log, sublog
+from .metrics import observe, histograms, reset_histograms, write_histograms, enable_histograms, histograms_enabled
@@ -0,0 +1,98 @@
+import os
+import threading
+from typing import Dict, List, Optional
+
+# Histograms of timings (e.g., lock wait times) keyed by metric name and label.
+# The number of labels per metric is bounded; observations for additional
+# labels are counted under '(other)'. Nothing is recorded unless the
+# histograms are enabled, with enable_histograms() or by setting the
+# MTLOGGING_HISTOGRAMS=TRUE environment variable.
+
+_DEFAULT_BUCKETS = [0.001, 0.01, 0.1, 1, 10, 100]
+_MAX_LABELS_PER_METRIC = 1000
+
+
+class Histogram():
+    def __init__(self, buckets: List[float]=_DEFAULT_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0 for _ in range(len(buckets) + 1)]
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+
+    def observe(self, value: float) -> None:
+        ii = 0
+        while (ii < len(self._buckets)) and (value > self._buckets[ii]):
+            ii = ii + 1
+        self._counts[ii] += 1
+        self._count += 1
+        self._sum += value
+        self._max = max(self._max, value)
+
+    def getObject(self) -> dict:
+        return dict(
+            count=self._count,
+            sum=self._sum,
+            max=self._max,
+            buckets=[dict(le=le, count=count) for le, count in zip(self._buckets + [None], self._counts)]
+        )
+
+
+_histograms: Dict[str, Dict[str, Histogram]] = dict()
+_lock = threading.Lock()
+_enabled = (os.environ.get('MTLOGGING_HISTOGRAMS', '') == 'TRUE')
+
+
+def enable_histograms(enabled: bool=True) -> None:
+    """Turn on or off the recording of observations"""
+    global _enabled
+    _enabled = enabled
+
+
+def histograms_enabled() -> bool:
+    return _enabled
+
+
+def observe(name: str, label: str, value: float) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        hh = _histograms.setdefault(name, dict())
+        if (label not in hh) and (len(hh) >= _MAX_LABELS_PER_METRIC):
+            label = '(other)'
+        if label not in hh:
+            hh[label] = Histogram()
+        hh[label].observe(value)
+
+
+def histograms(name: Optional[str]=None) -> dict:
+    """Return the histograms as a dict: name -> label -> histogram object"""
+    with _lock:
+        return dict([
+            (name0, dict([(label, h.getObject()) for label, h in hh.items()]))
+            for name0, hh in _histograms.items()
+            if (name is None) or (name0 == name)
+        ])
+
+
+def reset_histograms() -> None:
+    with _lock:
+        _histograms.clear()
+
+
+def write_histograms(name: Optional[str]=None, *, max_labels: int=20) -> None:
+    """Print the histograms, with the labels of each metric sorted by total
+    time (only the first max_labels)"""
+    for name0, hh in sorted(histograms(name).items()):
+        print('')
+        print('=== {} ==='.format(name0))
+        labels = sorted(hh.keys(), key=lambda label: hh[label]['sum'], reverse=True)
+        for label in labels[0:max_labels]:
+            obj = hh[label]
+            counts = ' '.join([
+                '{}{}:{}'.format('<=' if b['le'] is not None else '>', b['le'] if b['le'] is not None else obj['buckets'][-2]['le'], b['count'])
+                for b in obj['buckets'] if b['count'] > 0
+            ])
+            print('{}: {} calls, {:.3f} sec total, {:.3f} sec max [{}]'.format(label, obj['count'], obj['sum'], obj['max'], counts))
+        if len(labels) > max_labels:
+            print('... and {} more'.format(len(labels) - max_labels))
@@ -20,7 +20,10 @@ setuptools.setup(
         'bin/mt-resolve-key-path',
         'bin/mt-find',
         'bin/kachery-token',
-        'bin/mt-execute-job'
+        'bin/mt-execute-job',
+        'bin/mt-cache-gc',
+        'bin/mt-migrate-local-db',
+        'bin/mt-prefetch'
     ],
     install_requires=[
         'matplotlib', 'requests', 'ipython', 'simple-crypt', 'python-dotenv', 'simplejson'
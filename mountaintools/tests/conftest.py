@@ -0,0 +1,38 @@
+import os
+import json
+import pytest
+import mlprocessors as mlpr
+from standin_servers import KacheryStandin
+
+
+@pytest.fixture
+def kachery_server():
+    """A local stand-in for a kachery server (see standin_servers.py)"""
+    with KacheryStandin() as server:
+        yield server
+
+
+@pytest.fixture
+def run_jobs(tmp_path):
+    """Returns a function that runs jobs of a processor on a job handler, and
+    returns their results and the json written by each job to its json_out
+    output (None if the job failed). Each job also gets a unique token
+    parameter, so that its result is not taken from the cache."""
+    def run(processor, job_handler, argslist):
+        token = os.urandom(8).hex()
+        paths = [str(tmp_path / 'out-{}.json'.format(ii)) for ii in range(len(argslist))]
+        with mlpr.JobQueue(job_handler=job_handler) as jq:
+            results = [
+                processor.execute(json_out=paths[ii], token='{}-{}'.format(token, ii), **args)
+                for ii, args in enumerate(argslist)
+            ]
+            assert jq.wait(timeout=60)
+        records = []
+        for r, path in zip(results, paths):
+            if r.retcode == 0:
+                with open(path, 'r') as f:
+                    records.append(json.load(f))
+            else:
+                records.append(None)
+        return results, records
+    return run
@@ -0,0 +1,192 @@
+import re
+import abc
+import json
+import base64
+import hashlib
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import Dict, List, Optional, Set, Tuple
+
+# Local stand-ins for a kachery server and a pairio server, implementing just
+# enough of their http APIs for the tests (see the kachery_server fixture in
+# conftest.py) and the benchmarks. Tokens and signatures are not checked. An
+# optional latency (seconds per request) simulates a remote server, and
+# failures can be injected to exercise the retries of the clients.
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _StandinServer(abc.ABC):
+    def __init__(self, *, latency: float=0):
+        self._latency = latency
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        # 'METHOD /path?query' of each request
+        self.requests: List[str] = []
+        # the client ports of the connections (to check that they are kept alive)
+        self.client_ports: Set[int] = set()
+        # the next num_failures requests are answered with 503
+        self.num_failures = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_HEAD(self):
+                server._handle(self, 'HEAD', b'')
+
+            def do_GET(self):
+                server._handle(self, 'GET', b'')
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                server._handle(self, 'POST', body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self._httpd.server_address[1])
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str, body: bytes) -> None:
+        with self._lock:
+            self.num_requests += 1
+            self.requests.append(method + ' ' + handler.path)
+            self.client_ports.add(handler.client_address[1])
+            fail = (self.num_failures > 0)
+            if fail:
+                self.num_failures -= 1
+        if self._latency:
+            threading.Event().wait(self._latency)
+        path = handler.path.split('?')[0]
+        if fail:
+            code, headers, data = 503, {}, b''
+        else:
+            code, headers, data = self._respond(method, path, handler.headers, body)
+        handler.send_response(code)
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        if method != 'HEAD':
+            handler.wfile.write(data)
+
+    @abc.abstractmethod
+    def _respond(self, method: str, path: str, headers, body: bytes):
+        """Return the status code, headers and body of the response"""
+        pass
+
+
+def _json_response(obj: dict):
+    return 200, {'Content-Type': 'application/json'}, json.dumps(obj).encode('utf-8')
+
+
+class KacheryStandin(_StandinServer):
+    def __init__(self, *, latency: float=0):
+        """Stand-in for a kachery server (check, batch check, download with
+        range requests, and upload of files by sha1)"""
+        super().__init__(latency=latency)
+        self._contents: Dict[str, bytes] = dict()
+        # whether POST /check/sha1 is supported (older servers answer 404)
+        self.batch_check = True
+        # (start, end) of each range request
+        self.requested_ranges: List[Tuple[int, int]] = []
+        # range requests starting at these offsets are answered with 500
+        self.failing_ranges: Set[int] = set()
+
+    def addContent(self, data: bytes) -> str:
+        sha1 = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            self._contents[sha1] = data
+        return sha1
+
+    def numFiles(self) -> int:
+        return len(self._contents)
+
+    def downloadUrl(self, sha1: str) -> str:
+        return self.url + '/get/sha1/' + sha1
+
+    def _respond(self, method: str, path: str, headers, body: bytes):
+        m = re.match(r'^/check/sha1/([0-9a-f]{40})$', path)
+        if m:
+            data = self._contents.get(m.group(1), None)
+            return _json_response(dict(success=True, found=(data is not None), size=len(data or b'')))
+        if (path == '/check/sha1') and (method == 'POST') and self.batch_check:
+            sha1s: List[str] = json.loads(body)['sha1s']
+            results = []
+            for sha1 in sha1s:
+                data = self._contents.get(sha1, None)
+                results.append(dict(found=(data is not None), size=len(data or b'')))
+            return _json_response(dict(success=True, results=results))
+        m = re.match(r'^/get/sha1/([0-9a-f]{40})$', path)
+        if m:
+            data = self._contents.get(m.group(1), None)
+            if data is None:
+                return 404, {}, b''
+            range_header: Optional[str] = headers.get('Range', None)
+            m2 = re.match(r'^bytes=(\d+)-(\d*)$', range_header or '')
+            if m2:
+                i1 = int(m2.group(1))
+                i2 = int(m2.group(2)) + 1 if m2.group(2) else len(data)
+                with self._lock:
+                    self.requested_ranges.append((i1, i2))
+                if i1 in self.failing_ranges:
+                    return 500, {}, b''
+                return 206, {'Content-Range': 'bytes {}-{}/{}'.format(i1, i2 - 1, len(data))}, data[i1:i2]
+            return 200, {'Accept-Ranges': 'bytes'}, data
+        m = re.match(r'^/set/sha1/([0-9a-f]{40})$', path)
+        if m and (method == 'POST'):
+            if hashlib.sha1(body).hexdigest() != m.group(1):
+                return _json_response(dict(success=False, error='Unexpected sha1 of uploaded data'))
+            self.addContent(body)
+            return _json_response(dict(success=True))
+        return 404, {}, b''
+
+
+class PairioStandin(_StandinServer):
+    def __init__(self, *, latency: float=0):
+        """Stand-in for a pairio server (get, set and remove of values by
+        collection and key hash)"""
+        super().__init__(latency=latency)
+        self._values: Dict[str, str] = dict()
+
+    def _respond(self, method: str, path: str, headers, body: bytes):
+        # /get/<collection>/<keyhash>, /set/<collection>/<keyhash>/<base64 value>
+        # or /remove/<collection>/<keyhash> (subkeys are not supported)
+        parts = path.split('/')[1:]
+        if len(parts) < 3:
+            return 404, {}, b''
+        key = parts[1] + '/' + parts[2]
+        if (parts[0] == 'get') and (len(parts) == 3):
+            if key not in self._values:
+                return _json_response(dict(success=False, error='Not found'))
+            return _json_response(dict(success=True, value=self._values[key]))
+        if (parts[0] == 'set') and (len(parts) >= 4):
+            # the base64 value may itself contain slashes
+            with self._lock:
+                self._values[key] = base64.b64decode('/'.join(parts[3:])).decode('utf-8')
+            return _json_response(dict(success=True))
+        if (parts[0] == 'remove') and (len(parts) == 3):
+            with self._lock:
+                self._values.pop(key, None)
+            return _json_response(dict(success=True))
+        return 404, {}, b''
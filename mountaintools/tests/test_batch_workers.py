@@ -0,0 +1,93 @@
+import os
+import time
+import socket
+import struct
+import threading
+import pytest
+import mlprocessors as mlpr
+from mlprocessors.workerprotocol import MessageConnection
+
+
+class AppendLine(mlpr.Processor):
+    NAME = 'AppendLine'
+    VERSION = '0.1.0'
+
+    textfile = mlpr.Input(help="input text file")
+    textfile_out = mlpr.Output(help="output text file")
+    line = mlpr.StringParameter(help="line to append")
+
+    def run(self):
+        with open(self.textfile, 'r') as f:
+            txt = f.read()
+        with open(self.textfile_out, 'w') as f:
+            f.write(txt + self.line + '\n')
+
+
+def test_message_connection():
+    sock1, sock2 = socket.socketpair()
+    c1 = MessageConnection(sock1)
+    c2 = MessageConnection(sock2)
+    big = 'x' * 1000000
+    # the big message does not fit in the socket buffer
+    sender = threading.Thread(target=lambda: c1.send(dict(type='job', data=big)) and c1.send(dict(type='heartbeat')))
+    sender.start()
+    assert c2.receive(timeout=5) == dict(type='job', data=big)
+    assert c2.receive(timeout=5) == dict(type='heartbeat')
+    sender.join()
+    assert c2.receive() is None
+    assert not c2.isClosed()
+    c1.close()
+    assert c2.receive(timeout=5) is None
+    assert c2.isClosed()
+    c2.close()
+
+
+def test_unexpected_connections_are_closed(tmp_path):
+    from mlprocessors.slurmjobhandler import _Batch
+    tmpdir = str(tmp_path)
+    batch_type = dict(num_workers_per_batch=1, num_cores_per_job=1, use_slurm=False, time_limit_per_batch=None, additional_srun_opts=[], transport='socket')
+    batch = _Batch(tmpdir + '/batch', 'test batch', 'default', batch_type)
+    # listen as in _Batch.start(), without starting the workers
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(5)
+    server_socket.setblocking(False)
+    batch._server_socket = server_socket
+    clients = [socket.create_connection(server_socket.getsockname(), timeout=5) for _ in range(3)]
+    clients[0].sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    clients[1].sendall(struct.pack('>I', 10) + b'not json!!')
+    MessageConnection(clients[2]).send(dict(type='hello', token=batch._token))
+    timer = time.time()
+    while (batch._workers[0].connection() is None) or batch._unidentified_connections:
+        assert time.time() - timer < 5
+        batch._accept_connections()
+        time.sleep(0.01)
+    assert clients[0].recv(100) == b''
+    assert clients[1].recv(100) == b''
+    batch._workers[0].connection().close()
+    server_socket.close()
+    for c in clients:
+        c.close()
+
+
+@pytest.mark.parametrize('transport', ['socket', 'files'])
+def test_batch_workers(transport, tmp_path):
+    tmpdir = str(tmp_path)
+    token = os.urandom(8).hex()
+    with open(tmpdir + '/input.txt', 'w') as f:
+        f.write(token + '\n')
+    job_handler = mlpr.SlurmJobHandler(working_dir=tmpdir + '/working_dir')
+    job_handler.addBatchType(name='default', num_workers_per_batch=2, num_cores_per_job=1, use_slurm=False, transport=transport)
+    with mlpr.JobQueue(job_handler=job_handler) as jq:
+        results = []
+        for chain in ['a', 'b']:
+            textfile = tmpdir + '/input.txt'
+            for ii in range(2):
+                r = AppendLine.execute(textfile=textfile, textfile_out=tmpdir + '/{}-{}.txt'.format(chain, ii), line='{}{}'.format(chain, ii))
+                results.append(r)
+                textfile = r.outputs['textfile_out']
+        assert jq.wait(timeout=120)
+    assert all([r.retcode == 0 for r in results])
+    for chain in ['a', 'b']:
+        with open(tmpdir + '/{}-1.txt'.format(chain), 'r') as f:
+            assert f.read() == '{}\n{}0\n{}1\n'.format(token, chain, chain)
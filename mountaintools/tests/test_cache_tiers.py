@@ -0,0 +1,61 @@
+import os
+import pathlib
+import hashlib
+from mountainclient.sha1cache import Sha1Cache
+
+
+def _make_cache(directory, shared_directory, write_mode):
+    cache = Sha1Cache()
+    cache.setDirectory(directory)
+    cache.setSharedDirectory(shared_directory)
+    cache.setSharedWriteMode(write_mode)
+    return cache
+
+
+def test_write_through_and_promotion(tmp_path):
+    tmpdir = str(tmp_path)
+    node1 = _make_cache(tmpdir + '/node1', tmpdir + '/shared', 'through')
+    node2 = _make_cache(tmpdir + '/node2', tmpdir + '/shared', 'through')
+    data = os.urandom(10000)
+    sha1 = hashlib.sha1(data).hexdigest()
+    pathlib.Path(tmpdir + '/file.dat').write_bytes(data)
+    path1, _ = node1.copyFileToCache(tmpdir + '/file.dat')
+    os.unlink(tmpdir + '/file.dat')
+    assert node1.tierStats()['num_files_written_to_shared'] == 1
+    shared_path = node1._shared_cache()._get_path(sha1, create=False)
+    assert os.path.exists(shared_path)
+
+    # promoted into the local tier of the other node on read
+    path2 = node2.findFile(sha1)
+    assert path2 == node2._get_path(sha1, create=False)
+    with open(path2, 'rb') as f:
+        assert f.read() == data
+    assert node2.findFile(sha1) == path2
+    assert node2.findFile(hashlib.sha1(b'other').hexdigest()) is None
+    stats = node2.tierStats()
+    assert (stats['shared_hits'], stats['local_hits'], stats['misses']) == (1, 1, 1)
+    assert stats['num_bytes_promoted'] == len(data)
+
+
+def test_write_back_and_tier_limits(tmp_path):
+    tmpdir = str(tmp_path)
+    node = _make_cache(tmpdir + '/node', tmpdir + '/shared', 'back')
+    sha1s = []
+    for ii in range(3):
+        data = os.urandom(10000)
+        sha1s.append(hashlib.sha1(data).hexdigest())
+        pathlib.Path(tmpdir + '/file.dat').write_bytes(data)
+        node.copyFileToCache(tmpdir + '/file.dat')
+    os.unlink(tmpdir + '/file.dat')
+    shared = node._shared_cache()
+    assert not any([os.path.exists(shared._get_path(sha1, create=False)) for sha1 in sha1s])
+
+    # pending files are written back before anything is evicted
+    stats = node.cleanup(max_bytes=10000, shared_max_bytes=20000)
+    assert stats['num_files_written_to_shared'] == 3
+    assert stats['num_files_evicted'] == 2
+    assert stats['shared']['num_files_evicted'] == 1
+    assert node.flushSharedWrites() == 0
+    # every file is still available from one of the tiers
+    assert sum([os.path.exists(node._get_path(sha1, create=False)) for sha1 in sha1s]) == 1
+    assert sum([os.path.exists(shared._get_path(sha1, create=False)) for sha1 in sha1s]) == 2
@@ -0,0 +1,79 @@
+import io
+import pathlib
+import os
+import hashlib
+import numpy as np
+from mountainclient.sha1cache import Sha1Cache
+from mountainclient.chunkstore import iter_chunks
+
+
+def _random_bytes(num_bytes, seed):
+    return np.random.RandomState(seed).randint(0, 256, size=num_bytes).astype(np.uint8).tobytes()
+
+
+def test_content_defined_chunks():
+    data = _random_bytes(2 * 1024 * 1024, seed=1)
+    # insert some bytes near the beginning
+    data2 = data[:1000] + b'inserted' + data[1000:]
+    opts = dict(min_size=4096, avg_bits=14, max_size=65536)
+    chunks = list(iter_chunks(io.BytesIO(data), **opts))
+    chunks2 = list(iter_chunks(io.BytesIO(data2), **opts))
+    assert b''.join(chunks) == data
+    assert b''.join(chunks2) == data2
+    assert all([4096 <= len(c) <= 65536 for c in chunks[:-1]])
+    # only the chunks around the insertion differ
+    assert len(set(chunks) - set(chunks2)) <= 2
+    assert len(set(chunks)) > 20
+
+
+def test_sha1cache_chunking(tmp_path):
+    tmpdir = str(tmp_path)
+    cache = Sha1Cache()
+    cache.setDirectory(tmpdir + '/cache')
+    cache.setChunking(True)
+
+    data1 = _random_bytes(12 * 1024 * 1024, seed=2)
+    data2 = data1[:5 * 1024 * 1024] + _random_bytes(1000, seed=3) + data1[5 * 1024 * 1024:]
+    sha1s = []
+    for ii, data in enumerate([data1, data2]):
+        fname = tmpdir + '/file{}.dat'.format(ii)
+        pathlib.Path(fname).write_bytes(data)
+        path0, sha1 = cache.copyFileToCache(fname)
+        assert sha1 == hashlib.sha1(data).hexdigest()
+        # the cached file does not depend on the original file
+        assert path0 == cache._get_path(sha1, create=False)
+        os.remove(fname)
+        with open(path0, 'rb') as f:
+            assert f.read() == data
+        sha1s.append(sha1)
+    stats = cache.cleanup()
+    assert stats['num_files'] == 2
+    assert stats['num_chunked_files'] == 2
+    # the near-duplicate file adds only a few chunks
+    assert stats['num_chunk_bytes'] < len(data1) + 6 * 1024 * 1024
+
+    # the whole files are evicted first, since they can be reassembled
+    stats = cache.cleanup(max_bytes=stats['num_chunk_bytes'])
+    assert (stats['num_files_evicted'], stats['num_chunked_files_evicted']) == (2, 0)
+
+    # read through the chunks without reassembling
+    with cache.openFile(sha1s[1]) as f:
+        f.seek(5 * 1024 * 1024 - 10)
+        assert f.read(1020) == data2[5 * 1024 * 1024 - 10:5 * 1024 * 1024 + 1010]
+    assert not os.path.exists(cache._get_path(sha1s[1], create=False))
+
+    # findFile reassembles the file into the cache
+    path = cache.findFile(sha1s[0])
+    assert path == cache._get_path(sha1s[0], create=False)
+    with open(path, 'rb') as f:
+        assert f.read() == data1
+
+    # the reassembled file is evicted first, then the chunked files
+    stats = cache.cleanup(max_bytes=stats['num_chunk_bytes'])
+    assert (stats['num_files_evicted'], stats['num_chunked_files_evicted']) == (1, 0)
+    with cache.pinFiles([sha1s[1]]):
+        stats = cache.cleanup(max_bytes=len(data2) + 1024 * 1024)
+    assert stats['num_chunked_files_evicted'] == 1
+    assert cache.findFile(sha1s[0]) is None
+    with cache.openFile(sha1s[1]) as f:
+        assert f.read() == data2
@@ -0,0 +1,93 @@
+import os
+import pathlib
+import time
+import hashlib
+import numpy as np
+from mountainclient.sha1cache import Sha1Cache
+from mountainclient.coldstore import ColdStore
+
+
+def _compressible_bytes(num_bytes, seed):
+    # small integers, like typical timeseries
+    return np.random.RandomState(seed).randint(-20, 20, size=num_bytes // 2).astype(np.int16).tobytes()
+
+
+def _make_old(path):
+    t = time.time() - 10 * 24 * 3600
+    os.utime(path, (t, t))
+
+
+def test_cold_store(tmp_path):
+    tmpdir = str(tmp_path)
+    store = ColdStore(tmpdir + '/cold', codec='zlib')
+    data = _compressible_bytes(3 * 1024 * 1024 + 1234, seed=1)
+    sha1 = hashlib.sha1(data).hexdigest()
+    pathlib.Path(tmpdir + '/file.dat').write_bytes(data)
+    compressed_size = store.addFile(tmpdir + '/file.dat', sha1)
+    assert compressed_size is not None
+    assert compressed_size < len(data) / 2
+    assert store.hasFile(sha1)
+
+    # random access without expanding the file
+    with store.openFile(sha1) as f:
+        assert f.size() == len(data)
+        f.seek(1024 * 1024 - 10)
+        assert f.read(100) == data[1024 * 1024 - 10:1024 * 1024 + 90]
+        f.seek(-5, os.SEEK_END)
+        assert f.read() == data[-5:]
+
+    assert store.decompressFile(sha1, tmpdir + '/file2.dat')
+    with open(tmpdir + '/file2.dat', 'rb') as f:
+        assert f.read() == data
+
+    # incompressible files are not stored
+    data2 = os.urandom(100000)
+    pathlib.Path(tmpdir + '/random.dat').write_bytes(data2)
+    assert store.addFile(tmpdir + '/random.dat', hashlib.sha1(data2).hexdigest()) is None
+    assert [sha1_ for sha1_, _, _ in store.listFiles()] == [sha1]
+
+
+def test_sha1cache_compressed_tier(tmp_path):
+    tmpdir = str(tmp_path)
+    cache = Sha1Cache()
+    cache.setDirectory(tmpdir + '/cache')
+
+    data_old = _compressible_bytes(2 * 1024 * 1024, seed=2)
+    data_new = _compressible_bytes(2 * 1024 * 1024, seed=3)
+    paths = dict()
+    for name, data in [('old', data_old), ('new', data_new)]:
+        pathlib.Path(tmpdir + '/' + name + '.dat').write_bytes(data)
+        paths[name], _ = cache.copyFileToCache(tmpdir + '/' + name + '.dat')
+        os.unlink(tmpdir + '/' + name + '.dat')
+    sha1_old = hashlib.sha1(data_old).hexdigest()
+    _make_old(paths['old'])
+    cache._index().forget([sha1_old])
+
+    stats = cache.cleanup(compress_idle_sec=24 * 3600, dry_run=True)
+    assert stats['num_files_compressed'] == 1
+    assert os.path.exists(paths['old'])
+
+    stats = cache.cleanup(compress_idle_sec=24 * 3600)
+    assert stats['num_files_compressed'] == 1
+    assert stats['num_files'] == 1
+    assert stats['num_compressed_files'] == 1
+    assert not os.path.exists(paths['old'])
+    assert os.path.exists(paths['new'])
+
+    # read without expanding
+    with cache.openFile(sha1_old) as f:
+        f.seek(1000)
+        assert f.read(10) == data_old[1000:1010]
+    assert not os.path.exists(paths['old'])
+
+    # expanded into the cache when needed
+    assert cache.findFile(sha1_old) == paths['old']
+    with open(paths['old'], 'rb') as f:
+        assert f.read() == data_old
+
+    # the expanded copy goes first when evicting
+    stats = cache.cleanup(max_bytes=stats['num_bytes'])
+    assert stats['num_files_evicted'] == 1
+    assert not os.path.exists(paths['old'])
+    assert os.path.exists(paths['new'])
+    assert cache.findFile(sha1_old) == paths['old']
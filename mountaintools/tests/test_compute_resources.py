@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import threading
+import pytest
+import mlprocessors as mlpr
+from mlprocessors.computeresources import local_client, estimatedPeakMemoryGb, recordPeakMemory, jobResources
+
+
+class RecordJob(mlpr.Processor):
+    NAME = 'RecordJob'
+    VERSION = '0.1.0'
+    COMPUTE_REQUIREMENTS = dict(memory_gb=2)
+
+    json_out = mlpr.Output(help="output json file")
+    token = mlpr.StringParameter(help="token to make the job unique")
+    duration = mlpr.FloatParameter(optional=True, default=0, help="how long to run (seconds)")
+    memory_mb = mlpr.IntegerParameter(optional=True, default=0, help="memory to allocate (MB)")
+
+    def run(self):
+        t0 = time.time()
+        x = bytearray(self.memory_mb * 1024 * 1024)
+        time.sleep(self.duration)
+        with open(self.json_out, 'w') as f:
+            json.dump(dict(t0=t0, t1=time.time(), cuda=os.environ.get('CUDA_VISIBLE_DEVICES', None), size=len(x)), f)
+
+
+def test_declared_compute_requirements():
+    jobs = RecordJob.createJobs([
+        dict(json_out='out.json', token='a'),
+        dict(json_out='out.json', token='b', _compute_requirements=dict(num_cores=4, num_gpus=1, batch_type='gpu'))
+    ])
+    assert jobs[0].getObject()['compute_requirements'] == dict(num_cores=1, memory_gb=2, num_gpus=0)
+    assert jobs[1].getObject()['compute_requirements'] == dict(num_cores=4, memory_gb=2, num_gpus=1, batch_type='gpu')
+    with pytest.raises(Exception):
+        RecordJob.createJobs([dict(json_out='out.json', token='c', _compute_requirements=dict(num_cores=-1))])
+
+
+def test_peak_memory_is_learned(tmp_path):
+    tmpdir = str(tmp_path)
+    r = RecordJob.execute(json_out=tmpdir + '/out.json', token=os.urandom(8).hex(), memory_mb=300)
+    assert r.retcode == 0
+    if 'peak_memory_gb' not in r.runtime_info:
+        pytest.skip('Peak memory is not measured on this system')
+    assert r.runtime_info['peak_memory_gb'] >= 0.29
+    # the estimate is at least the largest recent peak
+    assert estimatedPeakMemoryGb(processor_name='RecordJob', processor_version='0.1.0') >= r.runtime_info['peak_memory_gb']
+
+
+def test_concurrent_peak_memory_records():
+    processor_name = 'TestProcessor-' + os.urandom(8).hex()
+
+    def record(ii):
+        for jj in range(5):
+            recordPeakMemory(processor_name=processor_name, processor_version='0.1.0', peak_memory_gb=ii * 5 + jj + 1)
+    threads = [threading.Thread(target=record, args=(ii,)) for ii in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # none of the peaks was lost, and only the most recent ones are kept
+    assert estimatedPeakMemoryGb(processor_name=processor_name, processor_version='0.1.0') == pytest.approx(20 * 1.2)
+    for _ in range(20):
+        recordPeakMemory(processor_name=processor_name, processor_version='0.1.0', peak_memory_gb=0.5)
+    assert estimatedPeakMemoryGb(processor_name=processor_name, processor_version='0.1.0') == pytest.approx(0.5 * 1.2)
+    # the recent peaks are kept in a single record
+    key = dict(name='mlprocessors_peak_memories', processor_name=processor_name, processor_version='0.1.0')
+    assert json.loads(local_client.getValue(key=key)) == [0.5] * 20
+    assert not local_client.getSubKeys(key=key)
+
+
+def test_declared_memory_is_respected():
+    processor_name = 'TestProcessor-' + os.urandom(8).hex()
+    recordPeakMemory(processor_name=processor_name, processor_version='0.1.0', peak_memory_gb=0.5)
+    job_object = dict(processor_name=processor_name, processor_version='0.1.0', compute_requirements=dict(memory_gb=4))
+    assert jobResources(job_object)['memory_gb'] == 4
+    # the learned memory is only used when none is declared
+    job_object['compute_requirements'] = dict()
+    assert jobResources(job_object)['memory_gb'] == pytest.approx(0.5 * 1.2)
+    assert jobResources(job_object, use_learned_memory=False)['memory_gb'] == 0
+
+
+def test_jobs_are_packed_largest_first(run_jobs):
+    argslist = [dict(duration=0.1, _compute_requirements=dict(memory_gb=mem)) for mem in [0.5, 0.5, 1.5]]
+    results, records = run_jobs(RecordJob, mlpr.ParallelJobHandler(num_workers=1, learn_memory=False), argslist)
+    assert all([r.retcode == 0 for r in results])
+    assert records[2]['t0'] < records[0]['t0'] < records[1]['t0']
+
+
+def test_jobs_fit_in_memory(run_jobs):
+    argslist = [dict(duration=0.3, _compute_requirements=dict(memory_gb=mem)) for mem in [0.5, 1.5, 1.5]]
+    results, records = run_jobs(RecordJob, mlpr.ParallelJobHandler(num_workers=2, memory_gb=2, learn_memory=False), argslist)
+    assert all([r.retcode == 0 for r in results])
+    # the two large jobs do not fit together, but the small one runs next to one of them
+    assert (records[1]['t1'] <= records[2]['t0']) or (records[2]['t1'] <= records[1]['t0'])
+    assert min(records[1]['t1'], records[2]['t1']) > records[0]['t0']
+
+
+def test_gpus_are_assigned(run_jobs):
+    argslist = [dict(duration=0.3, _compute_requirements=dict(num_gpus=1)) for _ in range(2)] + [dict()]
+    job_handler = mlpr.ParallelJobHandler(num_workers=3, gpu_ids=['0', '1'], learn_memory=False)
+    results, records = run_jobs(RecordJob, job_handler, argslist)
+    assert all([r.retcode == 0 for r in results])
+    assert sorted([records[0]['cuda'], records[1]['cuda']]) == ['0', '1']
+    assert records[2]['cuda'] == os.environ.get('CUDA_VISIBLE_DEVICES', None)
+
+
+def test_gpu_environment_is_unchanged_without_gpu_ids(run_jobs):
+    argslist = [dict(_compute_requirements=dict(num_gpus=1))]
+    results, records = run_jobs(RecordJob, mlpr.ParallelJobHandler(num_workers=1, gpu_ids=[], learn_memory=False), argslist)
+    assert all([r.retcode == 0 for r in results])
+    assert records[0]['cuda'] == os.environ.get('CUDA_VISIBLE_DEVICES', None)
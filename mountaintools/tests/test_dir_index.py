@@ -0,0 +1,91 @@
+import os
+import time
+import hashlib
+import shutil
+from mountainclient.dirindex import DirIndexCache
+
+
+def _write_text(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def _sha1_of_text(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class _Sha1Counter():
+    def __init__(self):
+        self.paths = []
+
+    def __call__(self, paths):
+        self.paths.extend(paths)
+        ret = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                ret.append(hashlib.sha1(f.read()).hexdigest())
+        return ret
+
+
+def _make_tree(root):
+    os.makedirs(root + '/a/b')
+    os.makedirs(root + '/c')
+    _write_text(root + '/file1.txt', 'file1')
+    _write_text(root + '/a/file2.txt', 'file2')
+    _write_text(root + '/a/b/file3.txt', 'file3')
+    _write_text(root + '/c/file4.txt', 'file4')
+
+
+def test_dir_index_cache(tmp_path):
+    tmpdir = str(tmp_path)
+    root = tmpdir + '/data'
+    _make_tree(root)
+    cache = DirIndexCache(tmpdir + '/dir-index')
+    counter = _Sha1Counter()
+
+    dd = cache.readDir(root, recursive=True, include_sha1=True, compute_file_sha1s=counter)
+    assert len(counter.paths) == 4
+    assert dd['files']['file1.txt'] == dict(size=5, sha1=_sha1_of_text('file1'))
+    assert dd['dirs']['a']['dirs']['b']['files']['file3.txt']['sha1'] == _sha1_of_text('file3')
+
+    # nothing changed: no sha1s are computed
+    counter.paths = []
+    assert cache.readDir(root, recursive=True, include_sha1=True, compute_file_sha1s=counter) == dd
+    assert counter.paths == []
+
+    # a new process uses the persisted index
+    cache2 = DirIndexCache(tmpdir + '/dir-index')
+    assert cache2.readDir(root, recursive=True, include_sha1=True, compute_file_sha1s=counter) == dd
+    assert counter.paths == []
+
+    # modify, add and remove files
+    time.sleep(0.01)
+    _write_text(root + '/a/b/file3.txt', 'file3-modified')
+    _write_text(root + '/c/file5.txt', 'file5')
+    os.unlink(root + '/file1.txt')
+    dd2 = cache.readDir(root, recursive=True, include_sha1=True, compute_file_sha1s=counter)
+    assert sorted(counter.paths) == sorted([root + '/a/b/file3.txt', root + '/c/file5.txt'])
+    assert 'file1.txt' not in dd2['files']
+    assert dd2['dirs']['a']['dirs']['b']['files']['file3.txt'] == dict(size=14, sha1=_sha1_of_text('file3-modified'))
+    assert dd2['dirs']['c']['files']['file5.txt']['sha1'] == _sha1_of_text('file5')
+    assert dd2['dirs']['a']['files'] == dd['dirs']['a']['files']
+
+    # same result as without the cache
+    assert cache.readDir(root, recursive=True, include_sha1=True, compute_file_sha1s=counter, validation='off') == dd2
+
+    # the index of a directory that no longer exists is removed
+    assert cache.cleanup() == 0
+    shutil.rmtree(root)
+    assert cache.cleanup() == 1
+    assert cache.readDir(root, recursive=True, include_sha1=True, compute_file_sha1s=counter) is None
+
+
+def test_dir_index_non_recursive(tmp_path):
+    tmpdir = str(tmp_path)
+    root = tmpdir + '/data'
+    _make_tree(root)
+    cache = DirIndexCache(None)
+    counter = _Sha1Counter()
+    dd = cache.readDir(root, recursive=False, include_sha1=False, compute_file_sha1s=counter)
+    assert dd == dict(files={'file1.txt': dict(size=5)}, dirs={'a': {}, 'c': {}})
+    assert counter.paths == []
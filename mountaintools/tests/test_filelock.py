@@ -0,0 +1,77 @@
+import time
+import threading
+import multiprocessing
+import pytest
+import mtlogging
+from mountainclient.filelock import FileLock
+
+
+def _hold_lock(path, started, duration):
+    with FileLock(path, exclusive=True, blocking=True):
+        started.set()
+        time.sleep(duration)
+
+
+@pytest.mark.parametrize('blocking', [True, False])
+def test_filelock_timeout(blocking, tmp_path):
+    tmpdir = str(tmp_path)
+    path = tmpdir + '/file.lock'
+    started = multiprocessing.Event()
+    process = multiprocessing.Process(target=_hold_lock, args=(path, started, 1))
+    process.start()
+    try:
+        assert started.wait(10)
+        with pytest.raises(Exception):
+            with FileLock(path, exclusive=False, blocking=blocking, timeout=0.2):
+                pass
+        timer = time.time()
+        with FileLock(path, exclusive=True, blocking=blocking, timeout=10):
+            # acquired once the other process releases it
+            assert time.time() - timer < 5
+    finally:
+        process.join()
+
+
+def test_filelock_shared_within_process(monkeypatch, tmp_path):
+    tmpdir = str(tmp_path)
+    path = tmpdir + '/file.lock'
+    monkeypatch.setattr(mtlogging.metrics, '_enabled', True)
+    mtlogging.reset_histograms()
+    files = []
+    barrier = threading.Barrier(4)
+
+    def target():
+        with FileLock(path, exclusive=False, blocking=True, share_descriptor=True):
+            barrier.wait(5)
+    threads = [threading.Thread(target=target) for _ in range(4)]
+    lock1 = FileLock(path, exclusive=False, share_descriptor=True)
+    lock2 = FileLock(path, exclusive=False, share_descriptor=True)
+    with lock1, lock2:
+        # the two shared locks use the same file descriptor
+        assert lock1._shared_entry is lock2._shared_entry
+        assert lock1._shared_entry.refcount == 2
+        files.append(lock1._shared_entry.file)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert files[0].closed
+    # nothing is held any more
+    with FileLock(path, exclusive=True, blocking=True, timeout=1):
+        pass
+    hh = mtlogging.histograms('filelock_wait')['filelock_wait'][path]
+    assert hh['count'] == 7
+
+
+def test_filelock_defaults(tmp_path):
+    tmpdir = str(tmp_path)
+    path = tmpdir + '/file.lock'
+    mtlogging.reset_histograms()
+    lock1 = FileLock(path, exclusive=False)
+    lock2 = FileLock(path, exclusive=False)
+    with lock1, lock2:
+        # each shared lock has a file descriptor of its own
+        assert lock1._shared_entry is None
+        assert lock1._file is not lock2._file
+    # the wait times are not recorded unless enabled
+    assert mtlogging.histograms('filelock_wait') == dict()
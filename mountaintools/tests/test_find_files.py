@@ -0,0 +1,46 @@
+import os
+import hashlib
+import pytest
+from mountainclient import MountainClient
+
+
+@pytest.mark.parametrize('batch_check', [True, False])
+def test_find_files(batch_check, kachery_server):
+    contents = ['content {}'.format(ii).encode('utf-8') for ii in range(20)]
+    sha1s = [hashlib.sha1(content).hexdigest() for content in contents]
+    mt = MountainClient()
+    server = kachery_server
+    server.batch_check = batch_check
+    for content in contents[:10]:
+        server.addContent(content)
+    paths = ['sha1://{}/file.dat'.format(sha1) for sha1 in sha1s]
+    ret = mt.findFiles(paths, remote_only=True, download_from=server.url)
+    assert ret == [server.downloadUrl(sha1) for sha1 in sha1s[:10]] + [None] * 10
+    if batch_check:
+        assert server.requests == ['POST /check/sha1']
+    else:
+        assert len(server.requests) == 21
+
+
+def test_snapshot_upload(tmp_path, kachery_server):
+    mt = MountainClient()
+    tmpdir = str(tmp_path)
+    server = kachery_server
+    os.mkdir(tmpdir + '/dir1')
+    for ii in range(10):
+        with open(tmpdir + '/dir1/file{}.txt'.format(ii), 'w') as f:
+            f.write('content {}'.format(ii))
+    # one of the files is already on the server
+    server.addContent('content 0'.encode('utf-8'))
+    mt.setKacheryUploadToken(server.url, 'token1')
+
+    address = mt.createSnapshot(tmpdir, upload_to=server.url, upload_recursive=True, num_upload_workers=3)
+    assert address.startswith('sha1dir://')
+    assert server.numFiles() == 11  # the 10 files and the directory object
+    uploads = [r for r in server.requests if r.startswith('POST /set/sha1/')]
+    assert len(uploads) == 10  # 9 files and the directory object
+
+    # nothing is uploaded the second time
+    server.requests.clear()
+    assert mt.createSnapshot(tmpdir, upload_to=server.url, upload_recursive=True) == address
+    assert [r for r in server.requests if r.startswith('POST /set/sha1/')] == []
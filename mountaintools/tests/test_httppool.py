@@ -0,0 +1,46 @@
+import hashlib
+import pytest
+from mountainclient.httppool import HttpPool
+from standin_servers import KacheryStandin
+
+
+def test_http_pool(kachery_server):
+    pool = HttpPool(pool_size=2, num_retries=2, retry_delay=0.01)
+    server = kachery_server
+    server.num_failures = 1
+    for ii in range(10):
+        sha1 = hashlib.sha1(str(ii).encode('utf-8')).hexdigest()
+        assert pool.getJson(server.url + '/check/sha1/' + sha1) == dict(success=True, found=False, size=0)
+    # the connection was kept alive and reused
+    assert len(server.client_ports) <= 2
+    metrics = list(pool.metrics().values())[0]
+    assert metrics['num_requests'] == 11
+    assert metrics['num_retries'] == 1
+    assert metrics['num_errors'] == 1
+
+    server.num_failures = 10
+    try:
+        pool.getJson(server.url + '/check/sha1/' + sha1)
+        assert False, 'expected an exception'
+    except Exception as e:
+        assert '503' in str(e)
+
+
+def test_http_pool_does_not_retry_post(kachery_server):
+    pool = HttpPool(num_retries=2, retry_delay=0.01)
+    server = kachery_server
+    server.num_failures = 1
+    response = pool.request('POST', server.url + '/check/sha1', json=dict(sha1s=[]))
+    assert response.status_code == 503
+    assert len(server.requests) == 1
+    assert pool.request('POST', server.url + '/check/sha1', json=dict(sha1s=[])).status_code == 200
+
+
+def test_http_pool_default_timeout():
+    pool = HttpPool(num_retries=1, retry_delay=0.01, timeout=(5, 0.2))
+    with KacheryStandin(latency=1) as server:
+        sha1 = hashlib.sha1(b'abc').hexdigest()
+        with pytest.raises(Exception):
+            pool.getJson(server.url + '/check/sha1/' + sha1)
+        metrics = list(pool.metrics().values())[0]
+        assert metrics['num_retries'] == 1
@@ -0,0 +1,32 @@
+import os
+import pathlib
+import hashlib
+import mountainclient.sha1cache as sha1cache_module
+from mountainclient.sha1cache import Sha1Cache
+
+
+def test_single_pass_ingest(monkeypatch, tmp_path):
+    def _no_separate_hashing(path):
+        raise Exception('Unexpected separate hashing pass for: ' + path)
+    monkeypatch.setattr(sha1cache_module, '_compute_file_sha1', _no_separate_hashing)
+    monkeypatch.setattr(sha1cache_module, '_IO_BLOCK_SIZE', 1000)
+    tmpdir = str(tmp_path)
+    cache = Sha1Cache()
+    cache.setDirectory(tmpdir + '/cache')
+    cache.setLinkMode('copy')
+    data = os.urandom(12345)
+    sha1 = hashlib.sha1(data).hexdigest()
+    pathlib.Path(tmpdir + '/file.dat').write_bytes(data)
+
+    path0, sha1_ = cache.copyFileToCache(tmpdir + '/file.dat')
+    assert sha1_ == sha1
+    assert path0 == cache._get_path(sha1, create=False)
+    with open(path0, 'rb') as f:
+        assert f.read() == data
+    # the sha1 of the source file was recorded
+    assert cache.computeFileSha1(tmpdir + '/file.dat') == sha1
+    assert os.listdir(tmpdir + '/cache/ingest') == []
+
+    # copying again does not read the file
+    assert cache.copyFileToCache(tmpdir + '/file.dat') == (path0, sha1)
+    assert cache.findFile(sha1) == path0
@@ -0,0 +1,97 @@
+import os
+import pytest
+import mlprocessors as mlpr
+from mlprocessors import MountainJob
+from mlprocessors.defaultjobhandler import DefaultJobHandler
+from mountainclient.mountainclientlocal import MountainClientLocal
+
+_global = dict(
+    num_times_called=0
+)
+
+
+class AppendSuffix(mlpr.Processor):
+    NAME = 'AppendSuffix'
+    VERSION = '0.1.0'
+
+    textfile = mlpr.Input(help="input text file")
+    textfile_out = mlpr.Output(help="output text file")
+    suffix = mlpr.StringParameter(help="suffix to append")
+
+    def run(self):
+        _global['num_times_called'] = _global['num_times_called'] + 1
+        with open(self.textfile, 'r') as f:
+            txt = f.read()
+        with open(self.textfile_out, 'w') as f:
+            f.write(txt + self.suffix)
+
+
+def _create_jobs(tmpdir, name, suffixes):
+    with open(tmpdir + '/input.txt', 'w') as f:
+        f.write('some text ')
+    return AppendSuffix.createJobs([
+        dict(textfile=tmpdir + '/input.txt', textfile_out=tmpdir + '/{}-{}.txt'.format(name, ii), suffix=suffix)
+        for ii, suffix in enumerate(suffixes)
+    ])
+
+
+@pytest.mark.parametrize('backend', ['files', 'sqlite'])
+def test_check_cache_for_jobs(monkeypatch, tmp_path, backend):
+    def _no_single_lookups(self, *, key, **kwargs):
+        raise Exception('Unexpected single lookup of a job signature')
+
+    single_lookups = []
+    get_value = MountainClientLocal.getValue
+
+    def _count_single_lookups(self, **kwargs):
+        single_lookups.append(kwargs['key'])
+        return get_value(self, **kwargs)
+
+    monkeypatch.setenv('MOUNTAIN_DB_BACKEND', backend)
+    tmpdir = str(tmp_path)
+    suffixes = ['suffix-{}'.format(os.urandom(8).hex()) for _ in range(3)]
+    jobs = _create_jobs(tmpdir, 'a', suffixes)
+    assert MountainJob.checkCacheForJobs(jobs) == [None, None, None]
+    results = [job.execute() for job in jobs[:2]]
+    assert all([r.retcode == 0 for r in results])
+
+    jobs = _create_jobs(tmpdir, 'b', suffixes)
+    monkeypatch.setattr(type(mlpr.mountainjob.local_client), 'getValue', _no_single_lookups)
+    monkeypatch.setattr(MountainClientLocal, 'getValue', _count_single_lookups)
+    results = MountainJob.checkCacheForJobs(jobs)
+    if backend == 'files':
+        # the runtime info and console output of each job, and the output of the two cached jobs
+        assert len(single_lookups) == 3 * 2 + 2
+    else:
+        # bulk queries
+        assert single_lookups == []
+    assert results[2] is None
+    for ii in range(2):
+        assert results[ii].retcode == 0
+        # the cached outputs were copied to the destination paths
+        assert results[ii].outputs['textfile_out'] == tmpdir + '/b-{}.txt'.format(ii)
+        with open(tmpdir + '/b-{}.txt'.format(ii), 'r') as f:
+            assert f.read() == 'some text ' + suffixes[ii]
+
+
+def test_job_queue_uses_cached_results(tmp_path):
+    tmpdir = str(tmp_path)
+    suffixes = ['suffix-{}'.format(os.urandom(8).hex()) for _ in range(4)]
+    num0 = _global['num_times_called']
+    with mlpr.JobQueue() as jq:
+        results = [job.execute() for job in _create_jobs(tmpdir, 'a', suffixes)]
+        jq.wait()
+    assert all([r.retcode == 0 for r in results])
+    assert _global['num_times_called'] - num0 == 4
+
+    job_handler = DefaultJobHandler()
+    with mlpr.JobQueue(job_handler=job_handler) as jq:
+        results = [job.execute() for job in _create_jobs(tmpdir, 'b', suffixes)]
+        jq.wait()
+    assert _global['num_times_called'] - num0 == 4
+    # the threads that realized the cached results were stopped with the queue
+    assert job_handler._cache_realization_pool is None
+    for ii, r in enumerate(results):
+        assert r.retcode == 0
+        with open(mlpr.mountainjob.local_client.realizeFile(r.outputs['textfile_out']), 'r') as f:
+            assert f.read() == 'some text ' + suffixes[ii]
@@ -0,0 +1,59 @@
+import os
+import copy
+import pickle
+import mlprocessors as mlpr
+from mlprocessors.defaultjobhandler import DefaultJobHandler
+
+
+class AppendText(mlpr.Processor):
+    NAME = 'AppendText'
+    VERSION = '0.1.0'
+
+    textfile = mlpr.Input(help="input text file")
+    textfile_out = mlpr.Output(help="output text file")
+    text = mlpr.StringParameter(help="text to append")
+    fail = mlpr.BoolParameter(optional=True, default=False, help="whether to fail")
+
+    def run(self):
+        assert not self.fail
+        with open(self.textfile, 'r') as f:
+            txt = f.read()
+        with open(self.textfile_out, 'w') as f:
+            f.write(txt + self.text)
+
+
+def _run_chains(tmpdir, job_handler):
+    # two chains of three jobs, where the first job of the second chain fails
+    token = os.urandom(8).hex()
+    with open(tmpdir + '/input.txt', 'w') as f:
+        f.write(token)
+    results = dict(a=[], b=[])
+    with mlpr.JobQueue(job_handler=job_handler) as jq:
+        for chain in ['a', 'b']:
+            textfile = tmpdir + '/input.txt'
+            for ii in range(3):
+                r = AppendText.execute(
+                    textfile=textfile, textfile_out=tmpdir + '/{}-{}.txt'.format(chain, ii), text=str(ii),
+                    fail=(chain == 'b') and (ii == 0)
+                )
+                results[chain].append(r)
+                textfile = r.outputs['textfile_out']
+        assert jq.wait(timeout=60)
+    return token, results
+
+
+def test_dependency_chains(tmp_path):
+    for job_handler in [DefaultJobHandler(), mlpr.ParallelJobHandler(num_workers=2)]:
+        tmpdir = str(tmp_path)
+        token, results = _run_chains(tmpdir, job_handler)
+        assert [r.retcode for r in results['a']] == [0, 0, 0]
+        with open(tmpdir + '/a-2.txt', 'r') as f:
+            assert f.read() == token + '012'
+        # the failure propagates to the jobs that depend on it
+        assert results['b'][0].retcode not in [0, 7]
+        assert [r.retcode for r in results['b'][1:]] == [7, 7]
+        assert all([r.isFinished() for r in results['b']])
+        # the results can be copied and pickled without their job queue
+        for r in results['a']:
+            assert pickle.loads(pickle.dumps(r)).outputs == r.outputs
+            assert copy.deepcopy(r).retcode == 0
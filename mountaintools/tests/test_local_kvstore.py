@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import multiprocessing
+import pytest
+from mountainclient import MountainClient
+from mountainclient.localkvstore import LocalKVStoreSqlite
+
+
+def _claim(args):
+    database_path, keyhash, worker = args
+    kvstore = LocalKVStoreSqlite(database_path)
+    return kvstore.setValue(keyhash, None, 'in-process-{}'.format(worker), overwrite=False)
+
+
+def test_local_kvstore_compare_and_set(tmp_path):
+    tmpdir = str(tmp_path)
+    kvstore = LocalKVStoreSqlite(tmpdir, num_shards=4)
+    keyhash = 'a' * 40
+    assert kvstore.setValue(keyhash, None, 'v1', overwrite=False)
+    assert not kvstore.setValue(keyhash, None, 'v2', overwrite=False)
+    assert kvstore.getValue(keyhash) == 'v1'
+    assert kvstore.setValue(keyhash, None, 'v2', overwrite=True)
+    assert kvstore.getValue(keyhash) == 'v2'
+    assert not kvstore.setValue(keyhash, None, None, overwrite=False)
+    assert kvstore.setValue(keyhash, None, None, overwrite=True)
+    assert kvstore.getValue(keyhash) is None
+
+    assert kvstore.setValue(keyhash, 's1', 'x', overwrite=False)
+    assert kvstore.setValue(keyhash, 's2', 'y', overwrite=False)
+    assert sorted(kvstore.getSubKeys(keyhash)) == ['s1', 's2']
+    assert kvstore.getSubKeyValues(keyhash) == dict(s1='x', s2='y')
+    kvstore.removeSubKeys(keyhash)
+    assert kvstore.getSubKeys(keyhash) == []
+
+    # exactly one of many concurrent processes wins
+    with multiprocessing.Pool(8) as pool:
+        results = pool.map(_claim, [(tmpdir, 'b' * 40, ii) for ii in range(32)])
+    assert sum(results) == 1
+    assert LocalKVStoreSqlite(tmpdir).numShards() == 4
+
+
+def test_local_kvstore_remove_is_atomic(tmp_path):
+    tmpdir = str(tmp_path)
+    kvstore = LocalKVStoreSqlite(tmpdir, num_shards=4)
+    keyhash = 'c' * 40
+    assert kvstore.getValue(keyhash) is None
+    # another process sets the value while we are removing it with overwrite=False
+    other = sqlite3.connect(os.path.join(kvstore.directory(), 'shard-{:02d}.db'.format(kvstore._shard_of(keyhash))), isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    other.execute('INSERT INTO kv (keyhash, value) VALUES (?, ?)', (keyhash, 'other'))
+    results = []
+    thread = threading.Thread(target=lambda: results.append(kvstore.setValue(keyhash, None, None, overwrite=False)))
+    thread.start()
+    time.sleep(0.3)
+    other.execute('COMMIT')
+    other.close()
+    thread.join()
+    assert results == [False]
+    assert kvstore.getValue(keyhash) == 'other'
+
+
+def test_local_kvstore_migration(monkeypatch, tmp_path):
+    tmpdir = str(tmp_path)
+    monkeypatch.setenv('MOUNTAIN_DIR', tmpdir)
+    monkeypatch.setenv('MOUNTAIN_DB_BACKEND', 'files')
+    mt = MountainClient()
+    assert mt.setValue(key='key1', value='value1')
+    assert mt.setValue(key=dict(name='key2'), subkey='a', value='value2a')
+    assert mt.setValue(key=dict(name='key2'), subkey='b', value='value2b')
+
+    kvstore = LocalKVStoreSqlite(mt.localDatabasePath())
+    assert kvstore.importDirectory(remove_files=True) == (1, 2)
+
+    monkeypatch.setenv('MOUNTAIN_DB_BACKEND', 'sqlite')
+    assert mt.getValue(key='key1') == 'value1'
+    assert json.loads(mt.getValue(key=dict(name='key2'), subkey='-')) == dict(a='value2a', b='value2b')
+    assert not mt.setValue(key='key1', value='other', overwrite=False)
+    assert mt.setValue(key='key3', value='value3', overwrite=False)
+    assert mt.getValue(key='key3') == 'value3'
+    # only the store and the lock files (which may be in use) are left in the database directory
+    fnames = []
+    for dirpath, dirnames, filenames in os.walk(mt.localDatabasePath()):
+        if not dirpath.startswith(os.path.join(mt.localDatabasePath(), 'kvstore')):
+            fnames.extend(filenames)
+    assert fnames
+    assert all([fname.endswith('.lock') for fname in fnames])
+
+
+@pytest.mark.parametrize('backend', ['files', 'sqlite'])
+def test_get_values(monkeypatch, backend, tmp_path):
+    tmpdir = str(tmp_path)
+    monkeypatch.setenv('MOUNTAIN_DIR', tmpdir + '/alt')
+    monkeypatch.setenv('MOUNTAIN_DB_BACKEND', backend)
+    mt = MountainClient()
+    assert mt.setValue(key='key-alt', value='value-alt')
+    monkeypatch.setenv('MOUNTAIN_DIR', tmpdir + '/main')
+    monkeypatch.setenv('MOUNTAIN_DIR_ALT', tmpdir + '/alt')
+    keys = [dict(name='key', index=ii) for ii in range(1200)]
+    for ii, key in enumerate(keys[::2]):
+        assert mt.setValue(key=key, value='value{}'.format(2 * ii))
+    values = mt.getValues(keys=keys + ['key-alt', keys[0]])
+    assert values[:1200] == [('value{}'.format(ii) if ii % 2 == 0 else None) for ii in range(1200)]
+    assert values[1200:] == [None, 'value0']
+    assert mt.getValues(keys=['key-alt', 'missing'], check_alt=True) == ['value-alt', None]
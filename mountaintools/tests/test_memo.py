@@ -0,0 +1,51 @@
+import time
+from mountainclient import MountainClient
+from mountainclient.memo import LruMemo
+
+
+def test_lru_memo():
+    memo = LruMemo(max_entries=3, max_bytes=10)
+    memo.set('a', 'aaaa')
+    memo.set('b', 'bbbb')
+    assert memo.get('a') == (True, 'aaaa')
+    memo.set('c', 'cc')
+    # over max_bytes, so the least recently used entry ('b') is evicted
+    memo.set('d', 'dd')
+    assert memo.get('b') == (False, None)
+    assert memo.get('a') == (True, 'aaaa')
+
+    memo.set('e', 'e', ttl=0.05, group='g')
+    memo.set('f', 'f', group='g')
+    assert memo.get('e') == (True, 'e')
+    time.sleep(0.1)
+    assert memo.get('e') == (False, None)
+    memo.invalidateGroup('g')
+    assert memo.get('f') == (False, None)
+    stats = memo.stats()
+    assert (stats['num_hits'], stats['num_misses']) == (3, 3)
+
+    # a value that is too large replaces the old value by nothing
+    memo.set('a', 'a' * 11)
+    assert memo.get('a') == (False, None)
+
+
+def test_mountain_client_memo():
+    mt = MountainClient()
+    mt.configMemo(True, key_ttl=60)
+    key = dict(name='test_mountain_client_memo', time=time.time())
+    assert mt.getValue(key=key) is None
+    assert mt.getValue(key=key) is None
+    assert mt.memoStats()['num_hits'] == 1
+    # setValue invalidates the memoized lookup
+    assert mt.setValue(key=key, value='value1')
+    assert mt.getValue(key=key) == 'value1'
+
+    path = mt.saveObject(dict(a=1))
+    assert mt.loadObject(path=path) == dict(a=1)
+    num_hits = mt.memoStats()['num_hits']
+    obj = mt.loadObject(path=path)
+    assert obj == dict(a=1)
+    assert mt.memoStats()['num_hits'] == num_hits + 1
+    # the returned objects are independent
+    obj['a'] = 2
+    assert mt.loadObject(path=path) == dict(a=1)
@@ -0,0 +1,47 @@
+import os
+import hashlib
+from mountainclient import MountainClient
+from mountainclient.openfile import HttpRangeFile
+
+
+def test_http_range_file(tmp_path, kachery_server):
+    content = os.urandom(10 * 1000 + 123)
+    tmpdir = str(tmp_path)
+    server = kachery_server
+    url = server.downloadUrl(server.addContent(content))
+    with HttpRangeFile(url, size=len(content), block_size=1000, block_cache_dir=tmpdir + '/blocks') as f:
+        f.seek(2500)
+        assert f.read(1000) == content[2500:3500]
+        # the two blocks were fetched with a single request
+        assert server.requested_ranges == [(2000, 4000)]
+        f.seek(3100)
+        assert f.read(100) == content[3100:3200]
+        assert len(server.requested_ranges) == 1
+        f.seek(-50, os.SEEK_END)
+        assert f.read() == content[-50:]
+        f.seek(0)
+        assert f.read() == content
+    # a new file object reads the blocks from the block cache
+    num_requests = len(server.requested_ranges)
+    with HttpRangeFile(url, size=len(content), block_size=1000, block_cache_dir=tmpdir + '/blocks') as f:
+        assert f.read() == content
+    assert len(server.requested_ranges) == num_requests
+
+
+def test_mountain_client_open_file(tmp_path, kachery_server):
+    content = os.urandom(5000)
+    tmpdir = str(tmp_path)
+    server = kachery_server
+    url = server.downloadUrl(server.addContent(content))
+    mt = MountainClient()
+    fname = tmpdir + '/file.dat'
+    with open(fname, 'wb') as f:
+        f.write(content)
+    sha1_url = mt.saveFile(path=fname)
+    with mt.openFile(sha1_url) as f:
+        f.seek(100)
+        assert f.read(10) == content[100:110]
+    with mt.openFile(url) as f:
+        f.seek(4990)
+        assert f.read() == content[4990:]
+    assert mt.openFile('sha1://' + hashlib.sha1(b'not there').hexdigest(), local_only=True) is None
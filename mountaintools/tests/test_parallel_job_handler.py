@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import mlprocessors as mlpr
+
+
+class RecordWorker(mlpr.Processor):
+    NAME = 'RecordWorker'
+    VERSION = '0.1.0'
+
+    json_out = mlpr.Output(help="output json file")
+    token = mlpr.StringParameter(help="token to make the job unique")
+    duration = mlpr.FloatParameter(optional=True, default=0, help="how long to run (seconds)")
+    crash = mlpr.BoolParameter(optional=True, default=False, help="whether to kill the worker process")
+
+    def run(self):
+        if self.crash:
+            os._exit(3)
+        t0 = time.time()
+        time.sleep(self.duration)
+        with open(self.json_out, 'w') as f:
+            json.dump(dict(pid=os.getpid(), t0=t0, t1=time.time()), f)
+
+
+def test_workers_are_reused(run_jobs):
+    results, records = run_jobs(RecordWorker, mlpr.ParallelJobHandler(num_workers=2), [dict()] * 8)
+    assert all([r.retcode == 0 for r in results])
+    pids = set([rec['pid'] for rec in records])
+    assert len(pids) <= 2
+    assert os.getpid() not in pids
+
+
+def test_worker_crash(run_jobs):
+    results, records = run_jobs(RecordWorker, mlpr.ParallelJobHandler(num_workers=1), [dict(), dict(crash=True), dict()])
+    assert [r.retcode == 0 for r in results] == [True, False, True]
+    assert 'exited unexpectedly' in results[1].console_out
+    # a new worker was started for the last job
+    assert records[0]['pid'] != records[2]['pid']
+
+
+def test_workers_exit_when_controller_goes_away():
+    handler = mlpr.ParallelJobHandler(num_workers=2, preload_modules=[])
+    workers = [handler._start_worker(), handler._start_worker()]
+    # as when the controller process dies
+    for w in workers:
+        w['conn'].close()
+    for w in workers:
+        w['process'].join(timeout=10)
+        assert w['process'].exitcode == 0
+    handler._workers = []
+
+
+def test_compute_requirements(run_jobs):
+    # each job needs both cores, so they must run one at a time
+    argslist = [dict(duration=0.3, _compute_requirements=dict(num_cores=2)) for _ in range(3)]
+    results, records = run_jobs(RecordWorker, mlpr.ParallelJobHandler(num_workers=2), argslist)
+    assert all([r.retcode == 0 for r in results])
+    intervals = sorted([(rec['t0'], rec['t1']) for rec in records])
+    for ii in range(len(intervals) - 1):
+        assert intervals[ii][1] <= intervals[ii + 1][0]
+
+
+class RecordContext(mlpr.Processor):
+    NAME = 'RecordContext'
+    VERSION = '0.1.0'
+
+    json_out = mlpr.Output(help="output json file")
+    token = mlpr.StringParameter(help="token to make the job unique")
+
+    def run(self):
+        from mountainclient import client as mt
+        with open(self.json_out, 'w') as f:
+            json.dump(dict(
+                value=os.environ.get('TEST_PARALLEL_JOB_HANDLER_VALUE', None),
+                cwd=os.getcwd(),
+                download_from=mt.getConfig()['download_from']
+            ), f)
+
+
+def test_jobs_see_current_state_of_controller(tmp_path, monkeypatch):
+    from mountainclient import client as mt
+    tmpdir = str(tmp_path)
+    monkeypatch.setattr(mt, '_config_download_from', [])
+    token = os.urandom(8).hex()
+    records = []
+    with mlpr.JobQueue(job_handler=mlpr.ParallelJobHandler(num_workers=1)) as jq:
+        for ii in range(2):
+            if ii == 1:
+                # after the worker was started
+                monkeypatch.setenv('TEST_PARALLEL_JOB_HANDLER_VALUE', 'abc')
+                monkeypatch.chdir(tmpdir)
+                mt.configDownloadFrom('some-kachery')
+            result = RecordContext.execute(json_out=tmpdir + '/out-{}.json'.format(ii), token='{}-{}'.format(token, ii))
+            assert jq.wait(timeout=60)
+            assert result.retcode == 0
+            with open(tmpdir + '/out-{}.json'.format(ii), 'r') as f:
+                records.append(json.load(f))
+    assert records[0]['value'] is None
+    assert records[0]['download_from'] == []
+    assert records[1] == dict(value='abc', cwd=os.path.realpath(tmpdir), download_from=['some-kachery'])
+
+
+def test_processor_defined_in_main(tmp_path):
+    tmpdir = str(tmp_path)
+
+    class MainProcessor(mlpr.Processor):
+        NAME = 'MainProcessor'
+        VERSION = '0.1.0'
+
+        textfile_out = mlpr.Output(help="output text file")
+        token = mlpr.StringParameter(help="token to make the job unique")
+
+        def run(self):
+            with open(self.textfile_out, 'w') as f:
+                f.write('{}'.format(os.getpid()))
+    # as for a class defined in a script or a notebook
+    MainProcessor.__module__ = '__main__'
+
+    token = os.urandom(8).hex()
+    job_handler = mlpr.ParallelJobHandler(num_workers=2)
+    with mlpr.JobQueue(job_handler=job_handler) as jq:
+        results = [
+            MainProcessor.execute(textfile_out=tmpdir + '/out-{}.txt'.format(ii), token='{}-{}'.format(token, ii))
+            for ii in range(3)
+        ]
+        assert jq.wait(timeout=60)
+        # the workers that ran the jobs have exited
+        assert job_handler._workers == []
+    assert [r.retcode for r in results] == [0, 0, 0]
+    pids = []
+    for ii in range(3):
+        with open(tmpdir + '/out-{}.txt'.format(ii), 'r') as f:
+            pids.append(int(f.read()))
+    # each job was run by a worker forked for it
+    assert len(set(pids)) == 3
+    assert os.getpid() not in pids
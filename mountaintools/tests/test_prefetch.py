@@ -0,0 +1,85 @@
+import os
+import time
+import hashlib
+from mountainclient import MountainClient
+from mountainclient.steady_download_and_compute_sha1 import download_rate_limit, _throttle
+
+
+def test_prefetch_files(kachery_server):
+    contents = [os.urandom(1000 * (ii + 1)) for ii in range(4)]
+    sha1s = [hashlib.sha1(c).hexdigest() for c in contents]
+    missing_sha1 = hashlib.sha1(b'missing').hexdigest()
+    mt = MountainClient()
+    server = kachery_server
+    for content in contents:
+        server.addContent(content)
+    paths = ['sha1://{}/file.dat'.format(sha1) for sha1 in sha1s] + ['sha1://' + sha1s[0], 'sha1://' + missing_sha1, '/some/local/path']
+    # the last file does not fit
+    stats = mt.prefetchFiles(paths, num_workers=3, max_bytes=6000, download_from=server.url)
+    assert stats['num_files'] == 5
+    assert stats['num_local'] == 0
+    assert stats['num_downloaded'] == 3
+    assert stats['num_bytes_downloaded'] == 6000
+    assert stats['num_skipped'] == 1
+    assert stats['num_not_found'] == 1
+    assert stats['num_failed'] == 0
+    assert len([r for r in server.requests if r.startswith('POST')]) == 1
+    for sha1 in sha1s[:3]:
+        assert mt.realizeFile('sha1://' + sha1, local_only=True)
+    assert mt.realizeFile('sha1://' + sha1s[3], local_only=True) is None
+
+    server.requests.clear()
+    stats = mt.prefetchFiles(paths, download_from=server.url)
+    assert stats['num_local'] == 3
+    assert stats['num_downloaded'] == 1
+    assert len([r for r in server.requests if r.startswith('GET')]) == 1
+
+
+def test_download_rate_limit():
+    with download_rate_limit(4 * 1024 * 1024):
+        timer = time.time()
+        # the first second's worth is allowed at once
+        for _ in range(5):
+            _throttle(1024 * 1024)
+        assert time.time() - timer > 0.2
+    timer = time.time()
+    _throttle(100 * 1024 * 1024)
+    assert time.time() - timer < 0.1
+
+
+def test_kachery_lookup_cache(monkeypatch, tmp_path, kachery_server):
+    # a local database and cache of our own
+    monkeypatch.setenv('MOUNTAIN_DIR', str(tmp_path / 'mountain'))
+    monkeypatch.setenv('SHA1_CACHE_DIR', str(tmp_path / 'sha1-cache'))
+    contents = [os.urandom(1000)]
+    sha1 = hashlib.sha1(contents[0]).hexdigest()
+    missing_sha1 = hashlib.sha1(os.urandom(100)).hexdigest()
+    # two clients stand in for two processes sharing the local database
+    mt1 = MountainClient()
+    mt2 = MountainClient()
+    server = kachery_server
+    for content in contents:
+        server.addContent(content)
+    url = mt1.findFile('sha1://' + sha1, download_from=server.url)
+    assert url == server.url + '/get/sha1/' + sha1
+    assert mt1.realizeFile('sha1://' + missing_sha1, download_from=server.url) is None
+    assert len(server.requests) == 2
+
+    # the lookups are not repeated
+    server.requests.clear()
+    assert mt2.findFile('sha1://' + sha1, download_from=server.url) == url
+    assert mt2.realizeFile('sha1://' + missing_sha1, download_from=server.url) is None
+    stats = mt2.prefetchFiles(['sha1://' + sha1, 'sha1://' + missing_sha1], download_from=server.url)
+    assert (stats['num_downloaded'], stats['num_not_found']) == (1, 1)
+    assert [r for r in server.requests if '/check/' in r] == []
+
+    # files that were not found are looked up again after not_found_ttl
+    mt2.configKacheryLookupCache(not_found_ttl=0)
+    server.requests.clear()
+    assert mt2.realizeFile('sha1://' + missing_sha1, download_from=server.url) is None
+    assert len(server.requests) == 1
+
+    # expired records are removed by cleanupLocalCache()
+    mt2.configKacheryLookupCache(found_ttl=0, not_found_ttl=0)
+    assert mt2.cleanupLocalCache()['num_kachery_lookups_removed'] == 2
+    assert mt2.cleanupLocalCache()['num_kachery_lookups_removed'] == 0
@@ -0,0 +1,187 @@
+import os
+import json
+import hashlib
+import pytest
+from mountainclient.sha1cache import Sha1Cache
+from mountainclient.sha1cacheindex import Sha1CacheIndexSqlite
+from mountainclient import MountainClient
+
+
+def _write_file(path, txt):
+    with open(path, 'w') as f:
+        f.write(txt)
+
+
+def _sha1_of_text(txt):
+    return hashlib.sha1(txt.encode('utf-8')).hexdigest()
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'json'])
+def test_sha1cache_index(backend, tmp_path):
+    tmpdir = str(tmp_path)
+    cache = Sha1Cache()
+    cache.setDirectory(tmpdir + '/cache')
+    cache.setIndexBackend(backend)
+
+    fname = tmpdir + '/file1.txt'
+    _write_file(fname, 'some content')
+    assert cache.computeFileSha1(fname, _cache_only=True) is None
+    sha1 = cache.computeFileSha1(fname)
+    assert sha1 == _sha1_of_text('some content')
+    assert cache.computeFileSha1(fname, _cache_only=True) == sha1
+
+    # the file is found through the hints in the index
+    assert cache.findFile(sha1) == os.path.abspath(fname)
+
+    # modifying the file invalidates both the record and the hint
+    _write_file(fname, 'some other content')
+    os.utime(fname, (0, 0))
+    assert cache.computeFileSha1(fname, _cache_only=True) is None
+    assert cache.findFile(sha1) is None
+
+
+def test_sha1cache_index_migrates_json_records(tmp_path):
+    tmpdir = str(tmp_path)
+    cache_dir = tmpdir + '/cache'
+    fname = tmpdir + '/file1.txt'
+    _write_file(fname, 'some content')
+
+    cache = Sha1Cache()
+    cache.setDirectory(cache_dir)
+    cache.setIndexBackend('json')
+    sha1 = cache.computeFileSha1(fname)
+    assert not os.path.exists(cache_dir + '/sha1-cache-index.db')
+
+    index = Sha1CacheIndexSqlite(cache_dir)
+    stat0 = os.stat(fname)
+    stat_obj = dict(path=os.path.abspath(fname), size=stat0.st_size, ino=stat0.st_ino, mtime=stat0.st_mtime, ctime=stat0.st_ctime)
+    assert index.getSha1s([stat_obj, dict(stat_obj, path='/does/not/exist')]) == [sha1, None]
+    assert json.dumps(index.getHints(sha1), sort_keys=True) == json.dumps([stat_obj], sort_keys=True)
+    # the legacy files are kept for older clients that share the cache
+    json_fnames = [fname0 for _, _, fnames in os.walk(cache_dir) for fname0 in fnames if fname0.endswith('.json')]
+    assert len(json_fnames) == 2
+    index.pruneRecords()
+    assert [fname0 for _, _, fnames in os.walk(cache_dir) for fname0 in fnames if fname0.endswith('.json')] == json_fnames
+
+
+def test_sha1cache_index_journal_mode(monkeypatch, tmp_path):
+    import mountainclient.sha1cacheindex as sha1cacheindex
+    tmpdir = str(tmp_path)
+    index = Sha1CacheIndexSqlite(tmpdir + '/cache1')
+    assert index._conn().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    # WAL mode is not used on network file systems
+    monkeypatch.setattr(sha1cacheindex, '_is_network_file_system', lambda path: True)
+    index = Sha1CacheIndexSqlite(tmpdir + '/cache2')
+    assert index._conn().execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+
+
+def test_compute_file_sha1s(tmp_path):
+    tmpdir = str(tmp_path)
+    cache = Sha1Cache()
+    cache.setDirectory(tmpdir + '/cache')
+
+    fnames = []
+    for ii in range(20):
+        fname = tmpdir + '/file{}.txt'.format(ii)
+        _write_file(fname, 'content {}'.format(ii))
+        fnames.append(fname)
+    expected = [_sha1_of_text('content {}'.format(ii)) for ii in range(20)]
+
+    assert cache.computeFileSha1(fnames[0]) == expected[0]
+    assert cache.computeFileSha1s(fnames + [tmpdir + '/does_not_exist.txt'], num_workers=4) == expected + [None]
+    # everything is now in the index
+    assert cache.computeFileSha1s(fnames, _cache_only=True) == expected
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'json'])
+def test_sha1cache_cleanup(backend, tmp_path):
+    tmpdir = str(tmp_path)
+    cache = Sha1Cache()
+    cache.setDirectory(tmpdir + '/cache')
+    cache.setIndexBackend(backend)
+
+    sha1s = []
+    for ii in range(4):
+        fname = tmpdir + '/file{}.txt'.format(ii)
+        _write_file(fname, 'x' * 1000 + str(ii))
+        path0, sha1 = cache.copyFileToCache(fname)
+        os.utime(path0, (1000 + ii, 1000 + ii))
+        cache._index().touch([sha1], timestamp=1000 + ii)
+        sha1s.append(sha1)
+    # a record for a file that no longer exists, and an orphaned lock file
+    _write_file(tmpdir + '/removed.txt', 'removed')
+    cache.computeFileSha1(tmpdir + '/removed.txt')
+    os.remove(tmpdir + '/removed.txt')
+    orphaned_lock = cache._get_path(sha1s[0]) + '.something.lock'
+    _write_file(orphaned_lock, '')
+    os.utime(orphaned_lock, (1000, 1000))
+    # a lock file that may still be in use is kept
+    recent_lock = cache._get_path(sha1s[0]) + '.other.lock'
+    _write_file(recent_lock, '')
+
+    with cache.pinFiles([sha1s[0]]):
+        stats = cache.cleanup(max_bytes=2500)
+    assert stats['num_files'] == 4
+    assert stats['num_index_entries_removed'] >= 1
+    assert not os.path.exists(orphaned_lock)
+    assert os.path.exists(recent_lock)
+    # file 0 is the oldest but it is pinned, so files 1 and 2 are evicted
+    assert stats['num_files_pinned'] == 1
+    assert stats['num_files_evicted'] == 2
+    assert [os.path.exists(cache._get_path(sha1, create=False)) for sha1 in sha1s] == [True, False, False, True]
+    assert not os.listdir(tmpdir + '/cache/pins')
+
+    # with nothing pinned the oldest file goes next
+    stats = cache.cleanup(max_bytes=1500)
+    assert stats['num_files_evicted'] == 1
+    assert [os.path.exists(cache._get_path(sha1, create=False)) for sha1 in sha1s] == [False, False, False, True]
+
+
+@pytest.mark.parametrize('mode', ['copy', 'reflink', 'hardlink', 'symlink', 'auto'])
+def test_sha1cache_link_modes(mode, tmp_path):
+    tmpdir = str(tmp_path)
+    cache = Sha1Cache()
+    cache.setDirectory(tmpdir + '/cache')
+    cache.setLinkMode(mode)
+
+    fname = tmpdir + '/file1.txt'
+    _write_file(fname, 'some content')
+    path0, sha1 = cache.copyFileToCache(fname)
+    if mode in ['hardlink', 'symlink']:
+        assert os.stat(path0).st_ino == os.stat(fname).st_ino
+    elif mode in ['copy', 'reflink']:
+        assert os.stat(path0).st_ino != os.stat(fname).st_ino
+    # the source file is still recognized after linking
+    assert cache.computeFileSha1(fname, _cache_only=True) == sha1
+    os.remove(fname)
+
+    dest_path = tmpdir + '/dest.txt'
+    used_mode = cache.materializeFile(sha1, cache.findFile(sha1), dest_path)
+    if mode in ['copy', 'hardlink', 'symlink']:
+        assert used_mode == mode
+    assert os.path.islink(dest_path) == (mode == 'symlink')
+    with open(dest_path) as f:
+        assert f.read() == 'some content'
+    assert cache.computeFileSha1(dest_path, _cache_only=True) == sha1
+    assert cache.findFile(sha1) == path0
+
+    if used_mode in ['hardlink', 'symlink']:
+        # modifying the cached data through the link is detected
+        os.chmod(dest_path, 0o644)
+        _write_file(dest_path, 'modified content')
+        os.utime(path0, (0, 0))
+        assert cache.findFile(sha1) is None
+        assert not os.path.exists(path0)
+
+
+def test_pin_files_in_sha1dir(monkeypatch, tmp_path):
+    tmpdir = str(tmp_path)
+    monkeypatch.setenv('MOUNTAIN_DIR', tmpdir + '/.mountain')
+    monkeypatch.setenv('SHA1_CACHE_DIR', tmpdir + '/cache')
+    mt = MountainClient()
+    _write_file(tmpdir + '/file1.txt', 'some content')
+    sha1 = mt.computeFileSha1(mt.saveFile(tmpdir + '/file1.txt'))
+    dir_path = mt.saveObject(dict(files={'file1.txt': dict(size=12, sha1=sha1)}, dirs=dict()))
+    sha1dir = dir_path.split('/')[2]
+    with mt.pinFiles(['sha1dir://{}/file1.txt'.format(sha1dir), '/some/local/path']) as pins:
+        assert pins._sha1s == [sha1]
@@ -0,0 +1,85 @@
+import os
+import hashlib
+import threading
+import pytest
+from mountainclient.steady_download_and_compute_sha1 import steady_download_and_compute_sha1
+
+
+def test_steady_download(tmp_path, kachery_server):
+    content = os.urandom(100000)
+    tmpdir = str(tmp_path)
+    server = kachery_server
+    url = server.downloadUrl(server.addContent(content))
+    # small file, single request
+    sha1 = steady_download_and_compute_sha1(url, tmpdir + '/small.dat')
+    assert sha1 == hashlib.sha1(content).hexdigest()
+    # many ranges
+    sha1 = steady_download_and_compute_sha1(url, tmpdir + '/file.dat', chunk_size=7000, num_workers=4)
+    assert sha1 == hashlib.sha1(content).hexdigest()
+    with open(tmpdir + '/file.dat', 'rb') as f:
+        assert f.read() == content
+    assert sorted([r[0] for r in server.requested_ranges]) == list(range(0, 100000, 7000))
+    assert sorted(os.listdir(tmpdir)) == ['file.dat', 'file.dat.lock', 'small.dat', 'small.dat.lock']
+
+
+def test_steady_download_resume(monkeypatch, tmp_path, kachery_server):
+    import mountainclient.steady_download_and_compute_sha1 as sd
+    monkeypatch.setattr(sd, '_RETRY_DELAY', 0.01)
+    content = os.urandom(100000)
+    tmpdir = str(tmp_path)
+    server = kachery_server
+    url = server.downloadUrl(server.addContent(content))
+    server.failing_ranges = set([50000])
+    with pytest.raises(Exception):
+        steady_download_and_compute_sha1(url, tmpdir + '/file.dat', chunk_size=10000, num_workers=1)
+    assert not os.path.exists(tmpdir + '/file.dat')
+    assert os.path.exists(tmpdir + '/file.dat.part')
+
+    server.failing_ranges = set()
+    server.requested_ranges.clear()
+    sha1 = steady_download_and_compute_sha1(url, tmpdir + '/file.dat', chunk_size=10000, num_workers=2)
+    assert sha1 == hashlib.sha1(content).hexdigest()
+    # the ranges downloaded before the interruption were not downloaded again
+    assert 0 not in [r[0] for r in server.requested_ranges]
+    assert 50000 in [r[0] for r in server.requested_ranges]
+    assert sorted(os.listdir(tmpdir)) == ['file.dat', 'file.dat.lock']
+
+
+def test_concurrent_downloads_to_same_target(tmp_path, kachery_server):
+    content = os.urandom(100000)
+    tmpdir = str(tmp_path)
+    server = kachery_server
+    url = server.downloadUrl(server.addContent(content))
+    results = []
+
+    def download():
+        try:
+            results.append(steady_download_and_compute_sha1(url, tmpdir + '/file.dat', chunk_size=7000))
+        except Exception as e:
+            results.append(e)
+    threads = [threading.Thread(target=download) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [hashlib.sha1(content).hexdigest()] * 4
+    # the file was downloaded once, and the lock file is left in place
+    assert len(server.requested_ranges) == len(range(0, 100000, 7000))
+    assert sorted(os.listdir(tmpdir)) == ['file.dat', 'file.dat.lock']
+
+
+def test_download_to_dest_path_leaves_no_lock_file(tmp_path, kachery_server):
+    from mountainclient.sha1cache import Sha1Cache
+    content = os.urandom(100000)
+    tmpdir = str(tmp_path)
+    os.mkdir(tmpdir + '/dest')
+    cache = Sha1Cache()
+    cache.setDirectory(tmpdir + '/cache')
+    server = kachery_server
+    url = server.downloadUrl(server.addContent(content))
+    sha1 = hashlib.sha1(content).hexdigest()
+    assert cache.downloadFile(url, sha1, target_path=tmpdir + '/dest/file.dat') == tmpdir + '/dest/file.dat'
+    with open(tmpdir + '/dest/file.dat', 'rb') as f:
+        assert f.read() == content
+    # the lock and the partial download were in the cache directory
+    assert os.listdir(tmpdir + '/dest') == ['file.dat']
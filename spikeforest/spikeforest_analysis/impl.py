@@ -168,15 +168,17 @@ def _clear_job_results(*, jobs, incomplete_only=True):
 
 
 def _download_recordings(*, jobs):
+    fnames = []
     for _, job in enumerate(jobs):
         val = mt.getValue(key=job)
         if not val:
             if 'recording' in job:
                 if 'directory' in job['recording']:
                     dsdir = job['recording']['directory']
-                    fname = dsdir + '/raw.mda'
-                    print('REALIZING FILE: ' + fname)
-                    mt.realizeFile(path=fname)
+                    fnames.append(dsdir + '/raw.mda')
+    print('PREFETCHING {} FILES'.format(len(fnames)))
+    stats = mt.prefetchFiles(fnames, verbose=True)
+    print('Downloaded {} files ({} already local)'.format(stats['num_downloaded'], stats['num_local']))
 
 
 def _make_timestamp():
@@ -1,8 +1,6 @@
 import numpy as np
 import struct
 import os
-import requests
-import tempfile
 import traceback
 
 
@@ -54,6 +52,7 @@ class DiskReadMda:
     def __init__(self, path, header=None):
         self._npy_mode = False
         self._path = path
+        self._file = None
         if (file_extension(path) == '.npy'):
             raise Exception('DiskReadMda implementation has not been tested for npy files')
             # self._npy_mode = True
@@ -62,9 +61,23 @@ class DiskReadMda:
         if header:
             self._header = header
             self._header.header_size = 0
+        elif is_url(path):
+            self._header = _read_header_from_file(self._remote_file())
         else:
             self._header = _read_header(self._path)
 
+    def __getstate__(self):
+        # the remote file is not pickled; it is opened again when needed
+        state = dict(self.__dict__)
+        state['_file'] = None
+        return state
+
+    def close(self):
+        """Close the remote file (if any). It is opened again by the next read."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
     def dims(self):
         if self._npy_mode:
             A = np.load(self._path, mmap_mode='r')
@@ -127,15 +140,20 @@ class DiskReadMda:
     def _read_chunk_1d(self, i, N):
         offset = self._header.header_size + self._header.num_bytes_per_entry * i
         if is_url(self._path):
-            tmp_fname = _download_bytes_to_tmpfile(self._path, offset, offset + self._header.num_bytes_per_entry * N)
-            try:
-                ret = self._read_chunk_1d_helper(tmp_fname, N, offset=0)
-            except:
-                ret = None
-            # os.remove(tmp_fname)
-            return ret
+            # errors reading the remote file (e.g., a failed range request) are raised
+            f = self._remote_file()
+            f.seek(offset)
+            buf = _read_exact(f, self._header.num_bytes_per_entry * N)
+            return np.frombuffer(buf, dtype=self._header.dt)
         return self._read_chunk_1d_helper(self._path, N, offset=offset)
 
+    def _remote_file(self):
+        # kept open between reads, so that the url is resolved only once and
+        # the fetched blocks are reused
+        if self._file is None:
+            self._file = _open_url(self._path)
+        return self._file
+
     def _read_chunk_1d_helper(self, path0, N, *, offset):
         f = open(path0, "rb")
         try:
@@ -155,30 +173,37 @@ def is_url(path):
         'kbucket://') or path.startswith('sha1://') or path.startswith('sha1dir://')
 
 
-def _download_bytes_to_tmpfile(url, start, end):
-    headers = {"Range": "bytes={}-{}".format(start, end - 1)}
-    r = requests.get(url, headers=headers, stream=True)
-    _, tmp_fname = tempfile.mkstemp()
-    with open(tmp_fname, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-    return tmp_fname
+def _open_url(path):
+    # seekable file object that reads the remote content with range requests
+    from mountaintools import client as mt
+    f = mt.openFile(path)
+    if f is None:
+        raise Exception('Unable to open file: ' + path)
+    return f
+
+
+def _read_exact(f, num_bytes):
+    buf = bytearray(num_bytes)
+    view = memoryview(buf)
+    num_read = 0
+    while num_read < num_bytes:
+        n = f.readinto(view[num_read:])
+        if not n:
+            raise Exception('Unexpected end of file')
+        num_read = num_read + n
+    return buf
 
 
 def _read_header(path):
     if is_url(path):
-        tmp_fname = _download_bytes_to_tmpfile(path, 0, 200)
-        if not tmp_fname:
-            raise Exception('Problem downloading bytes from ' + path)
-        try:
-            ret = _read_header(tmp_fname)
-        except:
-            ret = None
-        os.remove(tmp_fname)
-        return ret
+        with _open_url(path) as f:
+            return _read_header_from_file(f)
+    with open(path, "rb") as f:
+        return _read_header_from_file(f)
 
-    f = open(path, "rb")
+
+def _read_header_from_file(f):
+    f.seek(0)
     try:
         dt_code = _read_int32(f)
         _ = _read_int32(f)  # num bytes per entry
@@ -189,7 +214,6 @@ def _read_header(path):
             num_dims = -num_dims
         if (num_dims < 1) or (num_dims > 6):  # allow single dimension as of 12/6/17
             print("Invalid number of dimensions: {}".format(num_dims))
-            f.close()
             return None
         dims = []
         dimprod = 1
@@ -206,17 +230,14 @@ def _read_header(path):
         dt = _dt_from_dt_code(dt_code)
         if dt is None:
             print("Invalid data type code: {}".format(dt_code))
-            f.close()
             return None
         H = MdaHeader(dt, dims)
         if (uses64bitdims):
             H.uses64bitdims = True
             H.header_size = 3 * 4 + H.num_dims * 8
-        f.close()
         return H
     except Exception as e:  # catch *all* exceptions
         print(e)
-        f.close()
         return None
 
 
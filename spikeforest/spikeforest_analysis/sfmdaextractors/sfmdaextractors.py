@@ -46,6 +46,9 @@ class SFMdaRecordingExtractor(RecordingExtractor):
         #     self._timeseries_path = ca.findFile(path=timeseries0)
 
         X = DiskReadMda(timeseries_path_or_url)
+        # a remote file is read with range requests and kept open between calls
+        # to get_traces (it is not pickled with the extractor, see DiskReadMda)
+        self._remote_timeseries = X if not mt.isLocalPath(self._timeseries_path) else None
         if self._geom.shape[0] != X.N1():
             # raise Exception(
             #    'Incompatible dimensions between geom.csv and timeseries file {} <> {}'.format(self._geom.shape[0], X.N1()))
@@ -69,6 +72,11 @@ class SFMdaRecordingExtractor(RecordingExtractor):
     def recordingDirectory(self):
         return self._dataset_directory
 
+    def close(self):
+        """Close the remote timeseries file (if any)"""
+        if self._remote_timeseries is not None:
+            self._remote_timeseries.close()
+
     def get_channel_ids(self):
         return list(range(self._num_channels))
 
@@ -80,15 +88,16 @@ class SFMdaRecordingExtractor(RecordingExtractor):
 
     @mtlogging.log(name='SFMdaRecordingExtractor:get_traces')
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
-        if not mt.isLocalPath(self._timeseries_path):
-            raise Exception('Cannot get traces -- timeseries file is not downloaded')
         if start_frame is None:
             start_frame = 0
         if end_frame is None:
             end_frame = self.get_num_frames()
         if channel_ids is None:
             channel_ids = self.get_channel_ids()
-        X = DiskReadMda(self._timeseries_path)
+        if self._remote_timeseries is not None:
+            X = self._remote_timeseries
+        else:
+            X = DiskReadMda(self._timeseries_path)
         recordings = X.readChunk(i1=0, i2=start_frame, N1=X.N1(), N2=end_frame - start_frame)
         recordings = recordings[channel_ids, :]
         return recordings